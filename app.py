@@ -1,3 +1,5 @@
+import asyncio
+import dataclasses
 import os
 from typing import Optional, Tuple
 
@@ -7,9 +9,16 @@ from buster.completers import Completion
 
 # from embed_docs import embed_rtd_website
 # from rtd_scraper.scrape_rtd import scrape_rtd
-from embed_docs import embed_documents
+from async_serving import AsyncBuster, OpenAISession
+from embed_docs import store_is_up_to_date
 import cfg
 from cfg import setup_buster
+from metrics import serve_metrics
+from refresh import StoreRefresher, build_store, swap_retriever
+from manifest import get_manifest_path
+from shards import ShardManager, Site, parse_sites
+from singleflight import AsyncSingleFlightBuster
+from streaming import acoalesce, coalesce
 
 # Typehint for chatbot history
 ChatHistory = list[list[Optional[str], Optional[str]]]
@@ -19,18 +28,36 @@ ChatHistory = list[list[Optional[str], Optional[str]]]
 openai_api_key = os.getenv("OPENAI_API_KEY")  # Mandatory for app to work
 readthedocs_url = os.getenv("READTHEDOCS_URL")  # Mandatory for app to work as intended
 readthedocs_version = os.getenv("READTHEDOCS_VERSION")
+# Serve several sites from this app instead, e.g. "https://orion.readthedocs.io@en/v0.2.7,buster.readthedocs.io"
+readthedocs_sites = os.getenv("READTHEDOCS_SITES")
+# Loaded sites are evicted (least recently used first) once their vector stores exceed this size
+shards_memory_budget_mb = os.getenv("SHARDS_MEMORY_BUDGET_MB")
+# Set to rebuild the vector store on startup even if it is up to date
+force_rebuild = os.getenv("FORCE_REBUILD", "false").lower() in ["1", "true", "yes"]
+# Serve chats from an asyncio event loop instead of one worker thread each
+async_serving = os.getenv("ASYNC_SERVING", "true").lower() in ["1", "true", "yes"]
+# Number of chats answered concurrently
+concurrency_count = int(os.getenv("CONCURRENCY_COUNT", 256 if async_serving else 8))
+# Keep the crawled pages in a single compressed archive ("archive") instead of one file each ("files")
+crawl_output_format = os.getenv("CRAWL_OUTPUT_FORMAT", "files")
+# Answers are streamed to the browser in chunks sent at most every this many milliseconds, 0 to send each token
+stream_flush_interval_ms = float(os.getenv("STREAM_FLUSH_INTERVAL_MS", 50))
+# Serve Prometheus metrics (latency of each stage of the chats) on this port
+metrics_port = os.getenv("METRICS_PORT")
+# Crawl and embed the docs again every this many minutes while serving, swapping in the new stores once built
+refresh_interval_minutes = os.getenv("REFRESH_INTERVAL_MINUTES")
 
 if openai_api_key is None:
     print(
         "Warning: No OPENAI_API_KEY detected. Set it with 'export OPENAI_API_KEY=sk-...'."
     )
 
-if readthedocs_url is None:
+if readthedocs_url is None and readthedocs_sites is None:
     raise ValueError(
         "No READTHEDOCS_URL detected. Set it with e.g. 'export READTHEDOCS_URL=https://orion.readthedocs.io/'"
     )
 
-if readthedocs_version is None:
+if readthedocs_sites is None and readthedocs_version is None:
     print(
         """
     Warning: No READTHEDOCS_VERSION detected. If multiple versions of the docs exist, they will all be scraped.
@@ -39,19 +66,101 @@ if readthedocs_version is None:
     )
 
 
+if metrics_port is not None:
+    serve_metrics(int(metrics_port))
+
 # Override to put it anywhere
 save_directory = "outputs/"
 
+if readthedocs_sites is not None:
+    # Each site gets its own vector store, in outputs/shards/<site>/
+    sites = parse_sites(
+        readthedocs_sites, save_root=os.path.join(save_directory, "shards")
+    )
+else:
+    sites = [
+        Site(
+            url=readthedocs_url,
+            version=readthedocs_version,
+            save_directory=save_directory,
+        )
+    ]
+
 # scrape and embed content from readthedocs website
-# You only need to embed the first time the app runs, comment it out to skip
-embed_documents(
-    homepage_url=readthedocs_url,
-    save_directory=save_directory,
-    target_version=readthedocs_version,
-)
+# This only happens when the store's manifest doesn't match the current settings, or on FORCE_REBUILD
+for site in sites:
+    if force_rebuild or not store_is_up_to_date(
+        homepage_url=site.url,
+        save_directory=site.save_directory,
+        target_version=site.version,
+        output_format=crawl_output_format,
+        vector_store_path=site.vector_store_path,
+    ):
+        # In a child process: Scrapy's reactor can't be started again for the next site
+        build_store(site, site.vector_store_path, crawl_output_format)
+    else:
+        print(
+            f"Vector store of {site.name} is up to date, skipping crawling and embedding."
+        )
+
+# All sites share the same pool of connections to OpenAI
+openai_session = OpenAISession()
+
+
+def load_shard(site: Site) -> AsyncBuster:
+    """Setup the RAG agent of a site"""
+    vector_store_path = site.vector_store_path
+    buster_cfg = dataclasses.replace(
+        cfg.buster_cfg,
+        retriever_cfg={**cfg.buster_cfg.retriever_cfg, "path": vector_store_path},
+    )
+    buster = setup_buster(
+        buster_cfg, cfg.answer_cache_cfg, speculative=cfg.speculative_validation
+    )
+    async_buster = AsyncBuster(buster, session=openai_session)
+    if cfg.single_flight:
+        # Answers are shared until the store is rebuilt, which rewrites its manifest
+        return AsyncSingleFlightBuster(
+            async_buster, version_path=get_manifest_path(vector_store_path)
+        )
+    return async_buster
+
+
+def swap_store(site: Site, vector_store_path: str, retriever):
+    """Serve a site from a new version of its store, see refresh.StoreRefresher.
+
+    Sites that aren't loaded are loaded from it when first asked about.
+    """
+
+    def swap(shard):
+        if isinstance(shard, AsyncSingleFlightBuster):
+            shard.set_version_path(get_manifest_path(vector_store_path))
+            shard = shard.async_buster
+        swap_retriever(shard.buster, retriever, vector_store_path)
+
+    shards.update(site.name, swap)
 
-# Setup RAG agent
-buster = setup_buster(cfg.buster_cfg)
+
+shards = ShardManager(
+    sites,
+    load_fn=load_shard,
+    memory_budget=(
+        int(float(shards_memory_budget_mb) * 1e6) if shards_memory_budget_mb else None
+    ),
+)
+# Sites are loaded when first asked about, except the default one
+default_site = sites[0].name
+shards.get(default_site)
+
+if refresh_interval_minutes is not None:
+    refresher = StoreRefresher(
+        sites,
+        interval=float(refresh_interval_minutes) * 60,
+        on_swap=swap_store,
+        retriever_cfg=cfg.buster_cfg.retriever_cfg,
+        output_format=crawl_output_format,
+    )
+    refresher.start()
 
 
 # Setup Gradio app
@@ -103,23 +212,65 @@ def add_sources(history, completion):
     return history
 
 
-def chat(chat_history: ChatHistory) -> Tuple[ChatHistory, Completion]:
+def chat(
+    chat_history: ChatHistory, site_name: str = default_site
+) -> Tuple[ChatHistory, Completion]:
     """Answer a user's question using retrieval augmented generation."""
 
     # We assume that the question is the user's last interaction
     user_input = chat_history[-1][0]
 
-    # Do retrieval + augmented generation with buster
+    # Do retrieval + augmented generation with the buster of the site
+    buster = shards.get(site_name).buster
     completion = buster.process_input(user_input)
 
-    # Stream tokens one at a time to the user
+    # Stream the answer to the user. Each update sends the whole chat history, so tokens are sent in chunks
+    chat_history[-1][1] = ""
+    for chunk in coalesce(
+        completion.answer_generator, interval=stream_flush_interval_ms / 1000
+    ):
+        chat_history[-1][1] += chunk
+
+        yield chat_history, completion
+
+
+async def chat_async(
+    chat_history: ChatHistory, site_name: str = default_site
+) -> Tuple[ChatHistory, Completion]:
+    """Same as chat, without blocking a worker thread. Cancelled if the user disconnects."""
+
+    # We assume that the question is the user's last interaction
+    user_input = chat_history[-1][0]
+
+    # Loading a site's store blocks, keep it off the event loop
+    async_buster = await asyncio.to_thread(shards.get, site_name)
+    completion = await async_buster.process_input(user_input)
+
     chat_history[-1][1] = ""
-    for token in completion.answer_generator:
-        chat_history[-1][1] += token
+    async for chunk in acoalesce(
+        completion.answer_generator, interval=stream_flush_interval_ms / 1000
+    ):
+        chat_history[-1][1] += chunk
 
         yield chat_history, completion
 
 
+def ask(site_name: str, question: str) -> dict:
+    """API: answer a question about a site, with the sources used."""
+    buster = shards.get(site_name).buster
+    completion = buster.process_input(question)
+    answer = completion.answer_text
+
+    sources = []
+    if completion.answer_relevant:
+        # Chunks collapsed by dedup.deduplicate also list the urls of the pages they stand for
+        columns = [
+            c for c in ["title", "url", "urls"] if c in completion.matched_documents
+        ]
+        sources = completion.matched_documents[columns].to_dict("records")
+    return {"site": site_name, "answer": answer, "sources": sources}
+
+
 demo = gr.Blocks()
 with demo:
     with gr.Row():
@@ -145,6 +296,13 @@ with demo:
         """
     )
 
+    site = gr.Dropdown(
+        choices=shards.names,
+        value=default_site,
+        label="Documentation",
+        visible=len(sites) > 1,
+    )
+
     chatbot = gr.Chatbot()
 
     with gr.Row():
@@ -173,8 +331,8 @@ with demo:
         inputs=[question],
         outputs=[chatbot]
     ).then(
-        chat,
-        inputs=[chatbot],
+        chat_async if async_serving else chat,
+        inputs=[chatbot, site],
         outputs=[chatbot, response]
     ).then(
         add_sources,
@@ -182,6 +340,16 @@ with demo:
         outputs=[chatbot]
     )
 
+    # API only, e.g. gradio_client.Client(url).predict(site, question, api_name="/ask")
+    ask_button = gr.Button(visible=False)
+    ask_answer = gr.JSON(visible=False)
+    ask_button.click(
+        ask,
+        inputs=[site, question],
+        outputs=[ask_answer],
+        api_name="ask"
+    )
+
 
-demo.queue(concurrency_count=8)
+demo.queue(concurrency_count=concurrency_count)
 demo.launch(share=False)
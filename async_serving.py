@@ -0,0 +1,413 @@
+import asyncio
+import contextlib
+import logging
+import re
+import time
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+import aiohttp
+import numpy as np
+import openai
+import pandas as pd
+from buster.busterbot import Buster
+from buster.completers import Completion
+from openai.embeddings_utils import cosine_similarity
+
+from caching import (
+    CachedAnswer,
+    CachedBuster,
+    CachedRetriever,
+    is_cacheable,
+    normalize_question,
+)
+from metrics import Trace, current_trace, span, traced_astream
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncCompletion(Completion):
+    """Completion whose answer_generator is an async generator.
+
+    The answer relevance is only known once the answer is fully streamed, it is False until then.
+    """
+
+    def __init__(
+        self,
+        user_input: str,
+        matched_documents: pd.DataFrame,
+        answer_stream: AsyncIterator[str],
+        postprocess: Optional[Callable[["AsyncCompletion"], Awaitable]] = None,
+        error: bool = False,
+        question_relevant: bool = True,
+        answer_relevant: bool = False,
+        completion_kwargs: Optional[dict] = None,
+    ):
+        super().__init__(
+            error=error,
+            user_input=user_input,
+            matched_documents=matched_documents,
+            answer_text="",
+            answer_relevant=answer_relevant,
+            question_relevant=question_relevant,
+            completion_kwargs=completion_kwargs,
+            validator=None,
+        )
+        self._answer_stream = answer_stream
+        self._apostprocess = postprocess
+
+    @property
+    def answer_generator(self) -> AsyncIterator[str]:
+        return self._stream()
+
+    async def _stream(self) -> AsyncIterator[str]:
+        self._answer_text = ""
+        async for token in self._answer_stream:
+            self._answer_text += token
+            yield token
+        if self._apostprocess is not None:
+            await self._apostprocess(self)
+
+
+async def _replay(tokens: list[str]) -> AsyncIterator[str]:
+    for token in tokens:
+        yield token
+
+
+class OpenAISession:
+    """Pooled aiohttp session with keep-alive, shared by the OpenAI calls of all chats."""
+
+    def __init__(self, max_connections: int = 256, keepalive_timeout: float = 60):
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def use(self):
+        """Make the OpenAI calls of the current task go through the shared session.
+
+        openai.aiosession is a context variable, it must be set by every task making requests.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections, keepalive_timeout=self.keepalive_timeout
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        openai.aiosession.set(self._session)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+class AsyncBuster:
+    """Asyncio counterpart of SpeculativeBuster.process_input, to serve many concurrent chats from one event loop.
+
+    Uses the retriever, document answerer and validator of a (sync) buster, but makes all OpenAI calls
+    asynchronously over a pooled aiohttp session with keep-alive (see OpenAISession), which can be shared by
+    several AsyncBusters. The question is validated concurrently with the retrieval and answer generation.
+    Every call is bounded by request_timeout, and cancelling a chat (e.g. the user disconnecting) cancels its
+    pending requests and closes its answer stream.
+    If the buster is a CachedBuster, its answer cache is used as well.
+    """
+
+    def __init__(
+        self,
+        buster: Buster,
+        session: Optional["OpenAISession"] = None,
+        request_timeout: float = 60,
+    ):
+        self.buster = buster
+        self.session = session if session is not None else OpenAISession()
+        self.request_timeout = request_timeout
+        self._unknown_embeddings: Optional[list[np.ndarray]] = None
+
+    @property
+    def retriever(self):
+        return self.buster.retriever
+
+    @property
+    def validator(self):
+        return self.buster.validator
+
+    @property
+    def document_answerer(self):
+        return self.buster.document_answerer
+
+    async def close(self):
+        await self.session.close()
+
+    async def embed(self, text: str, model: str) -> np.ndarray:
+        self.session.use()
+        response = await openai.Embedding.acreate(
+            input=[text.replace("\n", " ")],
+            model=model,
+            request_timeout=self.request_timeout,
+        )
+        return np.array(response["data"][0]["embedding"], dtype=np.float32)
+
+    async def embed_question(self, question: str) -> np.ndarray:
+        if not isinstance(self.retriever, CachedRetriever):
+            with span("embed_query"):
+                return await self.embed(question, self.retriever.embedding_model)
+
+        # Share the embeddings cached by the retriever
+        self.retriever._check_version()
+        key = normalize_question(question)
+        embedding = self.retriever.embeddings.get(key)
+        if embedding is None:
+            with span("embed_query"):
+                embedding = await self.embed(question, self.retriever.embedding_model)
+            self.retriever.embeddings.put(key, embedding)
+        return embedding
+
+    async def check_question_relevance(self, question: str) -> tuple[bool, str]:
+        """Same as QuestionAnswerValidator.check_question_relevance."""
+        self.session.use()
+        try:
+            with span("validate"):
+                response = await openai.ChatCompletion.acreate(
+                    messages=[
+                        {
+                            "role": "system",
+                            "content": self.validator.check_question_prompt,
+                        },
+                        {"role": "user", "content": question},
+                    ],
+                    request_timeout=self.request_timeout,
+                    **self.validator.completer.completion_kwargs,
+                )
+        except openai.error.OpenAIError:
+            logger.exception(
+                "Something went wrong during question relevance detection. See traceback:"
+            )
+            return (
+                False,
+                "Unable to process your question at the moment, try again soon",
+            )
+
+        outputs = response["choices"][0]["message"]["content"].strip(".").lower()
+        question_relevant = outputs == "true"
+        logger.info(f"Question {question_relevant=}")
+        return question_relevant, self.validator.invalid_question_response
+
+    async def retrieve(
+        self,
+        question: str,
+        embedding: np.ndarray,
+        sources: Optional[list[str]] = None,
+        top_k: Optional[int] = None,
+    ) -> pd.DataFrame:
+        """Same as Retriever.retrieve, from the question's embedding. The search runs in a thread."""
+        if top_k is None:
+            top_k = self.retriever.top_k
+        text_kwargs = (
+            {"query": question}
+            if getattr(self.retriever, "uses_query_text", False)
+            else {}
+        )
+        with span("retrieve") as attributes:
+            matched_documents = await asyncio.to_thread(
+                self.retriever.get_topk_documents,
+                embedding=embedding,
+                sources=sources,
+                top_k=top_k,
+                **text_kwargs,
+            )
+            if len(matched_documents) > 0:
+                matched_documents = self.retriever.threshold_documents(
+                    matched_documents, self.retriever.thresh
+                )
+            attributes["documents"] = len(matched_documents)
+        return matched_documents
+
+    async def complete(self, prompt: str, user_input: str) -> AsyncIterator[str]:
+        """Request the answer, returns the stream of its tokens once the response starts."""
+        self.session.use()
+        completion_kwargs = self.document_answerer.completer.completion_kwargs
+        start = time.perf_counter()
+        with span("completion_request"):
+            response = await openai.ChatCompletion.acreate(
+                messages=[
+                    {"role": "system", "content": prompt},
+                    {"role": "user", "content": user_input},
+                ],
+                request_timeout=self.request_timeout,
+                **{**completion_kwargs, "stream": True},
+            )
+
+        async def tokens():
+            try:
+                async for chunk in response:
+                    yield chunk["choices"][0]["delta"].get("content", "")
+            finally:
+                # Releases the connection when the stream is abandoned
+                await response.aclose()
+
+        return traced_astream(tokens(), start, current_trace())
+
+    async def postprocess(self, completion: AsyncCompletion):
+        """Rerank the documents and check the answer relevance, like Completion.postprocess."""
+        if completion.error or len(completion.matched_documents) == 0:
+            return
+
+        model = self.validator.embedding_model
+        if self._unknown_embeddings is None:
+            self._unknown_embeddings = await asyncio.gather(
+                *[
+                    self.embed(response, model)
+                    for response in self.validator.unknown_response_templates
+                ]
+            )
+        answer_embedding = await self.embed(completion.answer_text, model)
+
+        if self.validator.use_reranking:
+            matched_documents = completion.matched_documents
+            matched_documents[
+                "similarity_to_answer"
+            ] = matched_documents.embedding.apply(
+                lambda x: cosine_similarity(x, answer_embedding)
+            )
+            completion.matched_documents = matched_documents.sort_values(
+                by="similarity_to_answer", ascending=False
+            )
+
+        completion._answer_relevant = not any(
+            cosine_similarity(answer_embedding, unknown_embedding)
+            > self.validator.unknown_threshold
+            for unknown_embedding in self._unknown_embeddings
+        )
+
+    async def gate(
+        self,
+        completion: AsyncCompletion,
+        answer_stream: AsyncIterator[str],
+        validation: asyncio.Task,
+    ) -> AsyncIterator[str]:
+        """Stream the answer once the question is validated, or the validator's message if it isn't."""
+        first_token = asyncio.ensure_future(answer_stream.__anext__())
+        try:
+            question_relevant, irrelevant_question_message = await validation
+            if not question_relevant:
+                logger.info("Question is irrelevant, dropping the speculative answer.")
+                completion._question_relevant = False
+                completion.error = False
+                completion.matched_documents = pd.DataFrame()
+                yield irrelevant_question_message
+                return
+
+            try:
+                yield await first_token
+            except StopAsyncIteration:
+                return
+            async for token in answer_stream:
+                yield token
+        finally:
+            validation.cancel()
+            first_token.cancel()
+            with contextlib.suppress(BaseException):
+                await first_token
+            await answer_stream.aclose()
+
+    async def process_input(
+        self,
+        user_input: str,
+        sources: Optional[list[str]] = None,
+        top_k: Optional[int] = None,
+    ) -> AsyncCompletion:
+        """Returns the completion as soon as the answer starts streaming, see SpeculativeBuster."""
+        logger.info(f"User Input:\n{user_input}")
+        if not user_input.endswith("\n"):
+            user_input += "\n"
+
+        request_trace = Trace("chat")
+        with request_trace.activate():
+            validation = asyncio.create_task(self.check_question_relevance(user_input))
+            try:
+                completion = await self._answer(user_input, validation, sources, top_k)
+            except BaseException:
+                validation.cancel()
+                raise
+
+        # The trace is finished once the answer is fully streamed and postprocessed
+        postprocess = completion._apostprocess
+
+        async def postprocess_and_finish(completion: AsyncCompletion):
+            if postprocess is not None:
+                with request_trace.activate(), span("postprocess"):
+                    await postprocess(completion)
+            request_trace.finish()
+
+        completion._apostprocess = postprocess_and_finish
+        return completion
+
+    async def _answer(
+        self,
+        user_input: str,
+        validation: asyncio.Task,
+        sources: Optional[list[str]],
+        top_k: Optional[int],
+    ) -> AsyncCompletion:
+        embedding = await self.embed_question(user_input)
+
+        answer_cache = None
+        context = (tuple(sorted(sources)) if sources else None, top_k)
+        if isinstance(self.buster, CachedBuster):
+            self.buster._check_version()
+            answer_cache = self.buster.answer_cache
+            answer = answer_cache.get(embedding, context=context)
+            if answer is not None:
+                validation.cancel()
+                return AsyncCompletion(
+                    user_input=user_input,
+                    matched_documents=answer.matched_documents.copy(),
+                    answer_stream=_replay(
+                        re.findall(r"\s*\S+|\s+", answer.answer_text)
+                    ),
+                    question_relevant=answer.question_relevant,
+                    answer_relevant=answer.answer_relevant,
+                )
+
+        matched_documents = await self.retrieve(
+            user_input, embedding, sources=sources, top_k=top_k
+        )
+
+        async def postprocess(completion: AsyncCompletion):
+            await self.postprocess(completion)
+            if answer_cache is not None and is_cacheable(
+                completion, self.document_answerer.no_documents_message
+            ):
+                answer_cache.put(
+                    embedding,
+                    CachedAnswer(
+                        answer_text=completion.answer_text,
+                        matched_documents=completion.matched_documents.copy(),
+                        answer_relevant=completion.answer_relevant,
+                        question_relevant=completion.question_relevant,
+                        context=context,
+                    ),
+                )
+
+        error = False
+        if len(matched_documents) == 0:
+            logger.warning("No documents found during retrieval.")
+            answer_stream = _replay([self.document_answerer.no_documents_message])
+        else:
+            prompt = self.document_answerer.prepare_prompt(matched_documents)
+            try:
+                answer_stream = await self.complete(prompt, user_input)
+            except openai.error.OpenAIError:
+                logger.exception("Error when requesting the answer. See traceback:")
+                error = True
+                answer_stream = _replay(
+                    ["Something went wrong with the request, try again soon!"]
+                )
+
+        completion = AsyncCompletion(
+            user_input=user_input,
+            matched_documents=matched_documents,
+            answer_stream=answer_stream,
+            postprocess=postprocess,
+            error=error,
+            completion_kwargs=self.document_answerer.completer.completion_kwargs,
+        )
+        completion._answer_stream = self.gate(completion, answer_stream, validation)
+        return completion
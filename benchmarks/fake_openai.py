@@ -0,0 +1,180 @@
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+from aiohttp import web
+
+ANSWER = (
+    "To install the library, run pip install orion. Then create an experiment with build_experiment, "
+    "and call ExperimentClient.suggest to get new trials to evaluate."
+)
+
+
+class FakeOpenAI:
+    """Local stand-in for the OpenAI embedding and chat completion endpoints, with configurable latencies.
+
+    Embeddings are deterministic bag-of-words vectors, so texts sharing words are similar and retrieval
+    results are meaningful. Like ada-002's, they share a common component: unrelated texts still have a
+    similarity of about baseline_similarity, so the usual retrieval thresholds apply. Chat completions answer 'true' to non-streaming requests (question validation)
+    and stream a fixed answer otherwise.
+    """
+
+    def __init__(
+        self,
+        embedding_dim: int = 1536,
+        embedding_latency: float = 0.05,
+        embedding_latency_per_input: float = 0.0005,
+        completion_latency: float = 0.3,
+        first_token_latency: float = 0.3,
+        token_latency: float = 0.01,
+        tokens_per_minute: int = 1_000_000,
+        requests_per_minute: int = 3_000,
+        baseline_similarity: float = 0.7,
+    ):
+        self.embedding_dim = embedding_dim
+        self.embedding_latency = embedding_latency
+        self.embedding_latency_per_input = embedding_latency_per_input
+        self.completion_latency = completion_latency
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.baseline_similarity = baseline_similarity
+        self.requests = {"embeddings": 0, "embedded_inputs": 0, "chat": 0}
+
+        self._word_vectors = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional[web.AppRunner] = None
+        self.base_url: Optional[str] = None
+
+    def _word_vector(self, word: str) -> np.ndarray:
+        vector = self._word_vectors.get(word)
+        if vector is None:
+            seed = int.from_bytes(hashlib.sha256(word.encode()).digest()[:8], "little")
+            vector = np.random.default_rng(seed).standard_normal(self.embedding_dim)
+            self._word_vectors[word] = vector
+        return vector
+
+    def embed(self, text: str) -> list[float]:
+        words = np.zeros(self.embedding_dim)
+        for word in re.findall(r"\w+", text.lower()):
+            words += self._word_vector(word)
+        norm = np.linalg.norm(words)
+        if norm > 0:
+            words /= norm
+
+        common = self._word_vector("")
+        common = common / np.linalg.norm(common)
+        vector = np.sqrt(self.baseline_similarity) * common
+        vector += np.sqrt(1 - self.baseline_similarity) * words
+        vector /= np.linalg.norm(vector)
+        return vector.astype(np.float32).tolist()
+
+    def _rate_limit_headers(self) -> dict:
+        return {
+            "x-ratelimit-limit-tokens": str(self.tokens_per_minute),
+            "x-ratelimit-remaining-tokens": str(self.tokens_per_minute),
+            "x-ratelimit-limit-requests": str(self.requests_per_minute),
+            "x-ratelimit-remaining-requests": str(self.requests_per_minute),
+        }
+
+    async def _embeddings(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        inputs = body["input"]
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        self.requests["embeddings"] += 1
+        self.requests["embedded_inputs"] += len(inputs)
+
+        await asyncio.sleep(
+            self.embedding_latency + self.embedding_latency_per_input * len(inputs)
+        )
+        data = [
+            {"object": "embedding", "index": i, "embedding": self.embed(text)}
+            for i, text in enumerate(inputs)
+        ]
+        return web.json_response(
+            {"object": "list", "data": data, "model": body.get("model")},
+            headers=self._rate_limit_headers(),
+        )
+
+    async def _chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests["chat"] += 1
+
+        if not body.get("stream"):
+            # Question validation
+            await asyncio.sleep(self.completion_latency)
+            return web.json_response(
+                {
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": "true"},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                },
+                headers=self._rate_limit_headers(),
+            )
+
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream", **self._rate_limit_headers()}
+        )
+        await response.prepare(request)
+        await asyncio.sleep(self.first_token_latency)
+        try:
+            for token in re.findall(r"\s*\S+", ANSWER):
+                chunk = {
+                    "object": "chat.completion.chunk",
+                    "choices": [{"index": 0, "delta": {"content": token}}],
+                }
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                await asyncio.sleep(self.token_latency)
+            await response.write(b"data: [DONE]\n\n")
+        except ConnectionResetError:
+            # The client stopped reading the stream
+            pass
+        return response
+
+    def start(self, port: int = 0) -> str:
+        """Start serving from a background thread, returns the api base url (to set as openai.api_base)."""
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            app = web.Application(client_max_size=1024**3)
+            app.router.add_post("/v1/embeddings", self._embeddings)
+            # openai.embeddings_utils.get_embedding (used by buster's validator) passes engine=
+            app.router.add_post("/v1/engines/{engine}/embeddings", self._embeddings)
+            app.router.add_post("/v1/chat/completions", self._chat_completions)
+            self._runner = web.AppRunner(app, access_log=None)
+            self._loop.run_until_complete(self._runner.setup())
+            site = web.TCPSite(self._runner, "127.0.0.1", port)
+            self._loop.run_until_complete(site.start())
+            host, bound_port = site._server.sockets[0].getsockname()[:2]
+            self.base_url = f"http://{host}:{bound_port}/v1"
+            started.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        started.wait()
+        return self.base_url
+
+    def stop(self):
+        if self._loop is None:
+            return
+
+        async def cleanup():
+            await self._runner.cleanup()
+
+        asyncio.run_coroutine_threadsafe(cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
@@ -0,0 +1,340 @@
+"""End-to-end benchmark of the crawl, parse, embed, retrieval and chat stages, fully offline.
+
+A synthetic Sphinx site is served locally to DocsSpider and OpenAI is replaced by benchmarks.fake_openai, so runs
+are deterministic and only measure our own code (plus the configured fake latencies).
+
+    python -m benchmarks.run --save-baseline benchmarks/baseline.json
+    python -m benchmarks.run --baseline benchmarks/baseline.json  # exits with 1 on regressions
+"""
+import argparse
+import dataclasses
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from functools import partial
+
+import numpy as np
+import openai
+
+from benchmarks.fake_openai import FakeOpenAI
+from benchmarks.sphinx_site import generate_site, serve
+
+logger = logging.getLogger(__name__)
+
+# Metrics reported by the benchmark, and whether higher values are better
+METRICS = {
+    "crawl_pages_per_sec": True,
+    "parse_chunks_per_sec": True,
+    "embed_chunks_per_sec": True,
+    "lexical_index_sec": False,
+    "chat_ttft_p50_ms": False,
+    "chat_ttft_p95_ms": False,
+    "chat_total_p50_ms": False,
+}
+for _backend in ["deeplake", "ann", "hybrid"]:
+    for _p in [50, 95, 99]:
+        METRICS[f"retrieval_{_backend}_p{_p}_ms"] = False
+
+QUESTIONS = [
+    "How do I install the library?",
+    "How can I use ExperimentClient.suggest?",
+    "What does max_trials do in build_experiment?",
+    "Which database storage is supported for parallel workers?",
+    "How do I configure the search space of an experiment?",
+    "What is the working_dir argument?",
+    "How do I run bayesian optimization from the command line interface?",
+    "How are results and metrics of a trial stored?",
+]
+
+
+def percentiles(values: list[float], prefix: str) -> dict[str, float]:
+    return {
+        f"{prefix}_p{p}_ms": float(np.percentile(values, p) * 1000)
+        for p in [50, 95, 99]
+    }
+
+
+def bench_crawl(
+    homepage_url: str,
+    save_directory: str,
+    seed_from_index: bool = True,
+    output_format: str = "files",
+) -> dict:
+    from rtd_scraper.scrape_rtd import run_spider
+
+    start = time.perf_counter()
+    pages = []
+    run_spider(
+        homepage_url,
+        save_directory=save_directory,
+        on_page=pages.append,
+        seed_from_index=seed_from_index,
+        output_format=output_format,
+    )
+    elapsed = time.perf_counter() - start
+    logger.info(f"Crawled {len(pages)} pages in {elapsed:.2f}s")
+    return {"crawl_pages": len(pages), "crawl_pages_per_sec": len(pages) / elapsed}
+
+
+def bench_parse(
+    homepage_url: str, save_directory: str, output_format="files", num_workers=None
+):
+    from buster.parser import SphinxParser
+
+    from embed_docs import (
+        CHUNKING_CFG,
+        get_archive_path_for,
+        get_root_dir,
+        prepare_chunks,
+    )
+    from parsing import get_all_documents_parallel
+
+    start = time.perf_counter()
+    df = get_all_documents_parallel(
+        root_dir=get_root_dir(homepage_url, save_directory),
+        base_url=homepage_url,
+        parser_cls=SphinxParser,
+        num_workers=num_workers,
+        archive_path=get_archive_path_for(save_directory, output_format),
+        **CHUNKING_CFG,
+    )
+    df = prepare_chunks(df)
+    elapsed = time.perf_counter() - start
+    logger.info(f"Parsed {len(df)} chunks in {elapsed:.2f}s")
+    return df, {"chunks": len(df), "parse_chunks_per_sec": len(df) / elapsed}
+
+
+def bench_embed(df, vector_store_path: str) -> dict:
+    from buster.documents_manager.base import get_embedding_openai
+    from buster.tokenizers import GPTTokenizer
+
+    from documents_manager import IncrementalDeepLakeDocumentsManager
+    from embed_docs import EMBEDDING_MODEL, EMBEDDING_RATE_LIMITS
+    from embedding_scheduler import EmbeddingScheduler
+    from retrievers import build_lexical_index
+
+    start = time.perf_counter()
+    dm = IncrementalDeepLakeDocumentsManager(
+        vector_store_path=vector_store_path,
+        overwrite=True,
+        required_columns=["url", "content", "source", "title"],
+        embedding_scheduler=EmbeddingScheduler(
+            embedding_model=EMBEDDING_MODEL,
+            tokenizer=GPTTokenizer(EMBEDDING_MODEL),
+            **EMBEDDING_RATE_LIMITS,
+        ),
+    )
+    dm.batch_add(
+        df=df,
+        batch_size=3000,
+        min_time_interval=0,
+        num_workers=32,
+        embedding_fn=partial(get_embedding_openai, model=EMBEDDING_MODEL),
+    )
+    elapsed = time.perf_counter() - start
+    logger.info(f"Embedded {len(df)} chunks in {elapsed:.2f}s")
+
+    start = time.perf_counter()
+    build_lexical_index(vector_store_path)
+    lexical_elapsed = time.perf_counter() - start
+    return {
+        "embed_chunks_per_sec": len(df) / elapsed,
+        "lexical_index_sec": lexical_elapsed,
+    }
+
+
+def bench_retrieval(retriever_cfg: dict, n_queries: int) -> dict:
+    """Latency of each retriever backend, from precomputed question embeddings."""
+    from buster.documents_manager.base import get_embedding_openai
+
+    from retrievers import get_retriever
+
+    embeddings = [
+        np.array(get_embedding_openai(q, model=retriever_cfg["embedding_model"]))
+        for q in QUESTIONS
+    ]
+    results = {}
+    for backend in ["deeplake", "ann", "hybrid"]:
+        cfg = {**retriever_cfg, "backend": backend, "cache": None}
+        retriever = get_retriever(**cfg)
+        latencies = []
+        for i in range(n_queries):
+            query, embedding = (
+                QUESTIONS[i % len(QUESTIONS)],
+                embeddings[i % len(QUESTIONS)],
+            )
+            start = time.perf_counter()
+            matched_documents = retriever.get_topk_documents(
+                query=query, embedding=embedding, sources=None, top_k=cfg["top_k"]
+            )
+            retriever.threshold_documents(matched_documents, cfg["thresh"])
+            latencies.append(time.perf_counter() - start)
+        results.update(percentiles(latencies, f"retrieval_{backend}"))
+        logger.info(
+            f"Retrieval {backend}: p50={results[f'retrieval_{backend}_p50_ms']:.2f}ms"
+        )
+    return results
+
+
+def bench_chat(buster_cfg, n_questions: int, speculative: bool) -> dict:
+    """Time to first token and total time of answers, without the answer cache."""
+    from cfg import setup_buster
+
+    buster = setup_buster(buster_cfg, answer_cache_cfg=None, speculative=speculative)
+    ttfts, totals = [], []
+    for i in range(n_questions):
+        start = time.perf_counter()
+        completion = buster.process_input(QUESTIONS[i % len(QUESTIONS)])
+        ttft = None
+        for _ in completion.answer_generator:
+            if ttft is None:
+                ttft = time.perf_counter() - start
+        totals.append(time.perf_counter() - start)
+        ttfts.append(ttft if ttft is not None else totals[-1])
+
+    results = {
+        "chat_ttft_p50_ms": float(np.percentile(ttfts, 50) * 1000),
+        "chat_ttft_p95_ms": float(np.percentile(ttfts, 95) * 1000),
+        "chat_total_p50_ms": float(np.percentile(totals, 50) * 1000),
+    }
+    logger.info(f"Chat: ttft p50={results['chat_ttft_p50_ms']:.0f}ms")
+    return results
+
+
+def run(args) -> dict:
+    import cfg
+
+    fake_openai = FakeOpenAI(
+        embedding_latency=args.embedding_latency,
+        completion_latency=args.completion_latency,
+        first_token_latency=args.first_token_latency,
+        token_latency=args.token_latency,
+    )
+    openai.api_base = fake_openai.start()
+    openai.api_key = "sk-benchmark"
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="buster-benchmark-")
+    site_dir = os.path.join(workdir, "site")
+    save_directory = os.path.join(workdir, "outputs")
+    homepage = generate_site(
+        site_dir,
+        n_pages=args.pages,
+        sections_per_page=args.sections_per_page,
+        words_per_section=args.words_per_section,
+    )
+    server, base_url = serve(site_dir, latency=args.site_latency)
+    homepage_url = base_url + homepage
+
+    results = {}
+    try:
+        results.update(
+            bench_crawl(
+                homepage_url,
+                save_directory,
+                seed_from_index=not args.follow_links,
+                output_format=args.output_format,
+            )
+        )
+        df, parse_results = bench_parse(
+            homepage_url, save_directory, output_format=args.output_format
+        )
+        results.update(parse_results)
+
+        vector_store_path = os.path.join(save_directory, "deeplake_store")
+        results.update(bench_embed(df, vector_store_path))
+
+        retriever_cfg = {**cfg.buster_cfg.retriever_cfg, "path": vector_store_path}
+        results.update(bench_retrieval(retriever_cfg, args.queries))
+
+        buster_cfg = dataclasses.replace(cfg.buster_cfg, retriever_cfg=retriever_cfg)
+        results.update(
+            bench_chat(buster_cfg, args.questions, cfg.speculative_validation)
+        )
+    finally:
+        server.shutdown()
+        fake_openai.stop()
+
+    results["openai_requests"] = dict(fake_openai.requests)
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Metrics worse than the baseline by more than tolerance (relative)."""
+    regressions = []
+    for name, higher_is_better in METRICS.items():
+        if name not in results or not baseline.get(name):
+            continue
+        change = (results[name] - baseline[name]) / baseline[name]
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(
+                f"{name}: {results[name]:.2f} vs {baseline[name]:.2f} baseline ({change:+.0%})"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--sections-per-page", type=int, default=5)
+    parser.add_argument("--words-per-section", type=int, default=150)
+    parser.add_argument(
+        "--site-latency",
+        type=float,
+        default=0.05,
+        help="Delay of the docs site's responses",
+    )
+    parser.add_argument(
+        "--follow-links",
+        action="store_true",
+        help="Crawl by following links instead of from the site's objects.inv",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=["files", "archive"],
+        default="files",
+        help="Save the crawled pages as files or in a single archive",
+    )
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--questions", type=int, default=20)
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--completion-latency", type=float, default=0.3)
+    parser.add_argument("--first-token-latency", type=float, default=0.3)
+    parser.add_argument("--token-latency", type=float, default=0.01)
+    parser.add_argument(
+        "--workdir", help="Where to write the site and the outputs (temporary dir)"
+    )
+    parser.add_argument("--output", help="Write the results to this json file")
+    parser.add_argument("--save-baseline", help="Save the results as a baseline")
+    parser.add_argument("--baseline", help="Compare the results against a baseline")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative slowdown tolerated before a metric is reported as a regression",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    results = run(args)
+    print(json.dumps(results, indent=2))
+
+    for path in [args.output, args.save_baseline]:
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions against the baseline:\n" + "\n".join(regressions))
+            sys.exit(1)
+        print("No regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
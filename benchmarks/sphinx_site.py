@@ -0,0 +1,134 @@
+import os
+import random
+import threading
+import time
+import zlib
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+# Vocabulary of the generated pages, with a few API identifiers to exercise lexical retrieval
+WORDS = (
+    "experiment trial optimization algorithm search space configuration storage database worker "
+    "parallel random grid bayesian hyperparameter objective result metric install library python "
+    "package command line interface client server version dependency module function argument value"
+).split()
+IDENTIFIERS = [
+    "ExperimentClient.suggest",
+    "ExperimentClient.observe",
+    "build_experiment",
+    "max_trials",
+    "working_dir",
+    "orion.core.cli",
+]
+
+
+def page_html(title: str, sections: list[tuple[str, str]], links: list[str]) -> str:
+    """A page with Sphinx's markup, as parsed by buster's SphinxParser."""
+    body = "".join(
+        f'<section id="s{i}"><h2>{name}<a class="headerlink" href="#s{i}">¶</a></h2><p>{text}</p></section>'
+        for i, (name, text) in enumerate(sections)
+    )
+    nav = "".join(f'<li><a href="{link}">{link}</a></li>' for link in links)
+    # Like Sphinx, every page also links to the search, the index and its own source
+    nav += '<a href="search.html">Search</a><a href="genindex.html">Index</a>'
+    nav += (
+        f'<a href="_sources/{title.lower().replace(" ", "")}.rst.txt">Show Source</a>'
+    )
+    return (
+        f"<html><head><title>{title}</title></head><body>"
+        f'<div class="sphinxsidebar"><ul>{nav}</ul></div>'
+        f'<div class="body"><section id="top"><h1>{title}<a class="headerlink" href="#top">¶</a></h1>'
+        f"{body}</section></div></body></html>"
+    )
+
+
+def generate_site(
+    directory: str,
+    n_pages: int = 100,
+    sections_per_page: int = 5,
+    words_per_section: int = 150,
+    version: str = "en/latest",
+    seed: int = 0,
+    inventory: bool = True,
+) -> str:
+    """Write a synthetic Sphinx site to directory/version/, returns the path of its homepage relative to the root.
+
+    With inventory=True, the site has an objects.inv listing its pages, like Sphinx writes.
+    """
+    rng = random.Random(seed)
+    version_dir = os.path.join(directory, version)
+    os.makedirs(version_dir, exist_ok=True)
+
+    pages = ["index.html"] + [f"page{i}.html" for i in range(1, n_pages)]
+    for page_idx, page in enumerate(pages):
+        sections = []
+        for section_idx in range(sections_per_page):
+            words = rng.choices(WORDS, k=words_per_section)
+            words[rng.randrange(len(words))] = rng.choice(IDENTIFIERS)
+            sections.append((f"Section {page_idx}.{section_idx}", " ".join(words)))
+
+        # Every page links to its neighbours and to a few random pages, like a sidebar would
+        links = {pages[(page_idx + 1) % len(pages)], pages[page_idx - 1]}
+        links.update(rng.sample(pages, k=min(5, len(pages))))
+        html = page_html(f"Page {page_idx}", sections, sorted(links))
+        with open(os.path.join(version_dir, page), "w") as f:
+            f.write(html)
+
+    # Non-content pages, which the spider shouldn't bother crawling
+    for page in ["search.html", "genindex.html"]:
+        with open(os.path.join(version_dir, page), "w") as f:
+            f.write(page_html(page, [], pages))
+    os.makedirs(os.path.join(version_dir, "_sources"), exist_ok=True)
+    for page_idx in range(n_pages):
+        with open(
+            os.path.join(version_dir, "_sources", f"page{page_idx}.rst.txt"), "w"
+        ) as f:
+            f.write(f"Page {page_idx}\n=======\n")
+
+    if inventory:
+        entries = "".join(
+            f"{page[:-len('.html')]} std:doc -1 {page} Page {page_idx}\n"
+            for page_idx, page in enumerate(pages)
+        )
+        with open(os.path.join(version_dir, "objects.inv"), "wb") as f:
+            f.write(
+                b"# Sphinx inventory version 2\n# Project: benchmark\n# Version: \n"
+                b"# The remainder of this file is compressed using zlib.\n"
+            )
+            f.write(zlib.compress(entries.encode()))
+
+    return f"{version}/"
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    latency = 0.0
+
+    def send_head(self):
+        time.sleep(self.latency)
+        return super().send_head()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    # The default backlog of 5 drops connections when crawling concurrently
+    request_queue_size = 128
+
+
+def serve(
+    directory: str, port: int = 0, latency: float = 0.0
+) -> tuple[ThreadingHTTPServer, str]:
+    """Serve a directory over http from a background thread, returns the server and its base url.
+
+    Pages are served with a Last-Modified header and answer conditional requests with 304s, like readthedocs.
+    Each response is delayed by latency seconds, to simulate a remote server.
+    """
+    handler = partial(
+        type("Handler", (_QuietHandler,), {"latency": latency}), directory=directory
+    )
+    server = _Server(("127.0.0.1", port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+    return server, f"http://{host}:{port}/"
@@ -0,0 +1,164 @@
+import logging
+import re
+from collections import Counter
+from typing import Iterable
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Words, identifiers and dotted paths e.g. ExperimentClient.suggest, max_trials, v0.2.7
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9_]+(?:\.[A-Za-z0-9_]+)*")
+CAMEL_CASE_PATTERN = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+
+
+def identifiers(text: str) -> list[str]:
+    """Code-like tokens of a text (dotted, snake_case or CamelCase), as written."""
+    return [
+        token
+        for token in TOKEN_PATTERN.findall(text)
+        if "." in token.strip(".")
+        or "_" in token.strip("_")
+        or re.search(r"[a-z][A-Z]", token)
+    ]
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercased terms of a text, identifiers also yield their parts.
+
+    e.g. 'ExperimentClient.suggest' -> experimentclient.suggest, experimentclient, suggest, experiment, client
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(text):
+        terms.append(token.lower())
+        parts = re.split(r"[._]+", token)
+        if len(parts) > 1:
+            terms.extend(part.lower() for part in parts if part)
+        for part in parts:
+            subwords = CAMEL_CASE_PATTERN.findall(part)
+            if len(subwords) > 1:
+                terms.extend(subword.lower() for subword in subwords)
+    return terms
+
+
+class BM25Index:
+    """Okapi BM25 inverted index over a set of documents, in NumPy.
+
+    Postings are stored as CSR arrays: the documents containing term i are doc_ids[offsets[i]:offsets[i + 1]],
+    with their term frequencies in term_freqs.
+    """
+
+    def __init__(
+        self,
+        vocabulary: dict[str, int],
+        offsets: np.ndarray,
+        doc_ids: np.ndarray,
+        term_freqs: np.ndarray,
+        doc_lengths: np.ndarray,
+        k1: float = 1.5,
+        b: float = 0.75,
+    ):
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+
+        n_docs = len(doc_lengths)
+        doc_freqs = np.diff(offsets)
+        self.idf = np.log(1 + (n_docs - doc_freqs + 0.5) / (doc_freqs + 0.5))
+        self.avg_doc_length = doc_lengths.mean() if n_docs > 0 else 0.0
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    @classmethod
+    def build(cls, texts: Iterable[str], **kwargs) -> "BM25Index":
+        vocabulary = {}
+        postings = []  # (term, doc, freq)
+        doc_lengths = []
+        for doc_id, text in enumerate(texts):
+            terms = tokenize(text)
+            doc_lengths.append(len(terms))
+            for term, freq in Counter(terms).items():
+                term_id = vocabulary.setdefault(term, len(vocabulary))
+                postings.append((term_id, doc_id, freq))
+
+        postings = np.array(postings, dtype=np.int64).reshape(-1, 3)
+        postings = postings[np.argsort(postings[:, 0], kind="stable")]
+        counts = np.bincount(postings[:, 0], minlength=len(vocabulary))
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        logger.info(
+            f"Built BM25 index of {len(doc_lengths)} documents, {len(vocabulary)} terms"
+        )
+        return cls(
+            vocabulary,
+            offsets,
+            postings[:, 1].astype(np.int32),
+            postings[:, 2].astype(np.float32),
+            np.array(doc_lengths, dtype=np.float32),
+            **kwargs,
+        )
+
+    def scores(self, query: str) -> np.ndarray:
+        """BM25 score of every document for the query."""
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = self.doc_ids[start:end]
+            freqs = self.term_freqs[start:end]
+            norm = self.k1 * (
+                1 - self.b + self.b * self.doc_lengths[docs] / self.avg_doc_length
+            )
+            scores[docs] += self.idf[term_id] * freqs * (self.k1 + 1) / (freqs + norm)
+        return scores
+
+    def search(
+        self, query: str, k: int, mask: np.ndarray = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the indices and scores of the top k documents matching the query, best first.
+
+        Documents not in mask (boolean array) are excluded, documents matching none of the terms are never returned.
+        """
+        scores = self.scores(query)
+        if mask is not None:
+            scores[~mask] = 0
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return candidates, scores[candidates]
+
+    def save(self, path: str, **extra):
+        """Save the index to a .npz file, with optional extra arrays."""
+        terms = np.array(sorted(self.vocabulary, key=self.vocabulary.get), dtype=str)
+        np.savez(
+            path,
+            terms=terms,
+            offsets=self.offsets,
+            doc_ids=self.doc_ids,
+            term_freqs=self.term_freqs,
+            doc_lengths=self.doc_lengths,
+            **extra,
+        )
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> tuple["BM25Index", dict]:
+        """Load an index saved with save(), returns it along with the extra arrays."""
+        with np.load(path) as data:
+            arrays = dict(data)
+        vocabulary = {term: i for i, term in enumerate(arrays.pop("terms").tolist())}
+        index = cls(
+            vocabulary,
+            arrays.pop("offsets"),
+            arrays.pop("doc_ids"),
+            arrays.pop("term_freqs"),
+            arrays.pop("doc_lengths"),
+            **kwargs,
+        )
+        return index, arrays
@@ -0,0 +1,383 @@
+import logging
+import os
+import re
+import string
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Hashable, Optional
+
+import numpy as np
+import pandas as pd
+from buster.busterbot import Buster
+from buster.completers import Completion
+from buster.retriever import Retriever
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_question(question: str) -> str:
+    """Normalize a question so that trivial variations (case, spacing, trailing punctuation) share a cache entry."""
+    question = re.sub(r"\s+", " ", question.lower())
+    return question.strip().rstrip(string.punctuation + " ")
+
+
+def file_version(path: str) -> Optional[int]:
+    """Modification time of a file, None if it doesn't exist."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class LRUCache:
+    """Thread-safe mapping holding at most max_size entries, evicting the least recently used ones.
+
+    Entries older than ttl seconds are expired (ttl=None to never expire).
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (insertion time, value)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            inserted_at, value = entry
+            if self.ttl is not None and time.monotonic() - inserted_at > self.ttl:
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class CachedRetriever(Retriever):
+    """Wraps a retriever to cache question embeddings and retrieved documents by normalized question.
+
+    A repeated question skips both the embedding request and the search. Caches are cleared whenever the
+    file at version_path (the store's manifest) changes, i.e. when the store gets rebuilt.
+    """
+
+    # The question's text is the cache key, it is needed even when its embedding is known
+    uses_query_text = True
+
+    def __init__(
+        self,
+        retriever: Retriever,
+        max_size: int = 1024,
+        ttl: Optional[float] = 3600,
+        version_path: Optional[str] = None,
+    ):
+        super().__init__(
+            top_k=retriever.top_k,
+            thresh=retriever.thresh,
+            embedding_model=retriever.embedding_model,
+        )
+        self.retriever = retriever
+        self.version_path = version_path
+        self.embeddings = LRUCache(max_size=max_size, ttl=ttl)
+        self.documents = LRUCache(max_size=max_size, ttl=ttl)
+        self._version = self._current_version()
+
+    def _current_version(self) -> Optional[int]:
+        if self.version_path is None:
+            return None
+        return file_version(self.version_path)
+
+    def _check_version(self):
+        version = self._current_version()
+        if version != self._version:
+            logger.info("Vector store changed, clearing the retrieval caches.")
+            self.embeddings.clear()
+            self.documents.clear()
+            self._version = version
+
+    def get_documents(self, sources: Optional[list[str]] = None) -> pd.DataFrame:
+        return self.retriever.get_documents(sources)
+
+    def get_source_display_name(self, source: str) -> str:
+        return self.retriever.get_source_display_name(source)
+
+    def threshold_documents(self, matched_documents, thresh: float) -> pd.DataFrame:
+        return self.retriever.threshold_documents(matched_documents, thresh)
+
+    def get_query_embedding(self, query: str) -> np.ndarray:
+        """Embedding of a question, computed once per normalized question."""
+        key = normalize_question(query)
+        embedding = self.embeddings.get(key)
+        if embedding is None:
+            embedding = self.get_embedding(query, model=self.embedding_model)
+            if embedding is not None:
+                self.embeddings.put(key, embedding)
+        return embedding
+
+    def get_topk_documents(
+        self,
+        query: str = None,
+        embedding: np.ndarray = None,
+        sources: Optional[list[str]] = None,
+        top_k: int = None,
+    ) -> pd.DataFrame:
+        if query is None:
+            return self.retriever.get_topk_documents(
+                embedding=embedding, sources=sources, top_k=top_k
+            )
+
+        self._check_version()
+        key = (
+            normalize_question(query),
+            tuple(sorted(sources)) if sources else None,
+            top_k,
+        )
+        matched_documents = self.documents.get(key)
+        if matched_documents is None:
+            # Retrievers matching the text (e.g. HybridRetriever) get it along with the cached embedding
+            text_kwargs = (
+                {"query": query}
+                if getattr(self.retriever, "uses_query_text", False)
+                else {}
+            )
+            if embedding is None:
+                embedding = self.get_query_embedding(query)
+            matched_documents = self.retriever.get_topk_documents(
+                embedding=embedding,
+                sources=sources,
+                top_k=top_k,
+                **text_kwargs,
+            )
+            self.documents.put(key, matched_documents)
+        else:
+            logger.info("Retrieved documents from cache.")
+
+        # Callers modify the matched documents (e.g. the validator adds columns), never hand out the cached one
+        return matched_documents.copy()
+
+
+def is_cacheable(completion: Completion, no_documents_message: str) -> bool:
+    """Only answers of the completer to relevant questions are cached, not errors or the fallback messages."""
+    return (
+        not completion.error
+        and completion.question_relevant
+        and completion.answer_text != no_documents_message
+    )
+
+
+@dataclass
+class CachedAnswer:
+    answer_text: str
+    matched_documents: pd.DataFrame
+    answer_relevant: bool
+    question_relevant: bool
+    # Answers are only reused for the same sources and top_k
+    context: Hashable = None
+
+
+class SemanticAnswerCache:
+    """Answers indexed by the embedding of their question.
+
+    A question matches a cached answer if their cosine similarity is at least threshold. Holds at most max_size
+    answers, evicting the least recently used ones, and answers older than ttl seconds are expired.
+    """
+
+    def __init__(
+        self, threshold: float = 0.97, max_size: int = 512, ttl: Optional[float] = 3600
+    ):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self._embeddings = np.zeros((0, 0), dtype=np.float32)
+        self._answers: list[CachedAnswer] = []
+        self._inserted_at = np.zeros(0)
+        self._used_at = np.zeros(0)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._answers)
+
+    def _remove(self, mask: np.ndarray):
+        keep = ~mask
+        self._embeddings = self._embeddings[keep]
+        self._answers = [answer for answer, k in zip(self._answers, keep) if k]
+        self._inserted_at = self._inserted_at[keep]
+        self._used_at = self._used_at[keep]
+
+    def _expire(self, now: float):
+        if self.ttl is not None and len(self._answers) > 0:
+            expired = now - self._inserted_at > self.ttl
+            if expired.any():
+                self._remove(expired)
+
+    def get(self, embedding: np.ndarray, context: Hashable = None):
+        """Most similar cached answer to a question embedding, None if there are none above the threshold."""
+        embedding = np.asarray(embedding, dtype=np.float32)
+        embedding = embedding / max(np.linalg.norm(embedding), 1e-12)
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            if len(self._answers) == 0:
+                return None
+
+            similarities = self._embeddings @ embedding
+            same_context = np.array([a.context == context for a in self._answers])
+            similarities[~same_context] = -np.inf
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None
+
+            self._used_at[best] = now
+            logger.info(f"Answer cache hit, similarity={similarities[best]:.3f}")
+            return self._answers[best]
+
+    def put(self, embedding: np.ndarray, answer: CachedAnswer):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        embedding = embedding / max(np.linalg.norm(embedding), 1e-12)
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            if len(self._answers) >= self.max_size:
+                lru = np.zeros(len(self._answers), dtype=bool)
+                lru[np.argmin(self._used_at)] = True
+                self._remove(lru)
+
+            if len(self._answers) == 0:
+                self._embeddings = embedding[None, :]
+            else:
+                self._embeddings = np.vstack([self._embeddings, embedding])
+            self._answers.append(answer)
+            self._inserted_at = np.append(self._inserted_at, now)
+            self._used_at = np.append(self._used_at, now)
+
+    def clear(self):
+        with self._lock:
+            self._embeddings = np.zeros((0, 0), dtype=np.float32)
+            self._answers = []
+            self._inserted_at = np.zeros(0)
+            self._used_at = np.zeros(0)
+
+
+class CachedBuster(Buster):
+    """Buster replaying cached answers to questions close to ones already answered.
+
+    A hit skips the question validation, the retrieval and the completion: the cached answer is streamed back
+    through a regular Completion, along with its matched documents so the sources can still be displayed.
+    The cache is cleared whenever the file at version_path (the store's manifest) changes.
+    """
+
+    def __init__(
+        self,
+        retriever: Retriever,
+        document_answerer,
+        validator,
+        answer_cache: SemanticAnswerCache,
+        version_path: Optional[str] = None,
+        **kwargs,
+    ):
+        super().__init__(
+            retriever=retriever,
+            document_answerer=document_answerer,
+            validator=validator,
+            **kwargs,
+        )
+        self.answer_cache = answer_cache
+        self.version_path = version_path
+        self._version = self._current_version()
+
+    def _current_version(self) -> Optional[int]:
+        if self.version_path is None:
+            return None
+        return file_version(self.version_path)
+
+    def _check_version(self):
+        version = self._current_version()
+        if version != self._version:
+            logger.info("Vector store changed, clearing the answer cache.")
+            self.answer_cache.clear()
+            self._version = version
+
+    def embed_question(self, user_input: str) -> np.ndarray:
+        """Embed the question the same way the retriever does, so the retrieval reuses the embedding."""
+        if isinstance(self.retriever, CachedRetriever):
+            return self.retriever.get_query_embedding(user_input)
+        return self.retriever.get_embedding(
+            user_input, model=self.retriever.embedding_model
+        )
+
+    def replay(self, user_input: str, answer: CachedAnswer) -> Completion:
+        # Stream word by word, like the completer would. There is no validator since the matched documents are
+        # already reranked and the answer relevance known.
+        tokens = re.findall(r"\s*\S+|\s+", answer.answer_text)
+        return Completion(
+            error=False,
+            user_input=user_input,
+            matched_documents=answer.matched_documents.copy(),
+            answer_generator=iter(tokens),
+            answer_relevant=answer.answer_relevant,
+            question_relevant=answer.question_relevant,
+            validator=None,
+        )
+
+    def process_input(
+        self,
+        user_input: str,
+        sources: Optional[list[str]] = None,
+        top_k: Optional[int] = None,
+    ) -> Completion:
+        # Same as Buster.process_input, so the embedding is computed once for both
+        if not user_input.endswith("\n"):
+            user_input += "\n"
+
+        self._check_version()
+        context = (tuple(sorted(sources)) if sources else None, top_k)
+        embedding = self.embed_question(user_input)
+        if embedding is None:
+            return super().process_input(user_input, sources=sources, top_k=top_k)
+
+        answer = self.answer_cache.get(embedding, context=context)
+        if answer is not None:
+            return self.replay(user_input, answer)
+
+        completion = super().process_input(user_input, sources=sources, top_k=top_k)
+
+        # Cache the answer once it is fully generated and validated
+        postprocess = completion.postprocess
+
+        def postprocess_and_cache():
+            postprocess()
+            if not is_cacheable(
+                completion, self.document_answerer.no_documents_message
+            ):
+                return
+            self.answer_cache.put(
+                embedding,
+                CachedAnswer(
+                    answer_text=completion.answer_text,
+                    matched_documents=completion.matched_documents.copy(),
+                    answer_relevant=completion.answer_relevant,
+                    question_relevant=completion.question_relevant,
+                    context=context,
+                ),
+            )
+
+        completion.postprocess = postprocess_and_cache
+        return completion
@@ -1,13 +1,29 @@
 from buster.busterbot import Buster, BusterConfig
 from buster.completers import ChatGPTCompleter, DocumentAnswerer
-from buster.formatters.documents import DocumentsFormatterJSON
 from buster.formatters.prompts import PromptFormatter
-from buster.retriever import DeepLakeRetriever, Retriever
+from buster.retriever import Retriever
 from buster.tokenizers import GPTTokenizer
 from buster.validators import QuestionAnswerValidator, Validator
 
+from caching import CachedBuster, SemanticAnswerCache
+from manifest import get_manifest_path
+from metrics import instrument_buster
+from prompting import TokenBudgetDocumentAnswerer, TokenCountedDocumentsFormatter
+from retrievers import get_retriever
+from speculative import CachedSpeculativeBuster, SpeculativeBuster
+
 buster_cfg = BusterConfig(
     retriever_cfg={
+        # "deeplake" searches the store with DeepLake, "ann" with an in-process approximate nearest neighbor index,
+        # "hybrid" fuses the results of dense_backend with a BM25 index, to also match exact identifiers
+        "backend": "deeplake",
+        "dense_backend": "deeplake",
+        # ANN only: number of index lists scanned per query, higher means better recall but slower
+        "nprobe": 8,
+        # ANN only: "float16" or "int8" (with exact rescoring of the top candidates) to shrink the resident vectors
+        "storage_dtype": "float32",
+        # Cache of question embeddings and retrieved documents, set to None to disable
+        "cache": {"max_size": 1024, "ttl": 3600},
         "path": "outputs/deeplake_store",
         "top_k": 3,
         "thresh": 0.7,
@@ -87,14 +103,31 @@ A user will submit a question. Respond 'true' if it is valid, respond 'false' if
     },
 )
 
+# Answers replayed for questions whose embedding has at least this cosine similarity with an answered one.
+# Set to None to disable
+answer_cache_cfg = {
+    "threshold": 0.97,
+    "max_size": 512,
+    "ttl": 3600,
+}
+
+# Validate questions concurrently with retrieval and answer generation, instead of before them
+speculative_validation = True
+
+# Concurrent requests for the same question share one answer, see singleflight.py
+single_flight = True
 
-def setup_buster(buster_cfg: BusterConfig):
+
+def setup_buster(
+    buster_cfg: BusterConfig, answer_cache_cfg: dict = None, speculative: bool = False
+):
     """initialize buster with a buster_cfg class"""
-    retriever: Retriever = DeepLakeRetriever(**buster_cfg.retriever_cfg)
+    retriever: Retriever = get_retriever(**buster_cfg.retriever_cfg)
     tokenizer = GPTTokenizer(**buster_cfg.tokenizer_cfg)
-    document_answerer: DocumentAnswerer = DocumentAnswerer(
+    # Documents are fit in the prompt from their token counts stored in the vector store, see prompting
+    document_answerer: DocumentAnswerer = TokenBudgetDocumentAnswerer(
         completer=ChatGPTCompleter(**buster_cfg.completion_cfg),
-        documents_formatter=DocumentsFormatterJSON(
+        documents_formatter=TokenCountedDocumentsFormatter(
             tokenizer=tokenizer, **buster_cfg.documents_formatter_cfg
         ),
         prompt_formatter=PromptFormatter(
@@ -103,7 +136,20 @@ def setup_buster(buster_cfg: BusterConfig):
         **buster_cfg.documents_answerer_cfg,
     )
     validator: Validator = QuestionAnswerValidator(**buster_cfg.validator_cfg)
-    buster: Buster = Buster(
+    buster_kwargs = dict(
         retriever=retriever, document_answerer=document_answerer, validator=validator
     )
-    return buster
+    if answer_cache_cfg is not None:
+        # Cached answers are dropped when the store is rebuilt, which rewrites its manifest
+        buster_kwargs.update(
+            answer_cache=SemanticAnswerCache(**answer_cache_cfg),
+            version_path=get_manifest_path(buster_cfg.retriever_cfg["path"]),
+        )
+        buster_cls = CachedSpeculativeBuster if speculative else CachedBuster
+    else:
+        buster_cls = SpeculativeBuster if speculative else Buster
+
+    buster: Buster = buster_cls(**buster_kwargs)
+
+    # Time each stage of the requests, see metrics.Trace
+    return instrument_buster(buster)
@@ -0,0 +1,215 @@
+import hashlib
+import itertools
+import logging
+import re
+import zlib
+from typing import Iterator, Optional
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Chunks whose estimated Jaccard similarity (of their word shingles) is above this are collapsed together
+DEDUP_CFG = {
+    "threshold": 0.85,
+    "num_perm": 128,
+    "bands": 16,
+    "shingle_size": 3,
+}
+
+_WORD = re.compile(r"\w+")
+_SHINGLE_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+def normalize_text(text: str) -> str:
+    """Text compared by the exact stage: case and whitespace are ignored."""
+    return " ".join(text.lower().split())
+
+
+def content_hash(text: str) -> str:
+    return hashlib.blake2b(
+        normalize_text(text).encode("utf-8"), digest_size=16
+    ).hexdigest()
+
+
+class MinHasher:
+    """MinHash signatures of texts, from the hashes of their word shingles, with num_perm hash functions.
+
+    The fraction of equal values in two signatures estimates the Jaccard similarity of the texts' shingles.
+    """
+
+    def __init__(self, num_perm: int = 128, shingle_size: int = 3, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        # Multiply-shift hashing: the high 32 bits of (a * x + b) mod 2**64, cheaper than a modulo by a prime
+        self.a = rng.integers(1, 1 << 64, size=(num_perm, 1), dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 64, size=(num_perm, 1), dtype=np.uint64)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+
+    def words(self, text: str) -> list[str]:
+        words = _WORD.findall(text.lower())
+        # Texts shorter than a shingle are a single (padded) shingle
+        return words + [""] * (self.shingle_size - len(words))
+
+    def shingles(self, words: list[list[str]]) -> tuple[np.ndarray, np.ndarray]:
+        """32 bit hashes of the word shingles of texts (given as their words), and the number of shingles of each."""
+        k = self.shingle_size
+        n_words = np.array([len(w) for w in words])
+        word_hashes = np.fromiter(
+            map(zlib.crc32, map(str.encode, itertools.chain.from_iterable(words))),
+            dtype=np.uint64,
+            count=int(n_words.sum()),
+        )
+
+        # Hash of the k words starting at each position, wrapping around
+        n = len(word_hashes) - k + 1
+        hashes = np.zeros(n, dtype=np.uint64)
+        for j in range(k):
+            hashes = hashes * np.uint64(_SHINGLE_MULTIPLIER) + word_hashes[j : n + j]
+
+        # Only keep the shingles within a text
+        text_starts = np.cumsum(n_words) - n_words
+        position = np.arange(n) - np.repeat(text_starts, n_words)[:n]
+        valid = position <= np.repeat(n_words - k, n_words)[:n]
+        return hashes[valid] >> np.uint64(32), n_words - k + 1
+
+    def block_signatures(self, words: list[list[str]]) -> np.ndarray:
+        shingles, lengths = self.shingles(words)
+        hashed = np.multiply(self.a, shingles)
+        hashed += self.b
+        hashed >>= np.uint64(32)
+        return np.minimum.reduceat(hashed, np.cumsum(lengths) - lengths, axis=1).T
+
+    def signatures(self, texts: list[str], block_size: int = 1 << 16) -> np.ndarray:
+        """(len(texts), num_perm) signatures, hashing about block_size shingles at a time.
+
+        Texts are split into words block by block, so only the signatures are kept for all of them.
+        """
+        signatures = np.empty((len(texts), self.num_perm), dtype=np.uint32)
+        first = 0
+        block: list[list[str]] = []
+        n_shingles = 0
+        for i, text in enumerate(texts):
+            words = self.words(text)
+            block.append(words)
+            n_shingles += len(words) - self.shingle_size + 1
+            if n_shingles >= block_size or i == len(texts) - 1:
+                signatures[first : i + 1] = self.block_signatures(block)
+                first, block, n_shingles = i + 1, [], 0
+        return signatures
+
+
+def candidate_pairs(
+    signatures: np.ndarray, bands: int
+) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """LSH: pairs of rows whose signatures are equal on at least one of bands bands, as (i, j) arrays per band.
+
+    Rows sharing a band are paired with the first of them, rather than with each other.
+    """
+    rows = signatures.shape[1] // bands
+    rng = np.random.default_rng(0)
+    multipliers = rng.integers(1, 1 << 63, size=rows, dtype=np.uint64) | np.uint64(1)
+    for band in range(bands):
+        # Wraps around, collisions are weeded out when comparing the signatures
+        keys = (signatures[:, band * rows : (band + 1) * rows] * multipliers).sum(
+            axis=1, dtype=np.uint64
+        )
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        is_first = np.ones(len(order), dtype=bool)
+        is_first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        firsts = order[is_first][np.cumsum(is_first) - 1]
+        yield firsts[~is_first], order[~is_first]
+
+
+class UnionFind:
+    """Disjoint sets of 0..n-1, each represented by its smallest element."""
+
+    def __init__(self, n: int):
+        self.parent = np.arange(n)
+
+    def find(self, i: int) -> int:
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i: int, j: int):
+        i, j = self.find(i), self.find(j)
+        if i != j:
+            self.parent[max(i, j)] = min(i, j)
+
+    def roots(self) -> np.ndarray:
+        return np.array([self.find(i) for i in range(len(self.parent))], dtype=int)
+
+
+def near_duplicate_groups(
+    texts: list[str],
+    threshold: float = 0.85,
+    num_perm: int = 128,
+    bands: int = 16,
+    shingle_size: int = 3,
+) -> np.ndarray:
+    """For each text, the index of the first text it is a near-duplicate of (itself if none)."""
+    signatures = MinHasher(num_perm, shingle_size).signatures(texts)
+    groups = UnionFind(len(texts))
+    for i, j in candidate_pairs(signatures, bands):
+        similar = (signatures[i] == signatures[j]).mean(axis=1) >= threshold
+        for a, b in zip(i[similar], j[similar]):
+            groups.union(a, b)
+    return groups.roots()
+
+
+def deduplicate(
+    df: pd.DataFrame, target_version: Optional[str] = None, **dedup_cfg
+) -> pd.DataFrame:
+    """Collapse chunks with the same (or nearly the same) content into one of them.
+
+    Exact duplicates (up to case and whitespace) are grouped by hash, then near-duplicates (e.g. the same page in
+    several versions of the docs, navigation text, API signatures repeated on several pages) by MinHash LSH,
+    see DEDUP_CFG. The chunk kept for a group doesn't depend on the crawl order: it is one from a url of
+    target_version if there is one, else the one with the last url in sorted order. It gets a 'urls' column
+    listing the urls of all the chunks it stands for, its own first.
+    """
+    dedup_cfg = {**DEDUP_CFG, **dedup_cfg}
+    df = df.reset_index(drop=True)
+    if len(df) == 0:
+        return df.assign(urls=pd.Series(dtype=object))
+
+    # Exact duplicates: only the first of each is compared to the others
+    exact_codes, _ = pd.factorize(pd.Series([content_hash(c) for c in df.content]))
+    _, unique_positions = np.unique(exact_codes, return_index=True)
+
+    roots = near_duplicate_groups(
+        df.content.iloc[unique_positions].to_list(), **dedup_cfg
+    )
+
+    # Groups are numbered by the position of their first chunk, so they keep the order of the docs
+    ranked = pd.DataFrame(
+        {
+            "group": unique_positions[roots[exact_codes]],
+            "preferred": (
+                df.url.str.contains(target_version, regex=False)
+                if target_version
+                else False
+            ),
+            "url": df.url,
+        }
+    ).sort_values(
+        ["group", "preferred", "url"], ascending=[True, False, False], kind="stable"
+    )
+    representatives = ranked.drop_duplicates("group").index
+    urls = ranked.groupby("group", sort=True).url.agg(lambda u: list(dict.fromkeys(u)))
+
+    deduplicated = df.loc[representatives].reset_index(drop=True)
+    deduplicated["urls"] = urls.to_list()
+
+    n_exact = len(df) - len(unique_positions)
+    n_near = len(unique_positions) - len(deduplicated)
+    logger.info(
+        f"Collapsed {len(df)} chunks into {len(deduplicated)}: "
+        f"{n_exact} exact and {n_near} near duplicates."
+    )
+    return deduplicated
@@ -0,0 +1,142 @@
+import hashlib
+import logging
+from typing import Optional
+
+import pandas as pd
+from buster.documents_manager import DeepLakeDocumentsManager
+from buster.documents_manager.base import (
+    compute_embeddings_parallelized,
+    get_embedding_openai,
+)
+
+from embedding_cache import EmbeddingCache
+from embedding_scheduler import EmbeddingScheduler
+
+logger = logging.getLogger(__name__)
+
+
+def chunk_id(url: str, content: str) -> str:
+    """Stable identifier of a chunk: its url plus a hash of its content."""
+    return hashlib.sha256(f"{url}\n{content}".encode("utf-8")).hexdigest()
+
+
+def add_chunk_ids(df: pd.DataFrame) -> pd.DataFrame:
+    """Add an 'id' column to the chunks, dropping chunks that are exact duplicates.
+
+    Chunks standing for several pages (a 'urls' column, see dedup.deduplicate) are keyed by all their urls,
+    so that their row is replaced when the list changes.
+    """
+    df = df.copy()
+    urls = df.url if "urls" not in df.columns else ["\n".join(u) for u in df.urls]
+    df["id"] = [chunk_id(url, content) for url, content in zip(urls, df.content)]
+    return df.drop_duplicates("id", ignore_index=True)
+
+
+class IncrementalDeepLakeDocumentsManager(DeepLakeDocumentsManager):
+    """DeepLake documents manager whose rows are keyed by chunk id, so the store can be updated in place.
+
+    Each entry in the df is expected to have an 'id' column, see add_chunk_ids.
+    If an embedding_cache is set, it is checked before calling the embedding API.
+    If an embedding_scheduler is set, it computes the embeddings instead of embedding_fn.
+    """
+
+    def __init__(
+        self,
+        vector_store_path: str = "deeplake_store",
+        required_columns: Optional[list[str]] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        embedding_scheduler: Optional[EmbeddingScheduler] = None,
+        **vector_store_kwargs,
+    ):
+        super().__init__(
+            vector_store_path=vector_store_path,
+            required_columns=required_columns,
+            **vector_store_kwargs,
+        )
+        self.embedding_cache = embedding_cache
+        self.embedding_scheduler = embedding_scheduler
+
+    def add(
+        self,
+        df: pd.DataFrame,
+        num_workers: int = 16,
+        embedding_fn: callable = get_embedding_openai,
+        **kwargs,
+    ):
+        # batch_add can produce empty batches, there is nothing to embed
+        if len(df) == 0:
+            return
+
+        if "embedding" not in df.columns:
+            df = df.copy()
+            if self.embedding_cache is not None:
+                df["embedding"] = self._compute_embeddings_cached(
+                    df, embedding_fn, num_workers
+                )
+            elif self.embedding_scheduler is not None:
+                df["embedding"] = self._compute_embeddings(
+                    df, embedding_fn, num_workers
+                )
+
+        super().add(df, num_workers=num_workers, embedding_fn=embedding_fn, **kwargs)
+
+    def _compute_embeddings(
+        self, df: pd.DataFrame, embedding_fn: callable, num_workers: int
+    ) -> list:
+        """Compute the embeddings of the 'content' column."""
+        if self.embedding_scheduler is not None:
+            return self.embedding_scheduler.embed(df.content.to_list())
+        return compute_embeddings_parallelized(
+            df, embedding_fn=embedding_fn, num_workers=num_workers
+        )
+
+    def _compute_embeddings_cached(
+        self, df: pd.DataFrame, embedding_fn: callable, num_workers: int
+    ) -> list:
+        """Look up embeddings in the cache, only the missing ones are computed (and cached)."""
+        embeddings = self.embedding_cache.get_many(df.content.to_list())
+
+        missing = [idx for idx, embedding in enumerate(embeddings) if embedding is None]
+        logger.info(
+            f"Embedding cache: {len(df) - len(missing)} hits, {len(missing)} misses."
+        )
+
+        if len(missing) > 0:
+            missing_df = df.iloc[missing]
+            computed = self._compute_embeddings(missing_df, embedding_fn, num_workers)
+            self.embedding_cache.put_many(missing_df.content.to_list(), computed)
+            for idx, embedding in zip(missing, computed):
+                embeddings[idx] = embedding
+
+        return embeddings
+
+    def _add_documents(self, df: pd.DataFrame, **add_kwargs):
+        assert "id" in df.columns, "expected column=id in the dataframe"
+        ids = df.id.to_list()
+        super()._add_documents(df.drop(columns="id"), id=ids, **add_kwargs)
+
+    def delete_documents(self, ids: list[str]):
+        """Delete the rows with the given chunk ids from the store."""
+        if len(ids) == 0:
+            return
+        logger.info(f"Deleting {len(ids)} stale chunks from the vector store.")
+        self.vector_store.delete(ids=ids)
+
+    def update(self, df: pd.DataFrame, previous_ids: list[str], **batch_add_kwargs):
+        """Bring the store up to date with df, given the chunk ids it currently holds.
+
+        Stale chunks are deleted and only new or changed chunks are embedded, the rest of the store is left alone.
+        """
+        previous_ids = set(previous_ids)
+        current_ids = set(df.id)
+
+        stale_ids = sorted(previous_ids - current_ids)
+        new_df = df[~df.id.isin(previous_ids)].copy()
+        logger.info(
+            f"{len(new_df)} new chunks, {len(stale_ids)} stale chunks, "
+            f"{len(current_ids & previous_ids)} unchanged chunks."
+        )
+
+        self.delete_documents(stale_ids)
+        if len(new_df) > 0:
+            self.batch_add(df=new_df, **batch_add_kwargs)
@@ -1,10 +1,31 @@
 import logging
 import os
+from datetime import datetime, timezone
+from functools import lru_cache, partial
 
-from buster.docparser import get_all_documents
-from buster.documents_manager import DeepLakeDocumentsManager
+from buster.documents_manager.base import get_embedding_openai
 from buster.parser import SphinxParser
+from buster.tokenizers import GPTTokenizer
 
+from cfg import buster_cfg
+from dedup import DEDUP_CFG, deduplicate
+from documents_manager import IncrementalDeepLakeDocumentsManager, add_chunk_ids
+from embedding_cache import EmbeddingCache
+from embedding_scheduler import EmbeddingScheduler
+from manifest import (
+    build_manifest,
+    delete_manifest,
+    is_store_up_to_date,
+    load_manifest,
+    manifest_matches,
+    save_manifest,
+)
+from metrics import span, trace
+from parsing import get_all_documents_parallel
+from pipeline import run_pipeline
+from prompting import count_tokens
+from retrievers import build_lexical_index
+from rtd_scraper.archive import PageArchive, get_archive_path
 from rtd_scraper.scrape_rtd import sanitize_url, run_spider
 
 # When using scrapy it seems to set logging for all apps at DEBUG, so simply shut it off here...
@@ -12,43 +33,231 @@ for name in logging.root.manager.loggerDict:
     logger = logging.getLogger(name)
     logger.setLevel(logging.INFO)
 
+# Parameters used to build the store, recorded in its manifest
+CHUNKING_CFG = {
+    "min_section_length": 100,
+    "max_section_length": 1000,
+}
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# Tokenizer of the chat model the chunks are given to, see cfg.buster_cfg.tokenizer_cfg
+TOKENIZER_MODEL = buster_cfg.tokenizer_cfg["model_name"]
+# Starting quota of the embedding scheduler, corrected by the API's rate limit headers
+EMBEDDING_RATE_LIMITS = {
+    "tokens_per_minute": 1_000_000,
+    "requests_per_minute": 3_000,
+}
 
-def embed_documents(homepage_url, save_directory, target_version=None):
+
+def get_root_dir(homepage_url, save_directory):
+    """root_dir is the folder containing the scraped content e.g. crawled_outputs/buster.readthedocs.io/"""
+    return os.path.join(save_directory, homepage_url.split("://", 1)[1])
+
+
+def get_archive_path_for(save_directory, output_format):
+    """The PageArchive the pages are crawled into, None if they are saved as files."""
+    if output_format == "archive":
+        return get_archive_path(save_directory)
+    return None
+
+
+def store_is_up_to_date(
+    homepage_url,
+    save_directory,
+    target_version=None,
+    output_format="files",
+    vector_store_path=None,
+):
+    """Check whether the vector store in save_directory can be served without crawling and embedding again."""
+    homepage_url = sanitize_url(homepage_url)
+    if vector_store_path is None:
+        vector_store_path = os.path.join(save_directory, "deeplake_store")
+    return is_store_up_to_date(
+        vector_store_path=vector_store_path,
+        homepage_url=homepage_url,
+        target_version=target_version,
+        root_dir=get_root_dir(homepage_url, save_directory),
+        chunking_cfg=CHUNKING_CFG,
+        embedding_model=EMBEDDING_MODEL,
+        tokenizer_model=TOKENIZER_MODEL,
+        dedup_cfg=DEDUP_CFG,
+        archive_path=get_archive_path_for(save_directory, output_format),
+    )
+
+
+@lru_cache
+def get_tokenizer() -> GPTTokenizer:
+    return GPTTokenizer(TOKENIZER_MODEL)
+
+
+def prepare_chunks(df, target_version=None):
+    """Add the source column, collapse duplicate chunks, key each chunk by its urls and content hash, and count its tokens.
+
+    Duplicates are only collapsed within df: across all the docs in a blocking build, within each page in a
+    pipelined one. The token counts (n_tokens) are stored with the chunks, so they are not tokenized again on
+    every question.
+    """
+    df["source"] = "readthedocs"
+    df = deduplicate(df, target_version=target_version, **DEDUP_CFG)
+    df = add_chunk_ids(df)
+    df["n_tokens"] = count_tokens(get_tokenizer(), df.content.to_list())
+    return df
+
+
+@trace("embed_documents")
+def embed_documents(
+    homepage_url,
+    save_directory,
+    target_version=None,
+    incremental_crawl=True,
+    embedding_cache_path=None,
+    num_parse_workers=None,
+    pipelined=False,
+    output_format="files",
+    vector_store_path=None,
+):
+    """Crawl, parse and embed the docs into save_directory/deeplake_store (or vector_store_path).
+
+    With pipelined=True, the three phases run concurrently instead of one after the other, see pipeline.run_pipeline.
+    With output_format="archive", the crawled pages are kept in a single PageArchive instead of one file each.
+    """
     # adds https:// and trailing slash
     homepage_url = sanitize_url(homepage_url)
 
-    # Crawl the website using scrapy
-    run_spider(
-        homepage_url, save_directory=save_directory, target_version=target_version
+    # An existing store built with the same settings is updated in place instead of rebuilt
+    if vector_store_path is None:
+        vector_store_path = os.path.join(save_directory, "deeplake_store")
+    previous_manifest = load_manifest(vector_store_path)
+    update_in_place = (
+        os.path.isdir(vector_store_path)
+        and previous_manifest is not None
+        and previous_manifest.get("chunk_ids") is not None
+        and manifest_matches(
+            previous_manifest,
+            homepage_url=homepage_url,
+            target_version=target_version,
+            chunking_cfg=CHUNKING_CFG,
+            embedding_model=EMBEDDING_MODEL,
+            tokenizer_model=TOKENIZER_MODEL,
+            dedup_cfg=DEDUP_CFG,
+        )
     )
 
-    # # Convert the .html pages into chunks using Buster's SphinxParser
-    # root_dir is the folder containing the scraped content e.g. crawled_outputs/buster.readthedocs.io/
-    root_dir = os.path.join(save_directory, homepage_url.split("https://")[1])
-    df = get_all_documents(
-        root_dir=root_dir,
-        base_url=homepage_url,
-        parser_cls=SphinxParser,
-        min_section_length=100,
-        max_section_length=1000,
-    )
-    df["source"] = "readthedocs"  # Add the source column
+    # The store is about to change, it is only valid again once the manifest is rewritten
+    delete_manifest(vector_store_path)
+    previous_ids = previous_manifest["chunk_ids"] if update_in_place else None
 
-    #  Initialize the DeepLake vector store
-    vector_store_path = os.path.join(save_directory, "deeplake_store")
-    dm = DeepLakeDocumentsManager(
-        vector_store_path=vector_store_path,
-        overwrite=True,
-        required_columns=["url", "content", "source", "title"],
+    # Embeddings of chunks seen before (other versions, previous builds) are reused from the cache
+    if embedding_cache_path is None:
+        embedding_cache_path = os.path.join(save_directory, "embedding_cache.sqlite")
+    embedding_cache = EmbeddingCache(
+        embedding_cache_path, embedding_model=EMBEDDING_MODEL
     )
 
-    # Add all embeddings to the vector store
-    dm.batch_add(
-        df=df,
+    def init_documents_manager():
+        #  Initialize the DeepLake vector store
+        return IncrementalDeepLakeDocumentsManager(
+            vector_store_path=vector_store_path,
+            overwrite=not update_in_place,
+            required_columns=["url", "content", "source", "title"],
+            embedding_cache=embedding_cache,
+            embedding_scheduler=embedding_scheduler,
+        )
+
+    # Embeddings are packed into requests by token count and sent at the rate the API quota allows
+    embedding_scheduler = EmbeddingScheduler(
+        embedding_model=EMBEDDING_MODEL,
+        tokenizer=GPTTokenizer(EMBEDDING_MODEL),
+        **EMBEDDING_RATE_LIMITS,
+    )
+    batch_add_kwargs = dict(
         batch_size=3000,
-        min_time_interval=60,
+        min_time_interval=0,
         num_workers=32,
+        embedding_fn=partial(get_embedding_openai, model=EMBEDDING_MODEL),
+    )
+    root_dir = get_root_dir(homepage_url, save_directory)
+    archive_path = get_archive_path_for(save_directory, output_format)
+
+    if pipelined:
+        # Crawl, parse and embed concurrently, each page flowing through as soon as it is crawled
+        with span("pipeline") as attributes:
+            chunk_ids = run_pipeline(
+                homepage_url=homepage_url,
+                save_directory=save_directory,
+                root_dir=root_dir,
+                dm=init_documents_manager(),
+                prepare_fn=partial(prepare_chunks, target_version=target_version),
+                parser_cls=SphinxParser,
+                chunking_cfg=CHUNKING_CFG,
+                target_version=target_version,
+                incremental_crawl=incremental_crawl,
+                previous_ids=previous_ids,
+                num_parse_workers=num_parse_workers,
+                output_format=output_format,
+                **batch_add_kwargs,
+            )
+            attributes["documents"] = len(chunk_ids)
+        crawl_time = datetime.now(timezone.utc).isoformat()
+    else:
+        # Crawl the website using scrapy
+        # In incremental mode, only pages that changed since the last crawl get downloaded
+        with span("crawl"):
+            run_spider(
+                homepage_url,
+                save_directory=save_directory,
+                target_version=target_version,
+                incremental=incremental_crawl,
+                output_format=output_format,
+            )
+        crawl_time = datetime.now(timezone.utc).isoformat()
+
+        # # Convert the .html pages into chunks using Buster's SphinxParser, spread over num_parse_workers processes
+        with span("parse") as attributes:
+            df = get_all_documents_parallel(
+                root_dir=root_dir,
+                base_url=homepage_url,
+                parser_cls=SphinxParser,
+                num_workers=num_parse_workers,
+                archive_path=archive_path,
+                **CHUNKING_CFG,
+            )
+            df = prepare_chunks(df, target_version=target_version)
+            attributes["documents"] = len(df)
+        chunk_ids = df.id.to_list()
+
+        dm = init_documents_manager()
+        with span("embed", documents=len(df)):
+            if update_in_place:
+                # Only embed the chunks that changed, and delete the stale ones
+                dm.update(df=df, previous_ids=previous_ids, **batch_add_kwargs)
+            else:
+                # Add all embeddings to the vector store
+                dm.batch_add(df=df, **batch_add_kwargs)
+
+    # Pages crawled again leave their previous records behind, rewrite the archive once they take most of it
+    if archive_path is not None:
+        with PageArchive(archive_path) as archive:
+            if archive.garbage_ratio() > 0.5:
+                archive.compact()
+
+    # Local BM25 index of the chunks, for HybridRetriever
+    with span("lexical_index"):
+        build_lexical_index(vector_store_path)
+
+    # Record how the store was built so the next startup can skip all of the above
+    manifest = build_manifest(
+        homepage_url=homepage_url,
+        target_version=target_version,
+        root_dir=root_dir,
+        chunking_cfg=CHUNKING_CFG,
+        embedding_model=EMBEDDING_MODEL,
+        tokenizer_model=TOKENIZER_MODEL,
+        dedup_cfg=DEDUP_CFG,
+        crawl_time=crawl_time,
+        chunk_ids=chunk_ids,
+        archive_path=archive_path,
     )
+    save_manifest(manifest, vector_store_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,94 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from typing import Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text the same way it is sent to the embedding API."""
+    return text.replace("\n", " ").strip()
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Content-addressed embedding cache, stored in a single SQLite file.
+
+    Embeddings are keyed by (embedding model, hash of the normalized text) and stored as float32 blobs,
+    so identical chunks are only ever embedded once, across rebuilds, doc versions and sites sharing the file.
+    """
+
+    # Max. number of parameters per query, SQLite's default limit is 999
+    _query_batch_size = 500
+
+    def __init__(self, path: str, embedding_model: str):
+        self.path = path
+        self.embedding_model = embedding_model
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                PRIMARY KEY (model, hash)
+            )"""
+        )
+        self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._conn.execute(
+                "SELECT COUNT(*) FROM embeddings WHERE model = ?",
+                (self.embedding_model,),
+            ).fetchone()
+        return count
+
+    def get_many(self, texts: list[str]) -> list[Optional[np.ndarray]]:
+        """Look up the embeddings of texts, None for texts that aren't cached."""
+        hashes = [text_hash(text) for text in texts]
+        found = {}
+        with self._lock:
+            for start in range(0, len(hashes), self._query_batch_size):
+                batch = list(set(hashes[start : start + self._query_batch_size]))
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT hash, embedding FROM embeddings WHERE model = ? AND hash IN ({placeholders})",
+                    [self.embedding_model, *batch],
+                )
+                for h, blob in rows:
+                    found[h] = np.frombuffer(blob, dtype=np.float32)
+        return [found.get(h) for h in hashes]
+
+    def put_many(self, texts: list[str], embeddings: list[Optional[np.ndarray]]):
+        """Store embeddings of texts. Missing embeddings (None) are skipped."""
+        rows = [
+            (
+                self.embedding_model,
+                text_hash(text),
+                np.asarray(embedding, dtype=np.float32).tobytes(),
+            )
+            for text, embedding in zip(texts, embeddings)
+            if embedding is not None
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, hash, embedding) VALUES (?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,291 @@
+import logging
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import numpy as np
+import openai
+from buster.tokenizers import Tokenizer
+from openai import api_requestor
+
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+# Errors worth retrying, everything else (e.g. InvalidRequestError) fails the batch right away
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """Parse the duration of OpenAI's x-ratelimit-reset-* headers (e.g. '1s', '6m0s', '20ms') into seconds."""
+    if not value:
+        return None
+    seconds = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        seconds += float(amount) * {"h": 3600, "m": 60, "s": 1, "ms": 0.001}[unit]
+    return seconds
+
+
+class RateLimitBudget:
+    """Tracks the tokens and requests spent over the last minute against a tokens/requests per minute quota.
+
+    The quota and remaining budget are corrected by the x-ratelimit-* headers returned by the API.
+    """
+
+    window = 60.0
+
+    def __init__(self, tokens_per_minute: int, requests_per_minute: int):
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self._spent = deque()  # (timestamp, tokens) of each request
+        self._spent_tokens = 0
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float):
+        while self._spent and self._spent[0][0] <= now - self.window:
+            _, tokens = self._spent.popleft()
+            self._spent_tokens -= tokens
+
+    def _wait_time(self, tokens: int, now: float) -> float:
+        """Seconds to wait before a request of `tokens` tokens fits the budget, 0 if it fits now."""
+        if now < self._paused_until:
+            return self._paused_until - now
+
+        self._expire(now)
+        if len(self._spent) == 0:
+            # A single request bigger than the quota can't wait for anything
+            return 0.0
+
+        fits_tokens = self._spent_tokens + tokens <= self.tokens_per_minute
+        fits_requests = len(self._spent) + 1 <= self.requests_per_minute
+        if fits_tokens and fits_requests:
+            return 0.0
+        return self._spent[0][0] + self.window - now
+
+    def acquire(self, tokens: int):
+        """Block until a request of `tokens` tokens fits the budget, then spend it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait_time = self._wait_time(tokens, now)
+                if wait_time <= 0:
+                    self._spent.append((now, tokens))
+                    self._spent_tokens += tokens
+                    return
+            time.sleep(wait_time)
+
+    def pause(self, seconds: float):
+        """Stop sending requests for a while, e.g. after a 429."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers) -> Optional[float]:
+        """Sync the budget with the rate limit headers of a response, returns the fraction of token budget left."""
+        if not headers:
+            return None
+
+        def get_int(name):
+            try:
+                return int(headers.get(name))
+            except (TypeError, ValueError):
+                return None
+
+        limit_tokens = get_int("x-ratelimit-limit-tokens")
+        limit_requests = get_int("x-ratelimit-limit-requests")
+        remaining_tokens = get_int("x-ratelimit-remaining-tokens")
+        remaining_requests = get_int("x-ratelimit-remaining-requests")
+
+        with self._lock:
+            if limit_tokens:
+                self.tokens_per_minute = limit_tokens
+            if limit_requests:
+                self.requests_per_minute = limit_requests
+
+        # Quota is exhausted server-side, wait until it resets
+        if remaining_tokens == 0:
+            reset = parse_reset_duration(headers.get("x-ratelimit-reset-tokens"))
+            self.pause(reset or 1.0)
+        if remaining_requests == 0:
+            reset = parse_reset_duration(headers.get("x-ratelimit-reset-requests"))
+            self.pause(reset or 1.0)
+
+        if remaining_tokens is None or not self.tokens_per_minute:
+            return None
+        return remaining_tokens / self.tokens_per_minute
+
+
+class AdaptiveConcurrency:
+    """Limits the number of requests in flight, additively increased on success and halved when rate limited."""
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = 32):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def increase(self):
+        with self._condition:
+            self.limit = min(self.maximum, self.limit + 1)
+            self._condition.notify_all()
+
+    def decrease(self):
+        with self._condition:
+            self.limit = max(self.minimum, self.limit // 2)
+            logger.info(f"Rate limited, reducing concurrency to {self.limit}.")
+
+
+class EmbeddingScheduler:
+    """Computes embeddings in batches packed by token count, at the rate allowed by the API quota.
+
+    Instead of sleeping a fixed interval between batches, requests are sent as fast as the tokens/requests per
+    minute budget allows. The budget and the concurrency adapt to the rate limit headers returned by the API,
+    and failed requests are retried with jittered exponential backoff.
+    """
+
+    # OpenAI's limits for a single embedding request
+    max_input_tokens = 8191
+    max_batch_inputs = 2048
+
+    def __init__(
+        self,
+        embedding_model: str,
+        tokenizer: Tokenizer,
+        tokens_per_minute: int = 1_000_000,
+        requests_per_minute: int = 3_000,
+        max_batch_tokens: int = 100_000,
+        max_concurrency: int = 16,
+        max_retries: int = 6,
+        request_timeout: float = 60,
+    ):
+        self.embedding_model = embedding_model
+        self.tokenizer = tokenizer
+        self.max_batch_tokens = max_batch_tokens
+        self.max_retries = max_retries
+        self.request_timeout = request_timeout
+        self.budget = RateLimitBudget(tokens_per_minute, requests_per_minute)
+        self.concurrency = AdaptiveConcurrency(
+            initial=max(1, max_concurrency // 4), maximum=max_concurrency
+        )
+
+    def pack_batches(self, texts: list[str]) -> list[tuple[list[int], int]]:
+        """Group texts into batches of at most max_batch_tokens tokens, returns (indices, num_tokens) per batch."""
+        batches = []
+        indices, batch_tokens = [], 0
+        for idx, text in enumerate(texts):
+            num_tokens = min(self.tokenizer.num_tokens(text), self.max_input_tokens)
+            if indices and (
+                batch_tokens + num_tokens > self.max_batch_tokens
+                or len(indices) >= self.max_batch_inputs
+            ):
+                batches.append((indices, batch_tokens))
+                indices, batch_tokens = [], 0
+            indices.append(idx)
+            batch_tokens += num_tokens
+        if indices:
+            batches.append((indices, batch_tokens))
+        return batches
+
+    def _request(self, inputs: list[str]):
+        """Single embedding request, returns the response data and headers."""
+        requestor = api_requestor.APIRequestor()
+        response, _, _ = requestor.request(
+            "post",
+            "/embeddings",
+            params={"input": inputs, "model": self.embedding_model},
+            request_timeout=self.request_timeout,
+        )
+        return response.data, response._headers
+
+    def _embed_batch(
+        self, inputs: list[str], num_tokens: int
+    ) -> list[Optional[np.ndarray]]:
+        for attempt in range(self.max_retries + 1):
+            self.budget.acquire(num_tokens)
+            try:
+                with self.concurrency:
+                    data, headers = self._request(inputs)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    logger.exception(
+                        f"Embedding batch failed after {attempt + 1} attempts."
+                    )
+                    break
+
+                backoff = min(60.0, 2**attempt) * random.uniform(0.5, 1.5)
+                if isinstance(e, openai.error.RateLimitError):
+                    self.concurrency.decrease()
+                    self.budget.update_from_headers(e.headers)
+                    retry_after = (e.headers or {}).get("retry-after")
+                    if retry_after is not None:
+                        backoff = max(backoff, float(retry_after))
+                    self.budget.pause(backoff)
+                logger.warning(
+                    f"Embedding request failed ({e.__class__.__name__}), retrying in {backoff:.1f}s..."
+                )
+                time.sleep(backoff)
+                continue
+            except openai.error.OpenAIError:
+                logger.exception("Embedding batch failed. See traceback:")
+                break
+
+            budget_left = self.budget.update_from_headers(headers)
+            if budget_left is None or budget_left > 0.2:
+                self.concurrency.increase()
+
+            embeddings = sorted(data["data"], key=lambda x: x["index"])
+            return [np.array(x["embedding"], dtype=np.float32) for x in embeddings]
+
+        # Same as get_embedding_openai, failed embeddings are None
+        return [None] * len(inputs)
+
+    def embed(self, texts: list[str]) -> list[Optional[np.ndarray]]:
+        """Embed all texts, returns their embeddings in the same order (None for the ones that failed)."""
+        inputs = [text.replace("\n", " ") for text in texts]
+        batches = self.pack_batches(inputs)
+        logger.info(
+            f"Computing embeddings of {len(texts)} chunks in {len(batches)} requests."
+        )
+
+        embeddings = [None] * len(texts)
+
+        def run(batch):
+            indices, num_tokens = batch
+            batch_embeddings = self._embed_batch(
+                [inputs[i] for i in indices], num_tokens
+            )
+            for idx, embedding in zip(indices, batch_embeddings):
+                embeddings[idx] = embedding
+
+        with span(
+            "embedding_requests",
+            documents=len(texts),
+            tokens=sum(num_tokens for _, num_tokens in batches),
+        ), ThreadPoolExecutor(max_workers=self.concurrency.maximum) as executor:
+            list(executor.map(run, batches))
+
+        logger.info("Finished computing embeddings")
+        return embeddings
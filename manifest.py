@@ -0,0 +1,184 @@
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+
+from rtd_scraper.archive import PageArchive, key_prefix
+
+logger = logging.getLogger(__name__)
+
+# Fields that must match for an existing vector store to be reused as-is
+MANIFEST_KEYS = [
+    "homepage_url",
+    "target_version",
+    "chunking_cfg",
+    "embedding_model",
+    # The chunks' token counts (n_tokens) are only valid for this tokenizer
+    "tokenizer_model",
+    "dedup_cfg",
+]
+
+
+def get_manifest_path(vector_store_path: str) -> str:
+    """The manifest lives next to the vector store, e.g. outputs/deeplake_store.manifest.json"""
+    return os.path.normpath(vector_store_path) + ".manifest.json"
+
+
+def hash_file(filepath) -> str:
+    """Returns the sha256 hex digest of a file's contents."""
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def hash_pages(root_dir: str, archive_path: Optional[str] = None) -> dict[str, str]:
+    """Hash every crawled .html page under root_dir, keyed by its path relative to root_dir.
+
+    With archive_path, the pages are the ones in that PageArchive, whose index already has their hashes.
+    """
+    if archive_path is not None:
+        hashes = PageArchive(archive_path).hashes(key_prefix(archive_path, root_dir))
+        return {
+            file: content_hash
+            for file, content_hash in hashes.items()
+            if file.endswith(".html")
+        }
+
+    root = Path(root_dir)
+    if not root.is_dir():
+        return {}
+    return {
+        str(filepath.relative_to(root)): hash_file(filepath)
+        for filepath in sorted(root.glob("**/*.html"))
+    }
+
+
+def build_manifest(
+    homepage_url: str,
+    target_version: Optional[str],
+    root_dir: str,
+    chunking_cfg: dict,
+    embedding_model: str,
+    tokenizer_model: str,
+    dedup_cfg: dict,
+    crawl_time: Optional[str] = None,
+    chunk_ids: Optional[list[str]] = None,
+    archive_path: Optional[str] = None,
+) -> dict:
+    """Describe how a vector store was built so that it can be reused on the next startup.
+
+    chunk_ids are the ids of the rows in the store, used to update it incrementally.
+    archive_path is the PageArchive the pages were crawled into, if they weren't saved as files.
+    """
+    if crawl_time is None:
+        crawl_time = datetime.now(timezone.utc).isoformat()
+
+    return {
+        "homepage_url": homepage_url,
+        "target_version": target_version,
+        "crawl_time": crawl_time,
+        "chunking_cfg": chunking_cfg,
+        "embedding_model": embedding_model,
+        "tokenizer_model": tokenizer_model,
+        "dedup_cfg": dedup_cfg,
+        "page_hashes": hash_pages(root_dir, archive_path),
+        "chunk_ids": chunk_ids,
+    }
+
+
+def save_manifest(manifest: dict, vector_store_path: str):
+    """Atomically write the manifest next to the vector store."""
+    manifest_path = get_manifest_path(vector_store_path)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+    logger.info(f"Saved manifest to {manifest_path}")
+
+
+def load_manifest(vector_store_path: str) -> Optional[dict]:
+    """Load the manifest of a vector store, returns None if it doesn't exist or can't be read."""
+    manifest_path = get_manifest_path(vector_store_path)
+    try:
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, json.JSONDecodeError):
+        logger.warning(f"Could not read manifest {manifest_path}, ignoring it.")
+        return None
+
+
+def delete_manifest(vector_store_path: str):
+    """Remove the manifest, e.g. before rebuilding the store it describes."""
+    try:
+        os.remove(get_manifest_path(vector_store_path))
+    except FileNotFoundError:
+        pass
+
+
+def manifest_matches(manifest: dict, **expected) -> bool:
+    """Check that the manifest was built with the expected settings (see MANIFEST_KEYS)."""
+    for key in MANIFEST_KEYS:
+        if manifest.get(key) != expected[key]:
+            logger.info(
+                f"Manifest mismatch on {key}: {manifest.get(key)!r} != {expected[key]!r}"
+            )
+            return False
+    return True
+
+
+def is_store_up_to_date(
+    vector_store_path: str,
+    homepage_url: str,
+    target_version: Optional[str],
+    root_dir: str,
+    chunking_cfg: dict,
+    embedding_model: str,
+    tokenizer_model: str,
+    dedup_cfg: dict,
+    archive_path: Optional[str] = None,
+) -> bool:
+    """Check whether the vector store can be served as-is, without crawling and embedding again.
+
+    The store is considered up to date when it exists, its manifest was built with the same settings and,
+    if crawled pages are still on disk, none of them changed since the store was built.
+    """
+    if not os.path.isdir(vector_store_path):
+        logger.info(f"No vector store found at {vector_store_path}.")
+        return False
+
+    manifest = load_manifest(vector_store_path)
+    if manifest is None:
+        logger.info(f"No manifest found for {vector_store_path}.")
+        return False
+
+    if not manifest_matches(
+        manifest,
+        homepage_url=homepage_url,
+        target_version=target_version,
+        chunking_cfg=chunking_cfg,
+        embedding_model=embedding_model,
+        tokenizer_model=tokenizer_model,
+        dedup_cfg=dedup_cfg,
+    ):
+        return False
+
+    # Pages crawled since the store was built (e.g. an interrupted rebuild) invalidate it
+    pages_on_disk = (
+        os.path.isdir(root_dir)
+        if archive_path is None
+        else os.path.exists(archive_path)
+    )
+    if pages_on_disk and hash_pages(root_dir, archive_path) != manifest.get(
+        "page_hashes"
+    ):
+        logger.info("Crawled pages differ from the ones in the manifest.")
+        return False
+
+    return True
@@ -0,0 +1,381 @@
+import bisect
+import contextlib
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import AsyncIterator, Callable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from a cached lookup to a long completion stream
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Tokens or documents
+COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 100000)
+
+
+class Histogram:
+    """Prometheus-style histogram, with one series per combination of label values."""
+
+    def __init__(self, name: str, help: str, buckets: tuple, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.labels = labels
+        self._series = {}  # label values -> [count per bucket (+Inf last), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [
+                    [0] * (len(self.buckets) + 1),
+                    0.0,
+                ]
+            series[0][idx] += 1
+            series[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [
+                (labels, list(counts), total)
+                for labels, (counts, total) in self._series.items()
+            ]
+
+        for label_values, counts, total in sorted(series):
+            labels = ",".join(
+                f'{name}="{value}"' for name, value in zip(self.labels, label_values)
+            )
+            prefix = labels + "," if labels else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._histograms: dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        buckets: tuple = DURATION_BUCKETS,
+        labels: tuple = (),
+    ) -> Histogram:
+        """Get the histogram with this name, creating it if needed."""
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = Histogram(name, help, buckets, labels)
+            return self._histograms[name]
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text format."""
+        with self._lock:
+            histograms = list(self._histograms.values())
+        return (
+            "\n".join(line for histogram in histograms for line in histogram.render())
+            + "\n"
+        )
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram(
+    "rtd_stage_duration_seconds",
+    "Duration of each stage of a request.",
+    labels=("stage",),
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "rtd_request_duration_seconds",
+    "Duration of requests, from start to last stage.",
+    labels=("kind",),
+)
+# Span attributes recorded as histograms, the other attributes are only logged
+ATTRIBUTE_HISTOGRAMS = {
+    "tokens": REGISTRY.histogram(
+        "rtd_stage_tokens",
+        "Tokens processed by each stage.",
+        COUNT_BUCKETS,
+        labels=("stage",),
+    ),
+    "documents": REGISTRY.histogram(
+        "rtd_stage_documents",
+        "Documents processed by each stage.",
+        COUNT_BUCKETS,
+        labels=("stage",),
+    ),
+}
+
+
+class Trace:
+    """Timing breakdown of one request (a chat, a build of the vector store), logged when it finishes."""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.start = time.perf_counter()
+        self.spans: list[tuple[str, float, dict]] = []
+        self.finished = False
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Make this the current trace, spans started meanwhile (in this context) are added to it."""
+        token = _current_trace.set(self)
+        try:
+            yield self
+        finally:
+            _current_trace.reset(token)
+
+    def add(self, name: str, duration: float, attributes: dict):
+        self.spans.append((name, duration, attributes))
+
+    def summary(self) -> str:
+        stages = []
+        for name, duration, attributes in self.spans:
+            stage = f"{name}={duration * 1000:.0f}ms"
+            if attributes:
+                stage += (
+                    " (" + ", ".join(f"{k}={v}" for k, v in attributes.items()) + ")"
+                )
+            stages.append(stage)
+        return ", ".join(stages)
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        duration = time.perf_counter() - self.start
+        REQUEST_SECONDS.observe(duration, self.kind)
+        logger.info(f"{self.kind} took {duration * 1000:.0f}ms: {self.summary()}")
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+# Attributes of the innermost span, see annotate
+_current_attributes: ContextVar[Optional[dict]] = ContextVar("attributes", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextlib.contextmanager
+def trace(kind: str):
+    """Trace a request from start to end of the block."""
+    request_trace = Trace(kind)
+    with request_trace.activate():
+        try:
+            yield request_trace
+        finally:
+            request_trace.finish()
+
+
+def record(
+    name: str, duration: float, attributes: dict, request_trace: Optional[Trace] = None
+):
+    STAGE_SECONDS.observe(duration, name)
+    for attribute, value in attributes.items():
+        if attribute in ATTRIBUTE_HISTOGRAMS and value is not None:
+            ATTRIBUTE_HISTOGRAMS[attribute].observe(value, name)
+    if request_trace is not None:
+        request_trace.add(name, duration, attributes)
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """Time a stage of the current request. Yields the span's attributes, to set e.g. token counts from the block."""
+    request_trace = current_trace()
+    token = _current_attributes.set(attributes)
+    start = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        record(name, time.perf_counter() - start, attributes, request_trace)
+        _current_attributes.reset(token)
+
+
+def annotate(**attributes):
+    """Set attributes (e.g. a token count) of the innermost span, from code that doesn't have it at hand."""
+    current_attributes = _current_attributes.get()
+    if current_attributes is not None:
+        current_attributes.update(attributes)
+
+
+def traced(
+    fn: Callable, name: str, attributes_fn: Optional[Callable] = None
+) -> Callable:
+    """Wrap fn in a span, with attributes computed from its result by attributes_fn."""
+
+    def wrapper(*args, **kwargs):
+        with span(name) as attributes:
+            result = fn(*args, **kwargs)
+            if attributes_fn is not None:
+                attributes.update(attributes_fn(result))
+            return result
+
+    return wrapper
+
+
+def traced_stream(
+    tokens: Iterator[str], start: float, request_trace: Optional[Trace]
+) -> Iterator[str]:
+    """Record the time to the first token (since start) and the duration of the rest of the stream."""
+    first_token_time = None
+    n_tokens = 0
+    try:
+        for token in tokens:
+            if first_token_time is None:
+                first_token_time = time.perf_counter()
+                record("first_token", first_token_time - start, {}, request_trace)
+            n_tokens += 1
+            yield token
+    finally:
+        if first_token_time is not None:
+            record(
+                "completion_stream",
+                time.perf_counter() - first_token_time,
+                {"tokens": n_tokens},
+                request_trace,
+            )
+
+
+async def traced_astream(
+    tokens: AsyncIterator[str], start: float, request_trace: Optional[Trace]
+) -> AsyncIterator[str]:
+    """Same as traced_stream, for an async stream."""
+    first_token_time = None
+    n_tokens = 0
+    try:
+        async for token in tokens:
+            if first_token_time is None:
+                first_token_time = time.perf_counter()
+                record("first_token", first_token_time - start, {}, request_trace)
+            n_tokens += 1
+            yield token
+    finally:
+        if first_token_time is not None:
+            record(
+                "completion_stream",
+                time.perf_counter() - first_token_time,
+                {"tokens": n_tokens},
+                request_trace,
+            )
+        await tokens.aclose()
+
+
+def instrument_retriever(retriever):
+    """Trace the query embedding and search of a retriever, see instrument_buster."""
+    # A CachedRetriever embeds the question itself, the retriever it wraps only gets the embedding
+    retrievers = [retriever]
+    if hasattr(retriever, "retriever"):
+        retrievers.append(retriever.retriever)
+    for r in retrievers:
+        r.get_embedding = traced(r.get_embedding, "embed_query")
+    retriever.retrieve = traced(
+        retriever.retrieve, "retrieve", lambda df: {"documents": len(df)}
+    )
+    return retriever
+
+
+def instrument_buster(buster):
+    """Trace each stage of buster.process_input, see Trace.
+
+    The components are wrapped in place. A request's trace is finished (and logged) once its answer is
+    fully streamed and postprocessed, or right away if the answer is already known.
+    """
+    validator = buster.validator
+    validator.check_question_relevance = traced(
+        validator.check_question_relevance, "validate"
+    )
+    validator.rerank_docs = traced(
+        validator.rerank_docs, "rerank", lambda df: {"documents": len(df)}
+    )
+    validator.check_answer_relevance = traced(
+        validator.check_answer_relevance, "answer_relevance"
+    )
+
+    instrument_retriever(buster.retriever)
+
+    answer_cache = getattr(buster, "answer_cache", None)
+    if answer_cache is not None:
+        answer_cache.get = traced(
+            answer_cache.get, "answer_cache", lambda answer: {"hit": answer is not None}
+        )
+
+    # The prompt's token count is set by the answerer (see prompting.TokenBudgetDocumentAnswerer)
+    document_answerer = buster.document_answerer
+    document_answerer.prepare_prompt = traced(
+        document_answerer.prepare_prompt, "format_prompt"
+    )
+
+    completer = document_answerer.completer
+    complete = completer.complete
+
+    def traced_complete(*args, **kwargs):
+        start = time.perf_counter()
+        with span("completion_request"):
+            answer, error = complete(*args, **kwargs)
+        if not isinstance(answer, str):
+            answer = traced_stream(answer, start, current_trace())
+        return answer, error
+
+    completer.complete = traced_complete
+
+    process_input = buster.process_input
+
+    def traced_process_input(*args, **kwargs):
+        request_trace = Trace("chat")
+        with request_trace.activate():
+            completion = process_input(*args, **kwargs)
+
+        if completion._answer_text is not None:
+            # Nothing left to generate (e.g. no documents were found)
+            request_trace.finish()
+            return completion
+
+        postprocess = completion.postprocess
+
+        def postprocess_and_finish():
+            with request_trace.activate():
+                with span("postprocess"):
+                    postprocess()
+            request_trace.finish()
+
+        completion.postprocess = postprocess_and_finish
+        return completion
+
+    buster.process_input = traced_process_input
+    return buster
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Serve the metrics at http://host:port/metrics from a background thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving metrics at http://{host}:{server.server_address[1]}/metrics")
+    return server
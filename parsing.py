@@ -0,0 +1,163 @@
+import glob
+import logging
+import os
+from functools import partial
+from multiprocessing import Pool
+from typing import Iterator, Optional, Type
+
+import pandas as pd
+from bs4 import BeautifulSoup
+from buster.parser import Parser
+from tqdm import tqdm
+
+from rtd_scraper.archive import PageArchive, key_prefix
+
+logger = logging.getLogger(__name__)
+
+DOCUMENT_COLUMNS = ["title", "url", "content"]
+
+# Archives opened by this (worker) process, by path
+_archives: dict[str, PageArchive] = {}
+
+
+def parse_page(
+    html: str,
+    file: str,
+    root_dir: str,
+    base_url: str,
+    parser_cls: Type[Parser],
+    min_section_length: int = 100,
+    max_section_length: int = 2000,
+) -> pd.DataFrame:
+    """Extract all sections from the html of one page, file being its path relative to root_dir.
+
+    Same as buster.docparser.get_document, but from the page contents instead of reading the file.
+    """
+    filepath = os.path.join(root_dir, file)
+    soup = BeautifulSoup(html, "html.parser")
+    parser = parser_cls(
+        soup, base_url, root_dir, filepath, min_section_length, max_section_length
+    )
+
+    sections = []
+    urls = []
+    names = []
+    for section in parser.parse():
+        sections.append(section.text)
+        urls.append(section.url)
+        names.append(section.name)
+
+    return pd.DataFrame.from_dict({"title": names, "url": urls, "content": sections})
+
+
+def _read_archived(file: str, root_dir: str, archive_path: str) -> str:
+    archive = _archives.get(archive_path)
+    if archive is None:
+        archive = _archives[archive_path] = PageArchive(archive_path)
+    # Pages may have been crawled again since this process last read the archive
+    archive.refresh()
+    return archive.read(key_prefix(archive_path, root_dir) + file).decode("utf-8")
+
+
+def _parse_file(
+    file: str, root_dir: str, archive_path: Optional[str] = None, **parse_kwargs
+) -> Optional[pd.DataFrame]:
+    """Worker function: read and parse a single file, returns None if it can't be parsed.
+
+    With archive_path, the file is read from that PageArchive instead of from disk.
+    """
+    try:
+        if archive_path is not None:
+            html = _read_archived(file, root_dir, archive_path)
+        else:
+            with open(os.path.join(root_dir, file), "r") as f:
+                html = f.read()
+        return parse_page(html, file, root_dir, **parse_kwargs)
+    except Exception as e:
+        print(f"Skipping {file} due to the following error: {e}")
+        return None
+
+
+def iter_documents(
+    root_dir: str,
+    base_url: str,
+    parser_cls: Type[Parser],
+    min_section_length: int = 100,
+    max_section_length: int = 2000,
+    num_workers: Optional[int] = None,
+    ordered: bool = True,
+    chunksize: int = 8,
+    archive_path: Optional[str] = None,
+) -> Iterator[pd.DataFrame]:
+    """Parse all HTML files in `root_dir` over a pool of processes, yielding the sections of each file as they are ready.
+
+    num_workers defaults to the number of cores, with num_workers=1 files are parsed in this process.
+    With ordered=True, files are yielded in the same order as buster.docparser.get_all_documents would parse them,
+    otherwise they are yielded as soon as they are parsed.
+    With archive_path, the pages under root_dir are read from that PageArchive (in the order they were crawled).
+    """
+    if archive_path is not None:
+        prefix = key_prefix(archive_path, root_dir)
+        files = [
+            key[len(prefix) :]
+            for key in PageArchive(archive_path).keys(prefix)
+            if key.endswith(".html")
+        ]
+    else:
+        files = glob.glob("**/*.html", root_dir=root_dir, recursive=True)
+    parse_file = partial(
+        _parse_file,
+        root_dir=root_dir,
+        archive_path=archive_path,
+        base_url=base_url,
+        parser_cls=parser_cls,
+        min_section_length=min_section_length,
+        max_section_length=max_section_length,
+    )
+
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = min(num_workers, max(len(files), 1))
+    logger.info(f"Parsing {len(files)} files using {num_workers=}")
+
+    if num_workers == 1:
+        for file in tqdm(files):
+            df = parse_file(file)
+            if df is not None:
+                yield df
+        return
+
+    with Pool(processes=num_workers) as pool:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for df in tqdm(imap(parse_file, files, chunksize=chunksize), total=len(files)):
+            if df is not None:
+                yield df
+
+
+def get_all_documents_parallel(
+    root_dir: str,
+    base_url: str,
+    parser_cls: Type[Parser],
+    min_section_length: int = 100,
+    max_section_length: int = 2000,
+    num_workers: Optional[int] = None,
+    ordered: bool = True,
+    archive_path: Optional[str] = None,
+) -> pd.DataFrame:
+    """Parallel version of buster.docparser.get_all_documents, see iter_documents."""
+    dfs = list(
+        iter_documents(
+            root_dir=root_dir,
+            base_url=base_url,
+            parser_cls=parser_cls,
+            min_section_length=min_section_length,
+            max_section_length=max_section_length,
+            num_workers=num_workers,
+            ordered=ordered,
+            archive_path=archive_path,
+        )
+    )
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=DOCUMENT_COLUMNS)
+
+    return pd.concat(dfs, ignore_index=True)
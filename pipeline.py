@@ -0,0 +1,244 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import partial
+from typing import Callable, Optional, Type
+
+import pandas as pd
+from buster.parser import Parser
+
+from documents_manager import IncrementalDeepLakeDocumentsManager
+from parsing import _parse_file
+from rtd_scraper.archive import get_archive_path
+from rtd_scraper.scrape_rtd import run_spider
+
+logger = logging.getLogger(__name__)
+
+# Sentinel marking the end of a queue
+_DONE = object()
+
+
+class _Stage(threading.Thread):
+    """Pipeline stage running in its own thread. Exceptions are kept to be re-raised once the pipeline is joined."""
+
+    def __init__(self, name: str, target: Callable):
+        super().__init__(name=name, daemon=True)
+        self._target_fn = target
+        self.error: Optional[BaseException] = None
+
+    def run(self):
+        try:
+            self._target_fn()
+        except BaseException as e:
+            logger.exception(f"Pipeline stage {self.name} failed. See traceback:")
+            self.error = e
+
+
+def _put(q: queue.Queue, item, consumer: threading.Thread):
+    """Put an item on a bounded queue, blocking while it is full unless its consumer stage has died."""
+    while consumer.is_alive():
+        try:
+            q.put(item, timeout=1)
+            return
+        except queue.Full:
+            continue
+
+
+def _parse_stage(
+    pages: queue.Queue,
+    chunks: queue.Queue,
+    root_dir: str,
+    parse_kwargs: dict,
+    num_workers: int,
+    consumer: threading.Thread,
+):
+    """Parse pages as they are crawled, over a pool of processes, and forward their chunks."""
+    parse_file = partial(_parse_file, root_dir=root_dir, **parse_kwargs)
+    # Bound the number of pages being parsed, so that a slow embedding stage also slows down parsing
+    max_in_flight = 2 * num_workers
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        in_flight = set()
+
+        def forward(futures):
+            for future in futures:
+                df = future.result()
+                if df is not None and len(df) > 0:
+                    _put(chunks, df, consumer)
+
+        while True:
+            page = pages.get()
+            if page is _DONE:
+                break
+
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                forward(done)
+            in_flight.add(executor.submit(parse_file, page))
+
+        forward(wait(in_flight).done)
+
+    _put(chunks, _DONE, consumer)
+
+
+def _embed_stage(
+    chunks: queue.Queue,
+    dm: IncrementalDeepLakeDocumentsManager,
+    prepare_fn: Callable[[pd.DataFrame], pd.DataFrame],
+    previous_ids: set[str],
+    chunk_ids: list[str],
+    batch_size: int,
+    min_time_interval: int,
+    add_kwargs: dict,
+):
+    """Accumulate chunks into batches and embed them into the store.
+
+    Chunks already in the store (previous_ids) are skipped, their ids are still recorded in chunk_ids.
+    """
+    seen_ids = set()
+    batch = []
+    batch_len = 0
+    last_batch_time = None
+
+    def flush():
+        nonlocal batch, batch_len, last_batch_time
+        if batch_len == 0:
+            return
+
+        # Keep a minimum time interval between batches, like DocumentsManager.batch_add
+        if last_batch_time is not None:
+            sleep_time = min_time_interval - (time.time() - last_batch_time)
+            if sleep_time > 0:
+                logger.info(f"Sleeping for {round(sleep_time)} seconds...")
+                time.sleep(sleep_time)
+
+        last_batch_time = time.time()
+        dm.add(pd.concat(batch, ignore_index=True), **add_kwargs)
+        batch, batch_len = [], 0
+
+    while True:
+        df = chunks.get()
+        if df is _DONE:
+            break
+
+        df = prepare_fn(df)
+        df = df[~df.id.isin(seen_ids)]
+        seen_ids.update(df.id)
+        chunk_ids.extend(df.id)
+
+        new_df = df[~df.id.isin(previous_ids)]
+        if len(new_df) > 0:
+            batch.append(new_df)
+            batch_len += len(new_df)
+        if batch_len >= batch_size:
+            flush()
+
+    flush()
+
+
+def run_pipeline(
+    homepage_url: str,
+    save_directory: str,
+    root_dir: str,
+    dm: IncrementalDeepLakeDocumentsManager,
+    prepare_fn: Callable[[pd.DataFrame], pd.DataFrame],
+    parser_cls: Type[Parser],
+    chunking_cfg: dict,
+    target_version: Optional[str] = None,
+    incremental_crawl: bool = False,
+    previous_ids: Optional[list[str]] = None,
+    num_parse_workers: Optional[int] = None,
+    batch_size: int = 3000,
+    min_time_interval: int = 0,
+    max_queue_size: int = 1000,
+    output_format: str = "files",
+    **add_kwargs,
+) -> list[str]:
+    """Crawl, parse and embed the docs as a streaming pipeline, instead of three blocking phases.
+
+    Each page is handed to a pool of parsing processes as soon as the spider saves it, and chunks are embedded
+    in batches of batch_size as they accumulate. Stages are connected by bounded queues, so a slow stage applies
+    backpressure to the ones before it. prepare_fn adds the 'source' and 'id' columns to the parsed chunks.
+
+    If previous_ids (the chunk ids currently in the store) is set, only new chunks are embedded and stale ones
+    are deleted once the crawl is over. Returns the ids of all chunks in the store.
+    With output_format="archive", pages are crawled into save_directory's PageArchive and parsed from it.
+    """
+    if num_parse_workers is None:
+        num_parse_workers = os.cpu_count() or 1
+    previous_ids = set(previous_ids or [])
+    archive_path = None
+    if output_format == "archive":
+        archive_path = get_archive_path(save_directory)
+
+    pages = queue.Queue(maxsize=max_queue_size)
+    chunks = queue.Queue(maxsize=max_queue_size)
+    chunk_ids = []
+
+    embed_stage = _Stage(
+        "embed",
+        partial(
+            _embed_stage,
+            chunks=chunks,
+            dm=dm,
+            prepare_fn=prepare_fn,
+            previous_ids=previous_ids,
+            chunk_ids=chunk_ids,
+            batch_size=batch_size,
+            min_time_interval=min_time_interval,
+            add_kwargs=add_kwargs,
+        ),
+    )
+    parse_stage = _Stage(
+        "parse",
+        partial(
+            _parse_stage,
+            pages=pages,
+            chunks=chunks,
+            root_dir=root_dir,
+            parse_kwargs=dict(
+                base_url=homepage_url,
+                parser_cls=parser_cls,
+                archive_path=archive_path,
+                **chunking_cfg,
+            ),
+            num_workers=num_parse_workers,
+            consumer=embed_stage,
+        ),
+    )
+    embed_stage.start()
+    parse_stage.start()
+
+    def on_page(item):
+        # Same files get_all_documents would pick up, relative to root_dir
+        filepath = os.path.relpath(item["filepath"], root_dir)
+        if not filepath.endswith(".html") or filepath.startswith(os.pardir):
+            return
+        # Blocks the crawl when parsing can't keep up
+        _put(pages, filepath, parse_stage)
+
+    try:
+        run_spider(
+            homepage_url,
+            save_directory=save_directory,
+            target_version=target_version,
+            incremental=incremental_crawl,
+            on_page=on_page,
+            output_format=output_format,
+        )
+    finally:
+        _put(pages, _DONE, parse_stage)
+        parse_stage.join()
+        embed_stage.join()
+
+    for stage in [parse_stage, embed_stage]:
+        if stage.error is not None:
+            raise RuntimeError(f"Pipeline stage {stage.name} failed.") from stage.error
+
+    stale_ids = sorted(previous_ids - set(chunk_ids))
+    dm.delete_documents(stale_ids)
+
+    return chunk_ids
@@ -0,0 +1,104 @@
+import logging
+from functools import cached_property
+from typing import Optional
+
+import pandas as pd
+from buster.completers import DocumentAnswerer
+from buster.formatters.documents import DocumentsFormatterJSON
+from buster.tokenizers import Tokenizer
+
+from metrics import annotate
+
+logger = logging.getLogger(__name__)
+
+# Tokens that may be gained where the formatted documents are joined to the prompt template
+JOIN_TOKENS = 4
+
+
+def count_tokens(tokenizer: Tokenizer, texts: list[str]) -> list[int]:
+    """Number of tokens of each text, e.g. to store as the n_tokens column of the chunks when building the store."""
+    encoder = getattr(tokenizer, "encoder", None)
+    if encoder is not None and hasattr(encoder, "encode_batch"):
+        # tiktoken encodes batches over a pool of threads
+        return [len(encoded) for encoded in encoder.encode_batch(texts)]
+    return [tokenizer.num_tokens(text) for text in texts]
+
+
+class TokenCountedDocumentsFormatter(DocumentsFormatterJSON):
+    """DocumentsFormatterJSON fitting the documents in max_tokens from their n_tokens column, without tokenizing them.
+
+    n_tokens is the number of tokens of each chunk's content, counted once when the store is built (see
+    embed_docs.prepare_chunks). The rest of the json (the other columns, keys, punctuation and escapes) is
+    counted as one token per byte, which can only overestimate. Documents are only tokenized when this
+    estimate doesn't fit in max_tokens, or if they have no token counts (e.g. a store built before they were added).
+    """
+
+    def estimate_tokens(
+        self, matched_documents: pd.DataFrame, documents_str: str
+    ) -> Optional[int]:
+        """Upper bound of the number of tokens of the formatted documents, None without token counts."""
+        if (
+            "n_tokens" not in matched_documents.columns
+            or matched_documents.n_tokens.isna().any()
+        ):
+            return None
+        content_bytes = sum(
+            len(content.encode("utf-8")) for content in matched_documents.content
+        )
+        other_bytes = len(documents_str.encode("utf-8")) - content_bytes
+        return int(matched_documents.n_tokens.sum()) + max(other_bytes, 0)
+
+    def format_with_count(
+        self, matched_documents: pd.DataFrame
+    ) -> tuple[str, pd.DataFrame, int]:
+        """Same as format, also returns the number of tokens of the formatted documents (or an upper bound)."""
+        documents_str = matched_documents[self.columns].to_json(orient="records")
+        n_tokens = self.estimate_tokens(matched_documents, documents_str)
+        if n_tokens is None or n_tokens > self.max_tokens:
+            # Count exactly, dropping documents until they fit
+            documents_str, matched_documents = super().format(matched_documents)
+            n_tokens = self.tokenizer.num_tokens(documents_str)
+        return documents_str, matched_documents, n_tokens
+
+    def format(self, matched_documents: pd.DataFrame) -> tuple[str, pd.DataFrame]:
+        documents_str, matched_documents, _ = self.format_with_count(matched_documents)
+        return documents_str, matched_documents
+
+
+class TokenBudgetDocumentAnswerer(DocumentAnswerer):
+    """DocumentAnswerer checking the prompt against prompt_formatter.max_tokens without tokenizing it.
+
+    The prompt's length is the documents' (see TokenCountedDocumentsFormatter) plus the prompt template's,
+    counted once. The prompt is only tokenized when this estimate doesn't fit.
+    """
+
+    @cached_property
+    def template_tokens(self) -> int:
+        """Number of tokens of the prompt without documents."""
+        return self.prompt_formatter.tokenizer.num_tokens(self._format(documents=""))
+
+    def _format(self, documents: str) -> str:
+        prompt_formatter = self.prompt_formatter
+        return prompt_formatter.formatter.format(
+            text_before_docs=prompt_formatter.text_before_docs,
+            documents=documents,
+            text_after_docs=prompt_formatter.text_after_docs,
+        )
+
+    def prepare_prompt(self, matched_documents: pd.DataFrame) -> str:
+        if not isinstance(self.documents_formatter, TokenCountedDocumentsFormatter):
+            return super().prepare_prompt(matched_documents)
+
+        documents_str, _, n_tokens = self.documents_formatter.format_with_count(
+            matched_documents
+        )
+        n_tokens += self.template_tokens + JOIN_TOKENS
+        if n_tokens > self.prompt_formatter.max_tokens:
+            # Might not fit, count exactly (PromptFormatter raises if it doesn't)
+            prompt = self.prompt_formatter.format(documents_str)
+            n_tokens = self.prompt_formatter.tokenizer.num_tokens(prompt)
+        else:
+            prompt = self._format(documents_str)
+
+        annotate(tokens=n_tokens)
+        return prompt
@@ -0,0 +1,257 @@
+import argparse
+import glob
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import threading
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+from buster.busterbot import Buster
+from buster.retriever import Retriever
+
+from embed_docs import embed_documents
+from manifest import get_manifest_path, load_manifest
+from metrics import instrument_retriever, span
+from retrievers import get_lexical_index_path, get_retriever
+from shards import CURRENT_NAME, Site, get_live_store_path
+
+logger = logging.getLogger(__name__)
+
+# Versions of the vector store are built in save_directory/stores/<version>/deeplake_store
+VERSIONS_DIR = "stores"
+
+
+class StoreValidationError(Exception):
+    pass
+
+
+def new_version_path(save_directory: str) -> str:
+    """Path of a new version of the store, versions sort by the time they were created."""
+    version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    return os.path.join(save_directory, VERSIONS_DIR, version, "deeplake_store")
+
+
+def copy_store(src: str, dst: str):
+    """Copy a store and its manifest, so that dst can be updated in place without touching src."""
+    # Without the locks of the processes reading src, which would make the copy read-only
+    shutil.copytree(src, dst, ignore=shutil.ignore_patterns("*.lock"))
+    if os.path.exists(get_manifest_path(src)):
+        shutil.copy2(get_manifest_path(src), get_manifest_path(dst))
+
+
+def delete_store(vector_store_path: str):
+    """Delete a store and the files next to it (manifest, lexical and ANN indexes)."""
+    shutil.rmtree(vector_store_path, ignore_errors=True)
+    for path in [
+        get_manifest_path(vector_store_path),
+        get_lexical_index_path(vector_store_path),
+    ]:
+        if os.path.exists(path):
+            os.remove(path)
+    # ANN indexes (see retrievers.ANNRetriever): a symlink to their versions, and a lock file
+    for path in glob.glob(glob.escape(os.path.normpath(vector_store_path)) + ".ann.*"):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+    # Versions are alone in their directory
+    version_dir = os.path.dirname(vector_store_path)
+    if os.path.basename(os.path.dirname(version_dir)) == VERSIONS_DIR:
+        shutil.rmtree(version_dir, ignore_errors=True)
+
+
+def build_store(site: Site, vector_store_path: str, output_format: str = "files"):
+    """Crawl and embed a site into vector_store_path, in a child process (see the __main__ block).
+
+    Scrapy's reactor can only run once per process, and the memory used by the build is returned once it exits.
+    """
+    command = [
+        sys.executable,
+        "-m",
+        "refresh",
+        site.url,
+        os.path.abspath(site.save_directory),
+        os.path.abspath(vector_store_path),
+        "--output-format",
+        output_format,
+    ]
+    if site.version is not None:
+        command += ["--target-version", site.version]
+    subprocess.run(command, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def validate_store(vector_store_path: str, retriever_cfg: dict) -> Retriever:
+    """Check that a freshly built store is complete and searchable, and return a retriever over it."""
+    from deeplake.core.vectorstore import VectorStore
+
+    manifest = load_manifest(vector_store_path)
+    if manifest is None or not manifest.get("chunk_ids"):
+        raise StoreValidationError(f"{vector_store_path} has no manifest or is empty.")
+
+    dataset = VectorStore(path=vector_store_path, read_only=True).dataset
+    if len(dataset) != len(manifest["chunk_ids"]):
+        raise StoreValidationError(
+            f"{vector_store_path} has {len(dataset)} rows, its manifest {len(manifest['chunk_ids'])} chunks."
+        )
+
+    # Searching for a document of the store must find it
+    retriever = get_retriever(**{**retriever_cfg, "path": vector_store_path})
+    matched_documents = retriever.get_topk_documents(
+        embedding=dataset.embedding[0].numpy(), top_k=1
+    )
+    if len(matched_documents) == 0:
+        raise StoreValidationError(f"Searching {vector_store_path} found nothing.")
+    return retriever
+
+
+def set_live_store(save_directory: str, vector_store_path: str):
+    """Atomically make vector_store_path the store served from save_directory."""
+    current_path = os.path.join(save_directory, CURRENT_NAME)
+    tmp_path = current_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(os.path.relpath(vector_store_path, save_directory))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, current_path)
+
+
+def collect_garbage(save_directory: str, keep: int = 1):
+    """Delete the stores of save_directory other than the live one and the keep versions that preceded it.
+
+    The previous versions are kept for the requests that were still reading them when they were swapped out.
+    """
+    live = os.path.normpath(get_live_store_path(save_directory))
+    versions_dir = os.path.join(save_directory, VERSIONS_DIR)
+    versions = sorted(os.listdir(versions_dir)) if os.path.isdir(versions_dir) else []
+    stores = [
+        os.path.normpath(os.path.join(versions_dir, version, "deeplake_store"))
+        for version in versions
+    ]
+    # The store from before versions were used (if any) is the oldest
+    legacy = os.path.normpath(os.path.join(save_directory, "deeplake_store"))
+    if os.path.isdir(legacy) or legacy == live:
+        stores.insert(0, legacy)
+    if live not in stores:
+        return
+
+    previous = stores[: stores.index(live)]
+    # Versions newer than the live one are left over from failed builds
+    stale = previous[: max(len(previous) - keep, 0)] + stores[stores.index(live) + 1 :]
+    for store in stale:
+        logger.info(f"Deleting old vector store {store}")
+        delete_store(store)
+
+
+def swap_retriever(buster: Buster, retriever: Retriever, vector_store_path: str):
+    """Make buster retrieve from retriever, over vector_store_path.
+
+    A single attribute assignment: requests that already retrieved their documents finish with the old one.
+    Cached answers (of a CachedBuster) are dropped, see caching.CachedBuster.
+    """
+    buster.retriever = instrument_retriever(retriever)
+    if hasattr(buster, "version_path"):
+        buster.version_path = get_manifest_path(vector_store_path)
+
+
+class StoreRefresher:
+    """Refreshes the vector stores of sites in a background thread, every interval seconds, while they are served.
+
+    Each refresh crawls the site again into a new version of its store, a copy of the live one updated in
+    place (so only changed pages get embedded). Once validated, it becomes the live store (see
+    get_live_store_path) and on_swap(site, vector_store_path, retriever) is called to serve it. Sites are
+    refreshed one at a time, so that at most one extra store is being built or loaded. The live store is
+    never modified, a failed refresh leaves it as it is.
+    """
+
+    def __init__(
+        self,
+        sites: list[Site],
+        interval: float,
+        on_swap: Callable[[Site, str, Retriever], None],
+        retriever_cfg: dict,
+        keep_versions: int = 1,
+        output_format: str = "files",
+    ):
+        self.sites = sites
+        self.interval = interval
+        self.on_swap = on_swap
+        self.retriever_cfg = retriever_cfg
+        self.keep_versions = keep_versions
+        self.output_format = output_format
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="store-refresher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            for site in self.sites:
+                if self._stop.is_set():
+                    return
+                try:
+                    self.refresh(site)
+                except Exception:
+                    logger.exception(f"Refreshing {site.name} failed. See traceback:")
+
+    def refresh(self, site: Site) -> Optional[str]:
+        """Build, validate and swap in a new version of the site's store, returns its path if the docs changed."""
+        live = site.vector_store_path
+        vector_store_path = new_version_path(site.save_directory)
+        logger.info(f"Refreshing {site.name} into {vector_store_path}...")
+
+        try:
+            with span("refresh"):
+                if os.path.isdir(live):
+                    copy_store(live, vector_store_path)
+                build_store(site, vector_store_path, self.output_format)
+
+            previous_manifest = load_manifest(live) or {}
+            if load_manifest(vector_store_path)["chunk_ids"] == previous_manifest.get(
+                "chunk_ids"
+            ):
+                logger.info(f"{site.name} didn't change.")
+                delete_store(vector_store_path)
+                return None
+
+            retriever = validate_store(vector_store_path, self.retriever_cfg)
+        except BaseException:
+            delete_store(vector_store_path)
+            raise
+
+        set_live_store(site.save_directory, vector_store_path)
+        self.on_swap(site, vector_store_path, retriever)
+        logger.info(f"Now serving {site.name} from {vector_store_path}")
+
+        collect_garbage(site.save_directory, keep=self.keep_versions)
+        return vector_store_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a version of a site's store.")
+    parser.add_argument("homepage_url")
+    parser.add_argument("save_directory")
+    parser.add_argument("vector_store_path")
+    parser.add_argument("--target-version")
+    parser.add_argument("--output-format", default="files")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    embed_documents(
+        homepage_url=args.homepage_url,
+        save_directory=args.save_directory,
+        target_version=args.target_version,
+        output_format=args.output_format,
+        vector_store_path=args.vector_store_path,
+    )
@@ -0,0 +1,391 @@
+import hashlib
+import logging
+import os
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from buster.retriever import DeepLakeRetriever as BaseDeepLakeRetriever
+from buster.retriever import Retriever
+
+from bm25 import BM25Index, identifiers
+from caching import CachedRetriever
+from documents_manager import chunk_id
+from manifest import get_manifest_path
+from vector_index import IVFIndex
+
+logger = logging.getLogger(__name__)
+
+METADATA_COLUMNS = ["source", "title", "url"]
+
+
+def load_vector_store(
+    path: str, with_embeddings: bool = True
+) -> tuple[pd.DataFrame, Optional[np.ndarray]]:
+    """Read all documents (content + metadata columns) and their embeddings from a DeepLake vector store."""
+    from deeplake.core.vectorstore import VectorStore
+
+    dataset = VectorStore(path=path, read_only=True).dataset
+    documents = pd.DataFrame(dataset.metadata.data()["value"])
+    documents["content"] = dataset.text.data()["value"]
+    if "id" in dataset.tensors:
+        documents["id"] = dataset.id.data()["value"]
+    embeddings = None
+    if with_embeddings:
+        embeddings = dataset.embedding.numpy().astype(np.float32)
+    return documents, embeddings
+
+
+def fingerprint(documents: pd.DataFrame) -> str:
+    """Identifies the contents of a store, to know when an index built on it is stale."""
+    sha = hashlib.sha256()
+    keys = documents.id if "id" in documents.columns else documents.content
+    for key in keys:
+        sha.update(key.encode("utf-8"))
+    return sha.hexdigest()
+
+
+def search_results_to_df(data: dict) -> pd.DataFrame:
+    """Matched documents from the results of a DeepLake search, with a column for each of their metadata."""
+    if len(data["score"]) == 0:
+        return pd.DataFrame()
+    matched_documents = pd.DataFrame(list(data["metadata"]))
+    matched_documents["content"] = data["text"]
+    matched_documents["similarity"] = data["score"]
+    for tensor in ["embedding", "id"]:
+        if tensor in data:
+            matched_documents[tensor] = list(data[tensor])
+    return matched_documents
+
+
+class DeepLakeRetriever(BaseDeepLakeRetriever):
+    """buster's DeepLakeRetriever, returning all the metadata of the documents (e.g. their token counts, n_tokens).
+
+    buster's only keeps their source, title and url.
+    """
+
+    def get_topk_documents(
+        self,
+        query: str = None,
+        embedding: np.ndarray = None,
+        sources: Optional[list[str]] = None,
+        top_k: int = None,
+        return_tensors: str = "*",
+    ) -> pd.DataFrame:
+        if self.use_tql:
+            return super().get_topk_documents(
+                query, embedding, sources, top_k, return_tensors
+            )
+
+        if query is not None:
+            query_embedding = self.get_embedding(query, model=self.embedding_model)
+        elif embedding is not None:
+            query_embedding = embedding
+        else:
+            raise ValueError("must provide either a query or an embedding")
+
+        filter = None
+        if sources:
+
+            def filter(x):
+                return x["metadata"].data()["value"]["source"] in sources
+
+        data = self.vector_store.search(
+            k=top_k,
+            embedding=query_embedding,
+            exec_option=self.exec_option,
+            return_tensors=return_tensors,
+            filter=filter,
+        )
+        return search_results_to_df(data)
+
+
+class ANNRetriever(Retriever):
+    """Retriever searching an in-process approximate nearest neighbor index built over a DeepLake store.
+
+    The index (see vector_index.IVFIndex) is built the first time the store is loaded and persisted next to it,
+    along with its vectors stored as storage_dtype. Vectors are memory-mapped from there, so serving processes
+    share them instead of each loading its own copy.
+    nprobe is the recall vs. latency knob: the number of lists scanned per query.
+    With quantized vectors (float16 or int8) and rescore=True, the exact float32 vectors are also kept (on disk)
+    to rescore the final candidates.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        nprobe: int = 8,
+        n_lists: Optional[int] = None,
+        storage_dtype: str = "float32",
+        rescore: bool = True,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.path = path
+        self.nprobe = nprobe
+        self.storage_dtype = storage_dtype
+        self.rescore = rescore
+
+        self.documents, _ = load_vector_store(path, with_embeddings=False)
+        self.index = self._load_or_build_index(n_lists)
+
+    @property
+    def index_path(self) -> str:
+        return f"{os.path.normpath(self.path)}.ann.{self.storage_dtype}"
+
+    def _load_or_build_index(self, n_lists: Optional[int]) -> IVFIndex:
+        store_fingerprint = fingerprint(self.documents)
+        keep_exact = self.rescore and self.storage_dtype != "float32"
+        if os.path.isdir(self.index_path):
+            index, extra = IVFIndex.load(self.index_path, mmap=True)
+            if str(extra.get("fingerprint")) != store_fingerprint:
+                logger.info("Vector store changed since the ANN index was built.")
+            elif keep_exact and index.storage.exact is None:
+                logger.info("ANN index was built without the vectors to rescore.")
+            else:
+                logger.info(f"Loaded ANN index from {self.index_path}")
+                return index
+
+        _, embeddings = load_vector_store(self.path)
+        index = IVFIndex.build(
+            embeddings,
+            n_lists=n_lists,
+            dtype=self.storage_dtype,
+            keep_exact=keep_exact,
+        )
+        index.save(self.index_path, fingerprint=np.array(store_fingerprint))
+        # Serve from the memory-mapped files rather than the copy built in memory
+        index, _ = IVFIndex.load(self.index_path, mmap=True)
+        return index
+
+    def get_documents(self, sources: Optional[list[str]] = None) -> pd.DataFrame:
+        """Get all current documents from a given source."""
+        if sources:
+            return self.documents[self.documents.source.isin(sources)]
+        return self.documents
+
+    def get_source_display_name(self, source: str) -> str:
+        raise NotImplementedError()
+
+    def get_topk_documents(
+        self,
+        query: str = None,
+        embedding: np.ndarray = None,
+        sources: Optional[list[str]] = None,
+        top_k: int = None,
+    ) -> pd.DataFrame:
+        """Get the topk documents matching a user's query.
+
+        If no matches are found, returns an empty dataframe."""
+        if query is not None:
+            query_embedding = self.get_embedding(query, model=self.embedding_model)
+        elif embedding is not None:
+            query_embedding = embedding
+        else:
+            raise ValueError("must provide either a query or an embedding")
+
+        if top_k is None:
+            top_k = self.top_k
+
+        # Documents from other sources get filtered out after the search, ask for more to compensate
+        k = top_k if not sources else top_k * 10
+        ids, scores = self.index.search(
+            np.asarray(query_embedding, dtype=np.float32), k=k, nprobe=self.nprobe
+        )
+
+        matched_documents = self.documents.iloc[ids].copy()
+        matched_documents["similarity"] = scores
+        matched_documents["embedding"] = list(self.index.vectors_by_id(ids))
+        if sources:
+            matched_documents = matched_documents[
+                matched_documents.source.isin(sources)
+            ]
+        return matched_documents.iloc[:top_k].reset_index(drop=True)
+
+
+def get_lexical_index_path(vector_store_path: str) -> str:
+    return os.path.normpath(vector_store_path) + ".bm25.npz"
+
+
+def build_lexical_index(
+    vector_store_path: str, documents: Optional[pd.DataFrame] = None
+) -> BM25Index:
+    """Build the BM25 index of a store's documents (titles and contents) and save it next to the store."""
+    if documents is None:
+        documents, _ = load_vector_store(vector_store_path, with_embeddings=False)
+    index = BM25Index.build(documents.title + "\n" + documents.content)
+
+    path = get_lexical_index_path(vector_store_path)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        index.save(f, fingerprint=np.array(fingerprint(documents)))
+    os.replace(tmp_path, path)
+    return index
+
+
+class HybridRetriever(Retriever):
+    """Retriever fusing a dense retriever's results with a local BM25 index, by reciprocal rank fusion.
+
+    Questions about exact identifiers (e.g. ExperimentClient.suggest) are often missed by embeddings alone.
+    Lexical matches are scored by their cosine similarity to the question like any other document, but
+    documents containing an identifier of the question are kept even if their similarity is below thresh.
+    The BM25 index is built at embedding time (see embed_docs), or when the retriever is loaded if it is stale.
+    """
+
+    # get_topk_documents needs the question's text along with its embedding
+    uses_query_text = True
+
+    def __init__(
+        self,
+        path: str,
+        dense_backend: str = "deeplake",
+        rrf_k: int = 60,
+        candidates_factor: int = 4,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.path = path
+        self.rrf_k = rrf_k
+        self.candidates_factor = candidates_factor
+        self.dense_retriever = RETRIEVERS[dense_backend](path=path, **kwargs)
+
+        from deeplake.core.vectorstore import VectorStore
+
+        self.dataset = VectorStore(path=path, read_only=True).dataset
+        self.documents, _ = load_vector_store(path, with_embeddings=False)
+        if "id" not in self.documents.columns:
+            self.documents["id"] = [
+                chunk_id(url, content)
+                for url, content in zip(self.documents.url, self.documents.content)
+            ]
+        self._positions = {id: i for i, id in enumerate(self.documents.id)}
+        self.lexical_index = self._load_or_build_lexical_index()
+
+    def _load_or_build_lexical_index(self) -> BM25Index:
+        path = get_lexical_index_path(self.path)
+        if os.path.exists(path):
+            index, extra = BM25Index.load(path)
+            if str(extra.get("fingerprint")) == fingerprint(self.documents):
+                logger.info(f"Loaded BM25 index from {path}")
+                return index
+            logger.info("Vector store changed since the BM25 index was built.")
+        return build_lexical_index(self.path, documents=self.documents)
+
+    def get_documents(self, sources: Optional[list[str]] = None) -> pd.DataFrame:
+        return self.dense_retriever.get_documents(sources)
+
+    def get_source_display_name(self, source: str) -> str:
+        return self.dense_retriever.get_source_display_name(source)
+
+    def lexical_search(
+        self, query: str, k: int, sources: Optional[list[str]] = None
+    ) -> pd.DataFrame:
+        """Top k documents by BM25 score, with their embeddings."""
+        mask = self.documents.source.isin(sources).to_numpy() if sources else None
+        positions, scores = self.lexical_index.search(query, k=k, mask=mask)
+        matched_documents = self.documents.iloc[positions].copy()
+        matched_documents["lexical_score"] = scores
+        matched_documents["embedding"] = [
+            self.dataset.embedding[int(i)].numpy().astype(np.float32) for i in positions
+        ]
+        return matched_documents.reset_index(drop=True)
+
+    def get_topk_documents(
+        self,
+        query: str = None,
+        embedding: np.ndarray = None,
+        sources: Optional[list[str]] = None,
+        top_k: int = None,
+    ) -> pd.DataFrame:
+        if embedding is not None:
+            query_embedding = embedding
+        elif query is not None:
+            query_embedding = self.get_embedding(query, model=self.embedding_model)
+        else:
+            raise ValueError("must provide either a query or an embedding")
+
+        if query is None:
+            # Without the question's text, there is nothing to match lexically
+            return self.dense_retriever.get_topk_documents(
+                embedding=query_embedding, sources=sources, top_k=top_k
+            )
+
+        if top_k is None:
+            top_k = self.top_k
+        k = top_k * self.candidates_factor
+
+        dense = self.dense_retriever.get_topk_documents(
+            embedding=query_embedding, sources=sources, top_k=k
+        )
+        lexical = self.lexical_search(query, k=k, sources=sources)
+        if dense.empty:
+            # Nothing matched (a bare DataFrame), only the lexical results are fused
+            dense = lexical.iloc[:0].drop(columns="lexical_score")
+        elif "id" not in dense.columns:
+            dense["id"] = [
+                chunk_id(url, content) for url, content in zip(dense.url, dense.content)
+            ]
+
+        # Reciprocal rank fusion
+        rrf_scores = {}
+        for results in [dense, lexical]:
+            for rank, id in enumerate(results.id):
+                rrf_scores[id] = rrf_scores.get(id, 0) + 1 / (self.rrf_k + rank + 1)
+
+        matched_documents = pd.concat([dense, lexical], ignore_index=True)
+        matched_documents = matched_documents.drop_duplicates("id", keep="first")
+        lexical_scores = dict(zip(lexical.id, lexical.lexical_score))
+        matched_documents["lexical_score"] = matched_documents.id.map(
+            lexical_scores
+        ).fillna(0)
+        matched_documents["rrf_score"] = matched_documents.id.map(rrf_scores)
+
+        # Lexical matches get the same similarity as dense ones, the cosine similarity to the question
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        matched_documents["similarity"] = [
+            float(
+                np.dot(e, query_embedding)
+                / (np.linalg.norm(e) * np.linalg.norm(query_embedding) + 1e-12)
+            )
+            for e in matched_documents.embedding
+        ]
+
+        # Documents containing one of the question's identifiers are kept past the threshold
+        query_identifiers = identifiers(query)
+        matched_documents["exact_match"] = [
+            any(identifier in content for identifier in query_identifiers)
+            for content in matched_documents.content
+        ]
+
+        matched_documents = matched_documents.sort_values("rrf_score", ascending=False)
+        return matched_documents.iloc[:top_k].reset_index(drop=True)
+
+    def threshold_documents(self, matched_documents, thresh: float) -> pd.DataFrame:
+        return matched_documents[
+            (matched_documents.similarity > thresh) | matched_documents.exact_match
+        ]
+
+
+# Retriever backends selectable with retriever_cfg["backend"]
+RETRIEVERS = {
+    "deeplake": DeepLakeRetriever,
+    "ann": ANNRetriever,
+    "hybrid": HybridRetriever,
+}
+
+
+def get_retriever(
+    backend: str = "deeplake", cache: Optional[dict] = None, **retriever_cfg
+) -> Retriever:
+    """Instantiate the retriever backend, wrapped in a CachedRetriever if cache (its kwargs) is set."""
+    if backend not in RETRIEVERS:
+        raise ValueError(
+            f"Unknown retriever {backend=}, must be one of {list(RETRIEVERS)}"
+        )
+    retriever = RETRIEVERS[backend](**retriever_cfg)
+
+    if cache is not None:
+        # Cached results are dropped when the store is rebuilt, which rewrites its manifest
+        version_path = get_manifest_path(retriever_cfg["path"])
+        retriever = CachedRetriever(retriever, version_path=version_path, **cache)
+    return retriever
@@ -0,0 +1,210 @@
+import gzip
+import hashlib
+import json
+import logging
+import mmap
+import os
+from typing import Iterator, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_NAME = "pages.archive"
+
+
+def default_codec() -> str:
+    return "zstd" if zstandard is not None else "gzip"
+
+
+def compress(body: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    if codec == "gzip":
+        # mtime=0 so that the same page always compresses to the same bytes
+        return gzip.compress(body, compresslevel=6, mtime=0)
+    raise ValueError(f"Unknown codec {codec!r}")
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Install zstandard to read zstd compressed archives.")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == "gzip":
+        return gzip.decompress(data)
+    raise ValueError(f"Unknown codec {codec!r}")
+
+
+def get_archive_path(save_directory: str) -> str:
+    """The archive of the pages crawled into save_directory, keyed by their path relative to it."""
+    return os.path.join(save_directory, ARCHIVE_NAME)
+
+
+def key_prefix(archive_path: str, root_dir: str) -> str:
+    """Prefix of the keys of the pages under root_dir, e.g. 'orion.readthedocs.io/en/stable/'."""
+    prefix = os.path.relpath(root_dir, os.path.dirname(archive_path) or ".")
+    if prefix == ".":
+        return ""
+    return prefix.replace(os.sep, "/") + "/"
+
+
+class PageArchive:
+    """Crawled pages stored as compressed records appended to a single file, instead of one file per page.
+
+    The records are in path, and their offsets in an index next to it (path + '.index', one json line per
+    record). Both files are only ever appended to: a page crawled again gets a new record, and the last
+    one wins. Readers map the archive in memory and pick up records appended after they were opened.
+    Copying both files (or a compact() of them) is enough to ship a snapshot of a crawl.
+    """
+
+    def __init__(self, path: str, writable: bool = False, codec: Optional[str] = None):
+        self.path = str(path)
+        self.index_path = self.path + ".index"
+        self.writable = writable
+        self.codec = codec or default_codec()
+        # key -> {"offset", "size", "codec", "hash", "url"} of its last record
+        self.entries: dict[str, dict] = {}
+        self._index_position = 0
+        self._mmap: Optional[mmap.mmap] = None
+        self._data = None
+        self._index = None
+
+        if writable:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._data = open(self.path, "ab")
+        self.refresh()
+        if writable:
+            # Drop the records of an interrupted write, not in the index
+            self._data.truncate(self._end_of_records())
+            self._data.seek(0, os.SEEK_END)
+            self._index = open(self.index_path, "a")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _end_of_records(self) -> int:
+        return max(
+            (entry["offset"] + entry["size"] for entry in self.entries.values()),
+            default=0,
+        )
+
+    def refresh(self):
+        """Load the index lines appended since the last refresh, e.g. by a spider still crawling."""
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "rb") as f:
+            f.seek(self._index_position)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Still being written, or torn by a crash
+                    break
+                self._index_position += len(line)
+                entry = json.loads(line)
+                self.entries[entry.pop("key")] = entry
+
+    def append(self, key: str, body: bytes, url: Optional[str] = None):
+        """Add a record for the page at key, replacing the previous one (if any)."""
+        if not self.writable:
+            raise RuntimeError(f"{self.path} was opened read-only.")
+        data = compress(body, self.codec)
+        offset = self._data.tell()
+        self._data.write(data)
+        # The record must be readable before its index entry is
+        self._data.flush()
+
+        entry = {
+            "offset": offset,
+            "size": len(data),
+            "codec": self.codec,
+            "hash": hashlib.sha256(body).hexdigest(),
+            "url": url,
+        }
+        self._index.write(json.dumps({"key": key, **entry}) + "\n")
+        self._index.flush()
+        self.entries[key] = entry
+
+    def read(self, key: str) -> bytes:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.refresh()
+            entry = self.entries[key]
+
+        end = entry["offset"] + entry["size"]
+        if self._mmap is None or len(self._mmap) < end:
+            self._remap()
+        return decompress(self._mmap[entry["offset"] : end], entry["codec"])
+
+    def _remap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        with open(self.path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def keys(self, prefix: str = "") -> list[str]:
+        """Keys starting with prefix, in the order of their records so that reading them is sequential."""
+        return sorted(
+            (key for key in self.entries if key.startswith(prefix)),
+            key=lambda key: self.entries[key]["offset"],
+        )
+
+    def items(self, prefix: str = "") -> Iterator[tuple[str, bytes]]:
+        for key in self.keys(prefix):
+            yield key, self.read(key)
+
+    def hashes(self, prefix: str = "") -> dict[str, str]:
+        """sha256 of the pages starting with prefix, keyed by their path relative to prefix."""
+        return {
+            key[len(prefix) :]: self.entries[key]["hash"]
+            for key in sorted(self.keys(prefix))
+        }
+
+    def garbage_ratio(self) -> float:
+        """Fraction of the archive taken by records that were replaced since."""
+        end = self._end_of_records()
+        if end == 0:
+            return 0.0
+        live = sum(entry["size"] for entry in self.entries.values())
+        return 1 - live / end
+
+    def compact(self, path: Optional[str] = None):
+        """Write only the last record of each page to path, or in place if path is None.
+
+        Not safe while the archive is being crawled into or read from other processes.
+        """
+        target = path or self.path
+        tmp_path = target + ".tmp"
+        for tmp in [tmp_path, tmp_path + ".index"]:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        with PageArchive(tmp_path, writable=True, codec=self.codec) as compacted:
+            for key in self.keys():
+                compacted.append(key, self.read(key), url=self.entries[key]["url"])
+
+        if path is None:
+            self.close()
+        os.replace(tmp_path, target)
+        os.replace(tmp_path + ".index", target + ".index")
+        logger.info(f"Compacted {self.path} into {target}")
+
+        if path is None:
+            self.__init__(self.path, writable=self.writable, codec=self.codec)
+
+    def close(self):
+        for f in [self._mmap, self._data, self._index]:
+            if f is not None:
+                f.close()
+        self._mmap = self._data = self._index = None
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def hash_content(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()
+
+
+class CrawlState:
+    """Per-URL ETag, Last-Modified and content hash kept on disk between crawls.
+
+    Used to send conditional requests so that unchanged pages are not downloaded again.
+    Each entry also records whether the page changed during the last crawl.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.pages: dict[str, dict] = {}
+        # URLs whose content changed during the current crawl
+        self.changed: set[str] = set()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    self.pages = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                logger.warning(
+                    f"Could not read crawl state {self.path}, starting over."
+                )
+
+    def __contains__(self, url: str) -> bool:
+        return url in self.pages
+
+    def get(self, url: str) -> Optional[dict]:
+        return self.pages.get(url)
+
+    def conditional_headers(self, url: str) -> dict:
+        """Headers for a conditional GET of a page we already crawled."""
+        page = self.pages.get(url)
+        if page is None:
+            return {}
+
+        headers = {}
+        if page.get("etag"):
+            headers["If-None-Match"] = page["etag"]
+        if page.get("last_modified"):
+            headers["If-Modified-Since"] = page["last_modified"]
+        return headers
+
+    def update(
+        self,
+        url: str,
+        body: bytes,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> bool:
+        """Record a freshly downloaded page. Returns True if its content changed."""
+        content_hash = hash_content(body)
+        previous = self.pages.get(url, {})
+        changed = previous.get("hash") != content_hash
+
+        self.pages[url] = {
+            "etag": etag,
+            "last_modified": last_modified,
+            "hash": content_hash,
+            "status": "changed" if changed else "unchanged",
+            "crawled_at": datetime.now(timezone.utc).isoformat(),
+        }
+        if changed:
+            self.changed.add(url)
+        return changed
+
+    def mark_unchanged(self, url: str):
+        """Record a page for which the server answered 304 Not Modified."""
+        page = self.pages.setdefault(url, {})
+        page["status"] = "unchanged"
+        page["crawled_at"] = datetime.now(timezone.utc).isoformat()
+
+    def changed_urls(self) -> list[str]:
+        """URLs whose content changed (or were new) during the current crawl."""
+        return sorted(self.changed)
+
+    def save(self):
+        """Atomically write the state to disk."""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.pages, f, indent=2)
+        os.replace(tmp_path, self.path)
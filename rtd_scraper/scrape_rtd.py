@@ -1,6 +1,7 @@
 import logging
 import os
 
+from scrapy import signals
 from scrapy.crawler import CrawlerProcess
 from scrapy.utils.project import get_project_settings
 
@@ -12,13 +13,46 @@ for name in logging.root.manager.loggerDict:
     logger.setLevel(logging.INFO)
 
 
-def run_spider(homepage_url, save_directory, target_version=None):
-    process = CrawlerProcess(settings=get_project_settings())
+def run_spider(
+    homepage_url,
+    save_directory,
+    target_version=None,
+    incremental=False,
+    on_page=None,
+    seed_from_index=None,
+    output_format="files",
+):
+    """Crawl the docs into save_directory.
+
+    With incremental=True, pages already crawled are requested conditionally (ETag/Last-Modified)
+    and only pages that changed get downloaded and rewritten.
+    on_page is called with {"url": ..., "filepath": ...} as soon as each page is saved.
+    With seed_from_index=True, the pages listed in the site's objects.inv and sitemap.xml are crawled directly,
+    links are followed only when there is no objects.inv (see DocsSpider). Defaults to the SEED_FROM_INDEX setting.
+    With output_format="archive", pages are appended to save_directory/pages.archive instead of written as files.
+    """
+    # scrapy.cfg isn't found when running from the root of the repo, point scrapy to our settings directly
+    os.environ.setdefault("SCRAPY_SETTINGS_MODULE", "rtd_scraper.tutorial.settings")
+    settings = get_project_settings()
+    if seed_from_index is None:
+        seed_from_index = settings.getbool("SEED_FROM_INDEX", True)
+    process = CrawlerProcess(settings=settings)
+    crawler = process.create_crawler(DocsSpider)
+
+    def page_scraped(item, response, spider):
+        on_page(item)
+
+    if on_page is not None:
+        crawler.signals.connect(page_scraped, signal=signals.item_scraped)
+
     process.crawl(
-        DocsSpider,
+        crawler,
         homepage_url=homepage_url,
         save_dir=save_directory,
         target_version=target_version,
+        incremental=incremental,
+        seed_from_index=seed_from_index,
+        output_format=output_format,
     )
 
     # Start the crawling process
@@ -0,0 +1,58 @@
+import re
+import zlib
+from urllib.parse import urljoin
+
+import lxml.etree
+from scrapy.utils.sitemap import Sitemap
+
+# name domain:role priority uri display-name, as parsed by sphinx.util.inventory
+INVENTORY_LINE_PATTERN = re.compile(r"(.+?)\s+(\S+)\s+(-?\d+)\s+?(\S*)\s+(.*)")
+
+
+def parse_sitemap(body: bytes) -> tuple[list[str], list[str]]:
+    """Parse a sitemap.xml, returns its page urls (with their alternate versions) and the sitemaps it links to.
+
+    Anything that isn't a sitemap (e.g. an html error page) has no urls.
+    """
+    try:
+        sitemap = Sitemap(body)
+    except (lxml.etree.XMLSyntaxError, StopIteration):
+        return [], []
+
+    if sitemap.type not in ("urlset", "sitemapindex"):
+        return [], []
+
+    urls = []
+    for entry in sitemap:
+        urls.append(entry["loc"])
+        urls.extend(entry.get("alternate", []))
+
+    if sitemap.type == "sitemapindex":
+        return [], urls
+    return urls, []
+
+
+def parse_objects_inv(data: bytes, base_url: str) -> list[str]:
+    """Urls of all the pages of a Sphinx site, from its objects.inv inventory at base_url.
+
+    Every document of the site is listed in the inventory, as a std:doc entry.
+    """
+    # 4 header lines, followed by the zlib compressed entries
+    lines = data.split(b"\n", 4)
+    if len(lines) < 5 or not lines[0].startswith(b"# Sphinx inventory version 2"):
+        raise ValueError("Not a Sphinx inventory (version 2)")
+    entries = zlib.decompress(lines[4]).decode("utf-8")
+
+    urls = []
+    for line in entries.splitlines():
+        match = INVENTORY_LINE_PATTERN.match(line.rstrip())
+        if match is None:
+            continue
+        name, type, _, uri, _ = match.groups()
+        if type != "std:doc":
+            continue
+        # '$' is shorthand for the entry's name
+        if uri.endswith("$"):
+            uri = uri[:-1] + name
+        urls.append(urljoin(base_url, uri))
+    return urls
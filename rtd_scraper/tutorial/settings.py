@@ -7,6 +7,8 @@
 #     https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 #     https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import os
+
 from scrapy.utils.log import configure_logging
 
 # Disable default Scrapy log settings.
@@ -29,21 +31,25 @@ LOG_LEVEL = "INFO"
 ROBOTSTXT_OBEY = True
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
-# CONCURRENT_REQUESTS = 32
+CONCURRENT_REQUESTS = 32
 
 # Configure a delay for requests for the same website (default: 0)
 # See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
 # See also autothrottle settings and docs
-# DOWNLOAD_DELAY = 3
+DOWNLOAD_DELAY = 0
 # The download delay setting will honor only one of:
-# CONCURRENT_REQUESTS_PER_DOMAIN = 16
+# A docs site is a single domain, this is the crawl's actual concurrency
+CONCURRENT_REQUESTS_PER_DOMAIN = int(
+    os.getenv("CRAWL_CONCURRENT_REQUESTS_PER_DOMAIN", 16)
+)
 # CONCURRENT_REQUESTS_PER_IP = 16
+DOWNLOAD_TIMEOUT = 30
 
 # Disable cookies (enabled by default)
-# COOKIES_ENABLED = False
+COOKIES_ENABLED = False
 
 # Disable Telnet Console (enabled by default)
-# TELNETCONSOLE_ENABLED = False
+TELNETCONSOLE_ENABLED = False
 
 # Override the default request headers:
 # DEFAULT_REQUEST_HEADERS = {
@@ -77,24 +83,35 @@ ROBOTSTXT_OBEY = True
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
-# AUTOTHROTTLE_ENABLED = True
+# Requests are sent as fast as the server answers them, and slowed down when its latency goes up
+_autothrottle = os.getenv("CRAWL_AUTOTHROTTLE", "true")
+AUTOTHROTTLE_ENABLED = _autothrottle.lower() in ["1", "true", "yes"]
 # The initial download delay
-# AUTOTHROTTLE_START_DELAY = 5
+AUTOTHROTTLE_START_DELAY = 0.1
 # The maximum download delay to be set in case of high latencies
-# AUTOTHROTTLE_MAX_DELAY = 60
+AUTOTHROTTLE_MAX_DELAY = 10
 # The average number of requests Scrapy should be sending in parallel to
 # each remote server
-# AUTOTHROTTLE_TARGET_CONCURRENCY = 1.0
+AUTOTHROTTLE_TARGET_CONCURRENCY = CONCURRENT_REQUESTS_PER_DOMAIN / 2
 # Enable showing throttling stats for every response received:
 # AUTOTHROTTLE_DEBUG = False
 
+# Crawl the pages listed in the site's objects.inv and sitemap.xml instead of discovering them by following links,
+# set CRAWL_FOLLOW_LINKS to always follow links (see DocsSpider)
+_follow_links = os.getenv("CRAWL_FOLLOW_LINKS", "false")
+SEED_FROM_INDEX = _follow_links.lower() not in ["1", "true", "yes"]
+
 # Enable and configure HTTP caching (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
-# HTTPCACHE_ENABLED = True
-# HTTPCACHE_EXPIRATION_SECS = 0
-# HTTPCACHE_DIR = "httpcache"
-# HTTPCACHE_IGNORE_HTTP_CODES = []
-# HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
+# Set CRAWL_HTTPCACHE_DIR to keep every response on disk and replay it on the next crawls instead of downloading it
+HTTPCACHE_ENABLED = os.getenv("CRAWL_HTTPCACHE_DIR") is not None
+HTTPCACHE_DIR = os.getenv("CRAWL_HTTPCACHE_DIR", "httpcache")
+# Cached responses expire after this many seconds, 0 to replay them forever
+HTTPCACHE_EXPIRATION_SECS = int(os.getenv("CRAWL_HTTPCACHE_EXPIRATION_SECS", 0))
+# Don't cache transient errors, nor 304s of incremental crawls (they have no body)
+HTTPCACHE_IGNORE_HTTP_CODES = [304, 429, 500, 502, 503, 504]
+HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
+HTTPCACHE_GZIP = True
 
 # Set settings whose default value is deprecated to a future-proof value
 REQUEST_FINGERPRINTER_IMPLEMENTATION = "2.7"
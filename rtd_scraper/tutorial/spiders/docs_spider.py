@@ -1,8 +1,16 @@
 import logging
+import posixpath
+import re
+import zlib
 from pathlib import Path
-from urllib.parse import urlparse
+from urllib.parse import urljoin, urlparse
 
 import scrapy
+from scrapy.http import HtmlResponse
+
+from rtd_scraper.archive import PageArchive, get_archive_path
+from rtd_scraper.crawl_state import CrawlState
+from rtd_scraper.seeds import parse_objects_inv, parse_sitemap
 
 logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.ERROR)
 
@@ -19,17 +27,18 @@ def extract_domain(url):
     Returns:
     - str: The domain (with subdomains) extracted from the URL.
            For example, 'www.example.com' for the URL 'https://www.example.com/path/to/something'.
+           The port is left out, e.g. 'localhost' for 'http://localhost:8000/'.
 
     """
     parsed_uri = urlparse(url)
-    # The netloc attribute will contain the domain name
-    domain = parsed_uri.netloc
+    # The hostname attribute will contain the domain name, without the port (scrapy's allowed_domains can't have one)
+    domain = parsed_uri.hostname
     return domain
 
 
 def sanitize_url(url: str) -> str:
-    """Adds https:// and trailing backslash."""
-    if not url.startswith("https://"):
+    """Adds https:// (unless the url is http://) and trailing backslash."""
+    if not url.startswith(("https://", "http://")):
         url = "https://" + url
 
     if not url.endswith("/"):
@@ -37,7 +46,44 @@ def sanitize_url(url: str) -> str:
     return url
 
 
+# Sphinx pages that aren't documentation content: page sources, static files, search and indices
+EXCLUDED_PATH_PATTERN = re.compile(
+    r"/(_sources|_static|_images|_downloads|_modules)/"
+    r"|/(search|genindex|py-modindex|objects\.inv)(\.html)?$"
+)
+
+
+def canonicalize_url(url: str) -> str:
+    """Drop the fragment and a trailing index.html, so that each page is requested once.
+
+    e.g. 'https://orion.readthedocs.io/en/stable/index.html#install' -> 'https://orion.readthedocs.io/en/stable/'
+    """
+    parsed_uri = urlparse(url)
+    path = parsed_uri.path
+    if path.endswith("/index.html"):
+        path = path[: -len("index.html")]
+    return parsed_uri._replace(path=path, fragment="").geturl()
+
+
+def is_content_url(url: str) -> bool:
+    """Whether a url can be a page of documentation, i.e. an html page that isn't excluded by EXCLUDED_PATH_PATTERN."""
+    parsed_uri = urlparse(url)
+    if parsed_uri.scheme not in ("http", "https"):
+        return False
+    if EXCLUDED_PATH_PATTERN.search(parsed_uri.path):
+        return False
+    extension = posixpath.splitext(parsed_uri.path)[1].lower()
+    return extension in ("", ".html", ".htm")
+
+
 class DocsSpider(scrapy.Spider):
+    """Crawl the pages of a docs site.
+
+    With seed_from_index=True, the pages to crawl are first looked up in the site's objects.inv (Sphinx's
+    inventory, which lists every page) and sitemap.xml, and fetched all at once. Links are only followed if
+    there is no objects.inv, i.e. if the list of pages may be incomplete.
+    """
+
     name = "docs"
 
     def __init__(
@@ -45,6 +91,10 @@ class DocsSpider(scrapy.Spider):
         homepage_url: str,
         save_dir="outputs/",
         target_version=None,
+        incremental=False,
+        state_path=None,
+        seed_from_index=True,
+        output_format="files",
         *args,
         **kwargs,
     ):
@@ -53,34 +103,242 @@ class DocsSpider(scrapy.Spider):
         homepage_url = sanitize_url(homepage_url)
 
         self.allowed_domains = [extract_domain(homepage_url)]
-        self.start_urls = [homepage_url]
+        self.start_urls = [canonicalize_url(homepage_url)]
+        # Urls already scheduled, most links point to pages every other page links to as well
+        self.seen_urls = set(self.start_urls)
         self.base_dir = Path(save_dir)
         self.target_version = target_version
 
-    def parse(self, response):
-        parsed_uri = urlparse(response.url)
+        self.seed_from_index = seed_from_index
+        self.seed_urls = set()
+        self.pending_seed_requests = 0
+        # Whether the seeds come from an objects.inv, i.e. are all the pages of the site
+        self.seeds_complete = False
+
+        if output_format not in ("files", "archive"):
+            raise ValueError(f"Unknown output format {output_format!r}")
+        self.archive = None
+        if output_format == "archive":
+            self.archive = PageArchive(get_archive_path(save_dir), writable=True)
+
+        # In incremental mode, pages are requested conditionally and 304s are read back from disk
+        self.crawl_state = None
+        if incremental:
+            if state_path is None:
+                state_path = (
+                    self.base_dir / f"{self.allowed_domains[0]}.crawl_state.json"
+                )
+            self.crawl_state = CrawlState(state_path)
+
+    async def start(self):
+        # Scrapy >= 2.13 starts from here instead of start_requests
+        for request in self.start_requests():
+            yield request
+
+    def start_requests(self):
+        if not self.seed_from_index:
+            for url in self.start_urls:
+                yield self.make_request(url)
+            return
+
+        # All counted as pending before any of them gets a response
+        requests = [
+            self.make_seed_request(
+                url,
+                self.parse_objects_inv
+                if url.endswith("objects.inv")
+                else self.parse_sitemap,
+            )
+            for url in self.index_urls()
+        ]
+        yield from requests
+
+    def index_urls(self) -> list[str]:
+        """Where the site may publish its sitemap.xml and objects.inv."""
+        homepage_url = self.start_urls[0]
+        version_url = homepage_url
+        if self.target_version and self.target_version.strip("/") not in homepage_url:
+            version_url = urljoin(homepage_url, self.target_version.strip("/") + "/")
+
+        urls = [
+            urljoin(homepage_url, "/sitemap.xml"),  # readthedocs' sitemap
+            homepage_url + "sitemap.xml",  # sphinx-sitemap's
+            version_url + "sitemap.xml",
+            version_url + "objects.inv",
+        ]
+        return list(dict.fromkeys(urls))
+
+    def make_seed_request(self, url, callback):
+        self.pending_seed_requests += 1
+        return scrapy.Request(
+            url, callback=callback, errback=self.seed_request_failed, dont_filter=True
+        )
+
+    def make_request(self, url, dont_filter=False, follow_links=True):
+        cb_kwargs = {"follow_links": follow_links}
+        if self.crawl_state is None:
+            return scrapy.Request(
+                url, callback=self.parse, dont_filter=dont_filter, cb_kwargs=cb_kwargs
+            )
+
+        return scrapy.Request(
+            url,
+            callback=self.parse,
+            headers=self.crawl_state.conditional_headers(url),
+            meta={"handle_httpstatus_list": [304]},
+            dont_filter=dont_filter,
+            cb_kwargs=cb_kwargs,
+        )
+
+    def should_follow(self, url) -> bool:
+        """Whether url is a documentation page of the site, in the target version if one was specified."""
+        if not is_content_url(url):
+            return False
+        domain = urlparse(url).hostname or ""
+        if domain != self.allowed_domains[0] and not domain.endswith(
+            "." + self.allowed_domains[0]
+        ):
+            return False
+        # If a version was specified, check to see if it's the correct version from url
+        return not self.target_version or self.target_version in url
+
+    def parse_sitemap(self, response):
+        urls, sitemaps = parse_sitemap(response.body)
+        # A sitemap index links to other sitemaps
+        for url in sitemaps:
+            if urlparse(url).hostname == self.allowed_domains[0]:
+                yield self.make_seed_request(url, self.parse_sitemap)
+        self.add_seeds(urls)
+        yield from self.seed_request_done()
+
+    def parse_objects_inv(self, response):
+        try:
+            urls = parse_objects_inv(response.body, base_url=response.url)
+        except (ValueError, zlib.error):
+            self.logger.warning(f"Could not read the inventory at {response.url}")
+            urls = []
+        if urls:
+            self.seeds_complete = True
+        self.add_seeds(urls)
+        yield from self.seed_request_done()
+
+    def seed_request_failed(self, failure):
+        # Most sites don't have all of sitemap.xml and objects.inv
+        self.logger.debug(f"No index at {failure.request.url}: {failure.value}")
+        yield from self.seed_request_done()
+
+    def add_seeds(self, urls: list[str]):
+        for url in urls:
+            url = canonicalize_url(url)
+            if self.should_follow(url):
+                self.seed_urls.add(url)
+
+    def seed_request_done(self):
+        """Once all the indexes are read, request all the pages they list (or start following links from the homepage)."""
+        self.pending_seed_requests -= 1
+        if self.pending_seed_requests > 0:
+            return
+
+        # Pages missing from a sitemap can only be found by following links
+        follow_links = not self.seeds_complete
+        urls = sorted(self.seed_urls | set(self.start_urls))
+        self.logger.info(
+            f"Found {len(self.seed_urls)} pages in the site's indexes, "
+            + ("following links." if follow_links else "not following links.")
+        )
+        self.seen_urls.update(urls)
+        for url in urls:
+            yield self.make_request(url, follow_links=follow_links)
+
+    def get_filepath(self, url) -> Path:
+        parsed_uri = urlparse(url)
         # Create a Path from the parsed URL. If it ends with '/', we add 'index.html' as the filename.
         if parsed_uri.path.endswith("/"):
-            filepath = (
+            return (
                 self.base_dir
                 / parsed_uri.netloc
                 / parsed_uri.path.strip("/")
                 / "index.html"
             )
-        else:
-            filepath = self.base_dir / parsed_uri.netloc / parsed_uri.path.strip("/")
-        filepath.parent.mkdir(parents=True, exist_ok=True)
+        return self.base_dir / parsed_uri.netloc / parsed_uri.path.strip("/")
+
+    def archive_key(self, filepath: Path) -> str:
+        return filepath.relative_to(self.base_dir).as_posix()
+
+    def page_exists(self, filepath: Path) -> bool:
+        if self.archive is not None:
+            return self.archive_key(filepath) in self.archive
+        return filepath.exists()
 
+    def read_page(self, filepath: Path) -> bytes:
+        if self.archive is not None:
+            return self.archive.read(self.archive_key(filepath))
+        return filepath.read_bytes()
+
+    def write_page(self, filepath: Path, body: bytes, url: str):
+        if self.archive is not None:
+            self.archive.append(self.archive_key(filepath), body, url=url)
+            return
+        filepath.parent.mkdir(parents=True, exist_ok=True)
         with open(filepath, "wb") as f:
-            f.write(response.body)
+            f.write(body)
+
+    def parse(self, response, follow_links=True):
+        filepath = self.get_filepath(response.url)
+
+        if response.status == 304:
+            if not self.page_exists(filepath):
+                # We lost our copy of the page, fetch it again unconditionally
+                yield scrapy.Request(
+                    response.url,
+                    callback=self.parse,
+                    dont_filter=True,
+                    cb_kwargs={"follow_links": follow_links},
+                )
+                return
+
+            self.crawl_state.mark_unchanged(response.url)
+            if follow_links:
+                # Page is unchanged, use the copy on disk to keep following its links
+                response = response.replace(
+                    cls=HtmlResponse, status=200, body=self.read_page(filepath)
+                )
+        else:
+            changed = True
+            if self.crawl_state is not None:
+                changed = self.crawl_state.update(
+                    response.url,
+                    body=response.body,
+                    etag=response.headers.get("ETag", b"").decode() or None,
+                    last_modified=response.headers.get("Last-Modified", b"").decode()
+                    or None,
+                )
+
+            if changed or not self.page_exists(filepath):
+                self.write_page(filepath, response.body, url=response.url)
+
+        # Let downstream stages (e.g. parsing) know the page is on disk (or in the archive, at the same path)
+        yield {"url": response.url, "filepath": str(filepath)}
+
+        if not follow_links:
+            return
 
         # Follow links to other documentation pages only if they contain the target version in the full URL
         for href in response.css("a::attr(href)").getall():
-            if self.target_version:
-                # A version was specified, check to see if it's the correct version from url
-                full_url = response.urljoin(href)  # Expand href to a full URL
-                if self.target_version in full_url:
-                    yield response.follow(href, self.parse)
-            else:
-                # no version specified, follow all links
-                yield response.follow(href, self.parse)
+            # Expand href to a full URL
+            full_url = canonicalize_url(response.urljoin(href))
+            if full_url in self.seen_urls:
+                continue
+            self.seen_urls.add(full_url)
+
+            if self.should_follow(full_url):
+                yield self.make_request(full_url)
+
+    def closed(self, reason):
+        if self.archive is not None:
+            self.archive.close()
+        if self.crawl_state is not None:
+            self.crawl_state.save()
+            self.logger.info(
+                f"Crawl finished, {len(self.crawl_state.changed_urls())} pages changed."
+            )
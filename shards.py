@@ -0,0 +1,171 @@
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Generic, Optional, TypeVar
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+# Names the live vector store of a save_directory, relative to it, see refresh.StoreRefresher
+CURRENT_NAME = "CURRENT"
+
+
+def get_live_store_path(save_directory: str) -> str:
+    """The vector store served from save_directory: the one named in its CURRENT file, else deeplake_store."""
+    try:
+        with open(os.path.join(save_directory, CURRENT_NAME)) as f:
+            return os.path.join(save_directory, f.read().strip())
+    except FileNotFoundError:
+        return os.path.join(save_directory, "deeplake_store")
+
+
+@dataclass
+class Site:
+    """A (site, version) pair served from its own vector store, in save_directory (see get_live_store_path)."""
+
+    url: str
+    version: Optional[str]
+    save_directory: str
+
+    @property
+    def name(self) -> str:
+        return site_name(self.url, self.version)
+
+    @property
+    def vector_store_path(self) -> str:
+        return get_live_store_path(self.save_directory)
+
+
+def site_name(url: str, version: Optional[str] = None) -> str:
+    """Readable identifier of a site, e.g. 'orion.readthedocs.io/en/v0.2.7'."""
+    parsed_url = urlparse(url if "://" in url else "https://" + url)
+    name = parsed_url.netloc + parsed_url.path.rstrip("/")
+    if version:
+        name += "/" + version.strip("/")
+    return name
+
+
+def slugify(name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9.]+", "-", name).strip("-")
+
+
+def parse_sites(spec: str, save_root: str) -> list[Site]:
+    """Parse sites given as 'url[@version],...' e.g. 'https://orion.readthedocs.io@en/v0.2.7,buster.readthedocs.io'.
+
+    Each site gets its own directory under save_root.
+    """
+    sites = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        url, _, version = entry.partition("@")
+        version = version.strip() or None
+        save_directory = os.path.join(save_root, slugify(site_name(url, version)))
+        sites.append(
+            Site(url=url.strip(), version=version, save_directory=save_directory)
+        )
+    return sites
+
+
+def directory_size(path: str) -> int:
+    """Total size in bytes of the files in a directory."""
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            if not os.path.islink(filepath):
+                size += os.path.getsize(filepath)
+    return size
+
+
+class ShardManager(Generic[T]):
+    """Serves many sites from one process, each from its own shard (e.g. a buster over its vector store).
+
+    Shards are loaded with load_fn the first time they are asked for, and the least recently used ones are
+    evicted once the loaded shards exceed memory_budget bytes. A shard's memory is estimated from the size of
+    its vector store on disk.
+    """
+
+    def __init__(
+        self,
+        sites: list[Site],
+        load_fn: Callable[[Site], T],
+        memory_budget: Optional[int] = None,
+    ):
+        self.sites = {site.name: site for site in sites}
+        self.load_fn = load_fn
+        self.memory_budget = memory_budget
+        self._shards: OrderedDict[str, tuple[T, int]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {name: threading.Lock() for name in self.sites}
+
+    @property
+    def names(self) -> list[str]:
+        return list(self.sites)
+
+    @property
+    def loaded(self) -> list[str]:
+        return list(self._shards)
+
+    @property
+    def memory_used(self) -> int:
+        return sum(size for _, size in self._shards.values())
+
+    def get(self, name: str) -> T:
+        """Get the shard of a site, loading it if needed."""
+        if name not in self.sites:
+            raise KeyError(f"Unknown site {name}, must be one of {self.names}")
+
+        with self._lock:
+            if name in self._shards:
+                self._shards.move_to_end(name)
+                return self._shards[name][0]
+
+        # Load outside of the manager's lock so other shards can still be served meanwhile
+        with self._load_locks[name]:
+            with self._lock:
+                if name in self._shards:
+                    return self._shards[name][0]
+
+            site = self.sites[name]
+            logger.info(f"Loading shard {name}...")
+            shard = self.load_fn(site)
+            size = directory_size(site.vector_store_path)
+
+            with self._lock:
+                self._shards[name] = (shard, size)
+                self._evict()
+            return shard
+
+    def update(self, name: str, update_fn: Callable[[T], None]):
+        """Apply update_fn to the shard of a site if it is loaded, e.g. to point it at a new vector store.
+
+        A shard being loaded is waited for, so it can't miss the update.
+        """
+        with self._load_locks[name]:
+            with self._lock:
+                if name not in self._shards:
+                    return
+                shard, _ = self._shards[name]
+
+            update_fn(shard)
+            size = directory_size(self.sites[name].vector_store_path)
+            with self._lock:
+                if name in self._shards:
+                    self._shards[name] = (shard, size)
+                    self._evict()
+
+    def _evict(self):
+        if self.memory_budget is None:
+            return
+        # Always keep the most recent shard, even if it alone exceeds the budget
+        while len(self._shards) > 1 and self.memory_used > self.memory_budget:
+            name, _ = self._shards.popitem(last=False)
+            logger.info(f"Evicted shard {name} to stay under the memory budget.")
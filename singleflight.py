@@ -0,0 +1,311 @@
+import asyncio
+import logging
+import threading
+from typing import AsyncIterator, Hashable, Iterator, Optional
+
+from buster.busterbot import Buster
+from buster.completers import Completion
+
+from async_serving import AsyncBuster, AsyncCompletion
+from caching import file_version, normalize_question
+
+logger = logging.getLogger(__name__)
+
+
+def flight_key(
+    user_input: str,
+    sources: Optional[list[str]],
+    top_k: Optional[int],
+    version_path: Optional[str],
+) -> Hashable:
+    """Requests with the same key get the same answer: same normalized question, sources, top_k and store version."""
+    version = file_version(version_path) if version_path is not None else None
+    return (
+        normalize_question(user_input),
+        tuple(sorted(sources)) if sources else None,
+        top_k,
+        version,
+    )
+
+
+def copy_outcome(completion: Completion, leader: Completion):
+    """Copy what is only known once the leader's answer is streamed: relevances, reranked documents, error."""
+    completion.error = leader.error
+    completion.matched_documents = leader.matched_documents.copy()
+    completion._question_relevant = leader._question_relevant
+    completion._answer_relevant = leader._answer_relevant
+
+
+class _Flight:
+    """One upstream answer, streamed to every request that joined it.
+
+    Tokens are kept so that requests joining late get the whole answer. The upstream stream is closed if all
+    its subscribers leave before it's done.
+    """
+
+    def __init__(self):
+        self.completion: Optional[Completion] = None
+        self.error: Optional[BaseException] = None
+        self.tokens: list[str] = []
+        self.done = False
+        self.subscribers = 0
+        self.abandoned = False
+        self.ready = threading.Event()
+        self._changed = threading.Condition()
+
+    def publish(self, token: str):
+        with self._changed:
+            self.tokens.append(token)
+            self._changed.notify_all()
+
+    def finish(self, error: Optional[BaseException] = None):
+        with self._changed:
+            self.error = error
+            self.done = True
+            self._changed.notify_all()
+
+    def subscribe(self) -> Iterator[str]:
+        position = 0
+        try:
+            while True:
+                with self._changed:
+                    self._changed.wait_for(
+                        lambda: self.done or position < len(self.tokens)
+                    )
+                    tokens = self.tokens[position:]
+                    done, error = self.done, self.error
+                position += len(tokens)
+                yield from tokens
+                if done and position == len(self.tokens):
+                    if error is not None:
+                        raise error
+                    return
+        finally:
+            self.leave()
+
+    def leave(self):
+        with self._changed:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self.abandoned = True
+
+
+class SingleFlightBuster:
+    """Buster sharing one answer between concurrent requests for the same question (see flight_key).
+
+    The first request runs buster.process_input, the ones arriving while its answer is being generated wait for
+    it and stream the same tokens, instead of each validating, embedding and completing the question again.
+    Once an answer is fully streamed, repeated questions go to the buster (and its answer cache) again.
+    Each request gets its own Completion, so it can be modified (e.g. by formatting its sources) independently.
+    """
+
+    def __init__(self, buster: Buster, version_path: Optional[str] = None):
+        self.buster = buster
+        self.version_path = version_path
+        self._flights: dict[Hashable, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.buster, name)
+
+    def process_input(
+        self,
+        user_input: str,
+        sources: Optional[list[str]] = None,
+        top_k: Optional[int] = None,
+    ) -> Completion:
+        key = flight_key(user_input, sources, top_k, self.version_path)
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            flight.subscribers += 1
+
+        if leader:
+            try:
+                flight.completion = self.buster.process_input(
+                    user_input, sources=sources, top_k=top_k
+                )
+            except BaseException as e:
+                flight.finish(e)
+                self._land(key, flight)
+                raise
+            finally:
+                flight.ready.set()
+            threading.Thread(target=self._pump, args=(key, flight), daemon=True).start()
+        else:
+            logger.info("Same question already being answered, sharing its answer.")
+            flight.ready.wait()
+            if flight.completion is None:
+                flight.leave()
+                raise flight.error
+
+        completion = Completion(
+            error=flight.completion.error,
+            user_input=user_input,
+            matched_documents=flight.completion.matched_documents.copy(),
+            answer_generator=flight.subscribe(),
+            question_relevant=flight.completion._question_relevant,
+            completion_kwargs=flight.completion.completion_kwargs,
+            validator=flight.completion.validator,
+        )
+        completion.postprocess = lambda: copy_outcome(completion, flight.completion)
+        return completion
+
+    def _pump(self, key: Hashable, flight: _Flight):
+        """Stream the upstream answer (which postprocesses it) to the flight's subscribers."""
+        answer_generator = flight.completion.answer_generator
+        error = None
+        try:
+            for token in answer_generator:
+                flight.publish(token)
+                if flight.abandoned:
+                    logger.info("All requests left, dropping the shared answer.")
+                    answer_generator.close()
+                    break
+        except Exception as e:
+            logger.exception("Shared answer failed. See traceback:")
+            error = e
+        finally:
+            self._land(key, flight)
+            flight.finish(error)
+
+    def _land(self, key: Hashable, flight: _Flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+
+class _AsyncFlight:
+    """Same as _Flight, for AsyncSingleFlightBuster."""
+
+    def __init__(self):
+        self.completion: Optional[AsyncCompletion] = None
+        self.tokens: list[str] = []
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self.ready: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._changed = asyncio.Event()
+
+    def notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        position = 0
+        try:
+            while True:
+                changed = self._changed
+                while position < len(self.tokens):
+                    position += 1
+                    yield self.tokens[position - 1]
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                if position == len(self.tokens):
+                    await changed.wait()
+        finally:
+            self.leave()
+
+    def leave(self):
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.done and self.task is not None:
+            logger.info("All requests left, dropping the shared answer.")
+            self.task.cancel()
+
+
+class AsyncSingleFlightBuster:
+    """AsyncBuster sharing one answer between concurrent requests for the same question, see SingleFlightBuster.
+
+    Like AsyncBuster, its buster attribute is the sync counterpart (a SingleFlightBuster) for the sync code paths.
+    """
+
+    def __init__(self, async_buster: AsyncBuster, version_path: Optional[str] = None):
+        self.async_buster = async_buster
+        self.buster = SingleFlightBuster(async_buster.buster, version_path)
+        self.version_path = version_path
+        self._flights: dict[Hashable, _AsyncFlight] = {}
+
+    async def close(self):
+        await self.async_buster.close()
+
+    def set_version_path(self, version_path: Optional[str]):
+        """Key the answers by another store's version, e.g. once it replaced the one being served."""
+        self.version_path = self.buster.version_path = version_path
+
+    async def process_input(
+        self,
+        user_input: str,
+        sources: Optional[list[str]] = None,
+        top_k: Optional[int] = None,
+    ) -> AsyncCompletion:
+        key = flight_key(user_input, sources, top_k, self.version_path)
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _AsyncFlight()
+            flight.task = asyncio.create_task(
+                self._run(key, flight, user_input, sources, top_k)
+            )
+        else:
+            logger.info("Same question already being answered, sharing its answer.")
+        flight.subscribers += 1
+
+        try:
+            # Shielded: a request leaving doesn't cancel the answer the others are waiting for
+            leader = await asyncio.shield(flight.ready)
+        except BaseException:
+            flight.leave()
+            raise
+
+        async def postprocess(completion: AsyncCompletion):
+            copy_outcome(completion, leader)
+
+        return AsyncCompletion(
+            user_input=user_input,
+            matched_documents=leader.matched_documents.copy(),
+            answer_stream=flight.subscribe(),
+            postprocess=postprocess,
+            error=leader.error,
+            question_relevant=leader._question_relevant,
+            completion_kwargs=leader.completion_kwargs,
+        )
+
+    async def _run(
+        self,
+        key: Hashable,
+        flight: _AsyncFlight,
+        user_input: str,
+        sources: Optional[list[str]],
+        top_k: Optional[int],
+    ):
+        """Answer the question and stream the answer (which postprocesses it) to the flight's subscribers."""
+        try:
+            flight.completion = await self.async_buster.process_input(
+                user_input, sources=sources, top_k=top_k
+            )
+            flight.ready.set_result(flight.completion)
+            async for token in flight.completion.answer_generator:
+                flight.tokens.append(token)
+                flight.notify()
+        except BaseException as e:
+            if not flight.ready.done():
+                if isinstance(e, asyncio.CancelledError):
+                    flight.ready.cancel()
+                else:
+                    flight.ready.set_exception(e)
+                    # Retrieved by the requests waiting on it, if any
+                    flight.ready.exception()
+            if not isinstance(e, asyncio.CancelledError):
+                logger.exception("Shared answer failed. See traceback:")
+            flight.error = e
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.done = True
+            flight.notify()
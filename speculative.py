@@ -0,0 +1,99 @@
+import contextvars
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterator, Optional
+
+import pandas as pd
+from buster.busterbot import Buster
+from buster.completers import Completion
+
+from caching import CachedBuster
+
+logger = logging.getLogger(__name__)
+
+
+class SpeculativeBuster(Buster):
+    """Buster validating the question concurrently with the retrieval and the answer generation.
+
+    Buster.process_input waits for the question validation (an LLM call) before retrieving documents and
+    requesting the answer. Here the answer is requested right away, assuming the question is relevant,
+    and its tokens are held back until the validation is done. If the question turns out to be irrelevant,
+    the answer stream is dropped and replaced with the validator's message.
+    Time to first token goes from validation + retrieval + completion to max(validation, retrieval + completion).
+    """
+
+    def __init__(self, *args, max_workers: int = 16, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="validation"
+        )
+
+    def gate(
+        self,
+        completion: Completion,
+        answer_generator: Iterator[str],
+        validation: Future,
+    ) -> Iterator[str]:
+        """Stream the answer once the question is validated, or the validator's message if it isn't."""
+        # On errors, the completer's answer is the error message rather than a stream
+        if isinstance(answer_generator, str):
+            answer_generator = iter([answer_generator])
+        else:
+            answer_generator = iter(answer_generator)
+        first_token = self.executor.submit(next, answer_generator, None)
+        question_relevant, irrelevant_question_message = validation.result()
+
+        if not question_relevant:
+            logger.info("Question is irrelevant, dropping the speculative answer.")
+            # Can't close a generator while another thread is waiting on it
+            if hasattr(answer_generator, "close"):
+                first_token.add_done_callback(lambda _: answer_generator.close())
+            completion._question_relevant = False
+            completion._answer_relevant = False
+            completion.error = False
+            completion.matched_documents = pd.DataFrame()
+            yield irrelevant_question_message
+            return
+
+        token = first_token.result()
+        if token is None:
+            return
+        yield token
+        yield from answer_generator
+
+    def process_input(
+        self,
+        user_input: str,
+        sources: Optional[list[str]] = None,
+        top_k: Optional[int] = None,
+    ) -> Completion:
+        logger.info(f"User Input:\n{user_input}")
+
+        # Same as Buster.process_input, avoids completing the question
+        if not user_input.endswith("\n"):
+            user_input += "\n"
+
+        # The validation runs in the request's context, so it is part of the request's trace
+        validation = self.executor.submit(
+            contextvars.copy_context().run,
+            self.validator.check_question_relevance,
+            user_input,
+        )
+        matched_documents = self.retriever.retrieve(
+            user_input, sources=sources, top_k=top_k
+        )
+        completion: Completion = self.document_answerer.get_completion(
+            user_input=user_input,
+            matched_documents=matched_documents,
+            validator=self.validator,
+            question_relevant=True,
+        )
+
+        completion.answer_generator = self.gate(
+            completion, completion._answer_generator, validation
+        )
+        return completion
+
+
+class CachedSpeculativeBuster(CachedBuster, SpeculativeBuster):
+    """SpeculativeBuster answering from a SemanticAnswerCache when possible, see CachedBuster."""
@@ -0,0 +1,89 @@
+import asyncio
+import contextlib
+import time
+from typing import AsyncIterator, Iterator
+
+# Tokens are sent to the browser at most this often (seconds)
+FLUSH_INTERVAL = 0.05
+# ... or as soon as this many characters are waiting
+MAX_FLUSH_CHARS = 1000
+
+
+def coalesce(
+    tokens: Iterator[str],
+    interval: float = FLUSH_INTERVAL,
+    max_chars: int = MAX_FLUSH_CHARS,
+) -> Iterator[str]:
+    """Join a stream of tokens into chunks, sent at most every interval seconds or once max_chars are waiting.
+
+    The first token is sent right away. Tokens that arrive within the interval wait for the next one (or the
+    end of the stream), use acoalesce to also flush them when the interval runs out.
+    """
+    pending = []
+    pending_chars = 0
+    last_flush = None
+    for token in tokens:
+        pending.append(token)
+        pending_chars += len(token)
+        now = time.monotonic()
+        if (
+            last_flush is None
+            or now - last_flush >= interval
+            or pending_chars >= max_chars
+        ):
+            yield "".join(pending)
+            pending, pending_chars, last_flush = [], 0, now
+
+    if pending:
+        yield "".join(pending)
+
+
+async def acoalesce(
+    tokens: AsyncIterator[str],
+    interval: float = FLUSH_INTERVAL,
+    max_chars: int = MAX_FLUSH_CHARS,
+) -> AsyncIterator[str]:
+    """Same as coalesce for an async stream. Waiting tokens are flushed when the interval runs out."""
+    loop = asyncio.get_running_loop()
+    iterator = tokens.__aiter__()
+    next_token = None
+    pending = []
+    pending_chars = 0
+    last_flush = None
+    try:
+        while True:
+            if next_token is None:
+                next_token = asyncio.ensure_future(iterator.__anext__())
+            timeout = None
+            if pending:
+                timeout = max(last_flush + interval - loop.time(), 0)
+            done, _ = await asyncio.wait({next_token}, timeout=timeout)
+
+            if done:
+                task, next_token = next_token, None
+                try:
+                    token = task.result()
+                except StopAsyncIteration:
+                    break
+                pending.append(token)
+                pending_chars += len(token)
+                if (
+                    last_flush is not None
+                    and loop.time() - last_flush < interval
+                    and pending_chars < max_chars
+                ):
+                    continue
+
+            yield "".join(pending)
+            pending, pending_chars, last_flush = [], 0, loop.time()
+
+        if pending:
+            yield "".join(pending)
+    finally:
+        if next_token is not None:
+            # The consumer stopped early (e.g. the user disconnected)
+            next_token.cancel()
+            with contextlib.suppress(BaseException):
+                await next_token
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
@@ -0,0 +1,71 @@
+import pandas as pd
+import pytest
+from buster.completers import Completer, DocumentAnswerer
+
+from speculative import SpeculativeBuster
+
+ERROR_MESSAGE = "Something went wrong with the request, try again soon!"
+
+
+class FailingCompleter(Completer):
+    def complete(self, prompt: str, user_input):
+        raise RuntimeError("API unavailable")
+
+
+class StaticDocumentsFormatter:
+    def format(self, matched_documents):
+        return "documents", matched_documents
+
+
+class StaticPromptFormatter:
+    def format(self, documents):
+        return documents
+
+
+class StaticRetriever:
+    def retrieve(self, user_input, sources=None, top_k=None):
+        return pd.DataFrame(
+            {
+                "title": ["Install"],
+                "url": ["https://docs/install"],
+                "content": ["pip install"],
+            }
+        )
+
+
+class StaticValidator:
+    use_reranking = False
+
+    def __init__(self, question_relevant: bool):
+        self.question_relevant = question_relevant
+
+    def check_question_relevance(self, user_input):
+        return self.question_relevant, "Not a question about the docs."
+
+    def check_answer_relevance(self, answer):
+        return True
+
+
+def make_buster(question_relevant: bool) -> SpeculativeBuster:
+    document_answerer = DocumentAnswerer(
+        documents_formatter=StaticDocumentsFormatter(),
+        prompt_formatter=StaticPromptFormatter(),
+        completer=FailingCompleter(completion_kwargs={}),
+    )
+    return SpeculativeBuster(
+        retriever=StaticRetriever(),
+        document_answerer=document_answerer,
+        validator=StaticValidator(question_relevant),
+    )
+
+
+@pytest.mark.parametrize(
+    "question_relevant, answer",
+    [(True, ERROR_MESSAGE), (False, "Not a question about the docs.")],
+)
+def test_erroring_completer(question_relevant, answer):
+    completion = make_buster(question_relevant).process_input("How to install?")
+
+    assert "".join(completion.answer_generator) == answer
+    assert completion.error == question_relevant
+    assert completion.question_relevant == question_relevant
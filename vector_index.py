@@ -0,0 +1,295 @@
+import fcntl
+import glob
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize vectors (rows), so that dot products are cosine similarities."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def kmeans(
+    vectors: np.ndarray, n_clusters: int, n_iter: int = 10, seed: int = 0
+) -> np.ndarray:
+    """Spherical k-means on normalized vectors, returns the normalized centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=n_clusters, replace=False)]
+    for _ in range(n_iter):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        # Empty clusters keep their previous centroid
+        centroids = np.where(counts[:, None] > 0, normalize(sums), centroids)
+    return centroids
+
+
+class VectorStorage:
+    """Normalized vectors stored as float32, float16 or int8 with a per-vector scale.
+
+    When saved, each array is its own .npy file so it can be memory-mapped: processes loading the same
+    files share their pages through the OS page cache instead of each holding a copy.
+    Quantized storage can keep the exact float32 vectors alongside, to rescore the final candidates.
+    """
+
+    dtypes = ["float32", "float16", "int8"]
+
+    def __init__(
+        self,
+        data: np.ndarray,
+        scales: Optional[np.ndarray] = None,
+        exact: Optional[np.ndarray] = None,
+    ):
+        self.data = data
+        self.scales = scales
+        self.exact = exact
+
+    @classmethod
+    def from_vectors(
+        cls, vectors: np.ndarray, dtype: str = "float32", keep_exact: bool = False
+    ) -> "VectorStorage":
+        if dtype not in cls.dtypes:
+            raise ValueError(f"Unknown {dtype=}, must be one of {cls.dtypes}")
+
+        vectors = normalize(vectors)
+        exact = vectors if keep_exact and dtype != "float32" else None
+        if dtype == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales = np.maximum(scales, 1e-12).astype(np.float32)
+            data = np.round(vectors / scales[:, None]).astype(np.int8)
+            return cls(data, scales=scales, exact=exact)
+        return cls(vectors.astype(dtype), exact=exact)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    @property
+    def dtype(self) -> str:
+        return str(self.data.dtype)
+
+    def dot(self, start: int, end: int, query: np.ndarray) -> np.ndarray:
+        """(Approximate) cosine similarities of the query with vectors[start:end]."""
+        scores = self.data[start:end].astype(np.float32) @ query
+        if self.scales is not None:
+            scores *= self.scales[start:end]
+        return scores
+
+    def exact_dot(self, positions: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """Cosine similarities of the query with the vectors at positions, exact if the float32 vectors are kept."""
+        if self.exact is not None:
+            return self.exact[positions] @ query
+        return self.get(positions) @ query
+
+    def get(self, positions: np.ndarray) -> np.ndarray:
+        """The vectors at positions as float32, exact if possible, dequantized otherwise."""
+        if self.exact is not None:
+            return np.asarray(self.exact[positions])
+        vectors = self.data[positions].astype(np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[positions, None]
+        return vectors
+
+    def save(self, directory: str):
+        np.save(os.path.join(directory, f"vectors.{self.dtype}.npy"), self.data)
+        if self.scales is not None:
+            np.save(os.path.join(directory, "scales.npy"), self.scales)
+        if self.exact is not None:
+            np.save(os.path.join(directory, "vectors.exact.npy"), self.exact)
+
+    @classmethod
+    def load(cls, directory: str, dtype: str, mmap: bool = True) -> "VectorStorage":
+        mmap_mode = "r" if mmap else None
+
+        def load(name):
+            filepath = os.path.join(directory, name)
+            if not os.path.exists(filepath):
+                return None
+            return np.load(filepath, mmap_mode=mmap_mode)
+
+        data = load(f"vectors.{dtype}.npy")
+        if data is None:
+            raise FileNotFoundError(f"No {dtype} vectors in {directory}")
+        return cls(data, scales=load("scales.npy"), exact=load("vectors.exact.npy"))
+
+
+class IVFIndex:
+    """Inverted file index for approximate nearest neighbor search by cosine similarity, in pure NumPy.
+
+    Vectors are clustered with k-means into n_lists lists. A query only scans the vectors of the nprobe lists
+    whose centroids are closest to it: a higher nprobe means better recall but higher latency,
+    nprobe >= n_lists is an exact search.
+    Vectors are kept in a VectorStorage, contiguously per list.
+    """
+
+    # Below this many vectors, a single list (exact search) is fast enough
+    min_vectors_per_list = 256
+
+    def __init__(
+        self, centroids: np.ndarray, list_offsets: np.ndarray, ids: np.ndarray
+    ):
+        self.centroids = centroids
+        # Vector ids sorted by list, ids[list_offsets[i]:list_offsets[i + 1]] are the vectors of list i
+        self.list_offsets = list_offsets
+        self.ids = ids
+        self.storage: Optional[VectorStorage] = None
+        self._positions = np.empty_like(ids)
+        self._positions[ids] = np.arange(len(ids))
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(
+        cls,
+        vectors: np.ndarray,
+        n_lists: Optional[int] = None,
+        dtype: str = "float32",
+        keep_exact: bool = False,
+        seed: int = 0,
+    ) -> "IVFIndex":
+        """Build the index over vectors, stored as dtype (see VectorStorage)."""
+        vectors = normalize(vectors)
+        if n_lists is None:
+            n_lists = int(np.sqrt(len(vectors)))
+        n_lists = max(1, min(n_lists, len(vectors) // cls.min_vectors_per_list))
+
+        if n_lists == 1:
+            centroids = normalize(vectors.mean(axis=0, keepdims=True))
+            assignments = np.zeros(len(vectors), dtype=np.int64)
+        else:
+            # Train on a sample, it's plenty to place the centroids
+            rng = np.random.default_rng(seed)
+            sample_size = min(len(vectors), 64 * n_lists)
+            sample = vectors[rng.choice(len(vectors), size=sample_size, replace=False)]
+            centroids = kmeans(sample, n_lists, seed=seed)
+            assignments = np.argmax(vectors @ centroids.T, axis=1)
+
+        ids = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=n_lists)
+        list_offsets = np.concatenate([[0], np.cumsum(counts)])
+        logger.info(
+            f"Built IVF index of {len(vectors)} vectors with {n_lists=}, stored as {dtype}"
+        )
+
+        index = cls(centroids, list_offsets, ids)
+        index.storage = VectorStorage.from_vectors(
+            vectors[ids], dtype=dtype, keep_exact=keep_exact
+        )
+        return index
+
+    def vectors_by_id(self, ids: np.ndarray) -> np.ndarray:
+        """Get the (normalized) vectors with the given ids."""
+        return self.storage.get(self._positions[ids])
+
+    def search(
+        self, query: np.ndarray, k: int, nprobe: int = 8, rescore_factor: int = 4
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the ids and cosine similarities of the (approximate) top k vectors, best first.
+
+        With quantized storage and exact vectors kept, the top k * rescore_factor candidates are rescored exactly.
+        """
+        query = normalize(query)
+        nprobe = min(nprobe, self.n_lists)
+        if nprobe == self.n_lists:
+            lists = np.arange(self.n_lists)
+        else:
+            lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+
+        positions = np.concatenate(
+            [np.arange(self.list_offsets[i], self.list_offsets[i + 1]) for i in lists]
+        )
+        scores = np.concatenate(
+            [
+                self.storage.dot(self.list_offsets[i], self.list_offsets[i + 1], query)
+                for i in lists
+            ]
+        )
+
+        rescore = self.storage.exact is not None
+        n_candidates = min(k * rescore_factor if rescore else k, len(positions))
+        if n_candidates == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+        top = np.argpartition(-scores, n_candidates - 1)[:n_candidates]
+        positions = positions[top]
+        scores = scores[top]
+
+        if rescore:
+            # Sorted positions make reads of the memory-mapped exact vectors sequential
+            order = np.argsort(positions)
+            positions = positions[order]
+            scores = self.storage.exact_dot(positions, query)
+
+        top = np.argsort(-scores)[:k]
+        return self.ids[positions[top]], scores[top]
+
+    def save(self, directory: str, **extra):
+        """Save the index and its vectors to a directory, with optional extra arrays.
+
+        directory is a symlink to the latest saved version, replaced atomically: readers see either the
+        previous index or this one, and concurrent saves all succeed (the last one to swap wins).
+        The version it replaces is kept for the readers still loading it, older ones are deleted.
+        """
+        directory = os.path.normpath(directory)
+        tmp_directory = f"{directory}.tmp-{os.getpid()}-{threading.get_ident()}"
+        os.makedirs(tmp_directory, exist_ok=True)
+        np.savez(
+            os.path.join(tmp_directory, "index.npz"),
+            centroids=self.centroids,
+            list_offsets=self.list_offsets,
+            ids=self.ids,
+            dtype=np.array(self.storage.dtype),
+            **extra,
+        )
+        self.storage.save(tmp_directory)
+
+        # Swaps are serialized, so that one doesn't delete the version another is about to make current
+        with open(f"{directory}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            version = f"{directory}.v{time.time_ns()}-{os.getpid()}"
+            os.rename(tmp_directory, version)
+            link = f"{version}.link"
+            os.symlink(os.path.basename(version), link)
+
+            previous = None
+            if os.path.islink(directory):
+                previous = os.path.realpath(directory)
+            elif os.path.isdir(directory):
+                # Saved before versions were used
+                shutil.rmtree(directory)
+            os.replace(link, directory)
+
+            keep = {os.path.realpath(version), previous}
+            for old_version in glob.glob(f"{glob.escape(directory)}.v*"):
+                if (
+                    os.path.isdir(old_version)
+                    and os.path.realpath(old_version) not in keep
+                ):
+                    shutil.rmtree(old_version, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> tuple["IVFIndex", dict]:
+        """Load an index saved with save(), returns it along with the extra arrays.
+
+        With mmap=True, vectors are memory-mapped instead of read into memory.
+        """
+        with np.load(os.path.join(directory, "index.npz")) as data:
+            arrays = dict(data)
+        index = cls(
+            arrays.pop("centroids"), arrays.pop("list_offsets"), arrays.pop("ids")
+        )
+        index.storage = VectorStorage.load(
+            directory, dtype=str(arrays.pop("dtype")), mmap=mmap
+        )
+        return index, arrays